@@ -0,0 +1,163 @@
+'''
+A spatial index over a layer's brick table, so that finding the bricks
+touching a tile is a couple of binary searches plus vectorized cuts
+rather than a scan (and a Python loop) over every brick.
+'''
+from __future__ import print_function
+import numpy as np
+
+from map.utils import ra_ranges_overlap
+
+class BrickIndex(object):
+    '''
+    Index over a brick table with *ra*, *dec*, *ra1*, *ra2*, *dec1*,
+    *dec2* columns.  Queries return (sorted) row numbers into *bricks*,
+    so the results come out in the same order as a full-table cut.
+    '''
+    def __init__(self, bricks):
+        self.bricks = bricks
+        # Sorted-Dec tables for box and radius queries, built on demand
+        # (not every brick table has both RA,Dec boxes and centers).
+        self.dec1_order = None
+        self.dec_order = None
+        # Brick outlines (RA,Dec of 9 points walking the boundary),
+        # filled in on demand by touching_wcs().  Allocated here, not on
+        # first use, since concurrent requests fill them in.  (Their
+        # pages are only touched as they get filled.)
+        N = len(bricks)
+        self.outline_ra = np.zeros((N, 9))
+        self.outline_dec = np.zeros((N, 9))
+        self.have_outline = np.zeros(N, bool)
+
+    def __len__(self):
+        return len(self.bricks)
+
+    def touching_radec_box(self, ralo, rahi, declo, dechi):
+        '''
+        Bricks whose RA,Dec box overlaps the given one (which may wrap
+        around RA=0).
+        '''
+        if self.dec1_order is None:
+            B = self.bricks
+            # bricks sorted by lower Dec edge
+            order = np.argsort(B.dec1, kind='mergesort')
+            self.dec1 = B.dec1[order]
+            self.maxheight = np.max(B.dec2 - B.dec1) if len(B) else 0.
+            self.dec1_order = order
+        # dec2 >= declo implies dec1 >= declo - maxheight
+        i0 = np.searchsorted(self.dec1, declo - self.maxheight - 1e-9, side='left')
+        i1 = np.searchsorted(self.dec1, dechi, side='right')
+        I = self.dec1_order[i0:i1]
+        B = self.bricks
+        I = I[B.dec2[I] >= declo]
+        I = I[ra_ranges_overlap(ralo, rahi, B.ra1[I], B.ra2[I])]
+        return np.sort(I)
+
+    def within_radius(self, ra, dec, radius):
+        '''Bricks whose centers are within *radius* degrees of *ra*,*dec*.'''
+        from astrometry.util.starutil_numpy import radectoxyz, deg2distsq
+        if self.dec_order is None:
+            B = self.bricks
+            # bricks sorted by center Dec
+            order = np.argsort(B.dec, kind='mergesort')
+            self.dec = B.dec[order]
+            self.xyz = radectoxyz(B.ra, B.dec)
+            self.dec_order = order
+        i0 = np.searchsorted(self.dec, dec - radius, side='left')
+        i1 = np.searchsorted(self.dec, dec + radius, side='right')
+        I = self.dec_order[i0:i1]
+        d2 = np.sum((self.xyz[I,:] - radectoxyz(ra, dec))**2, axis=1)
+        I = I[d2 <= deg2distsq(radius)]
+        return np.sort(I)
+
+    def get_outlines(self, I, get_wcs):
+        '''
+        Returns RA,Dec arrays (len(I) x 9) walking the boundary of the
+        WCS returned by *get_wcs(brick)* for each of bricks *I*, computing
+        (and remembering) the ones we have not seen before.
+        '''
+        for i in I[np.logical_not(self.have_outline[I])]:
+            bwcs = get_wcs(self.bricks[i])
+            bh,bw = bwcs.shape
+            xl,xm,xh = 0.5, (bw+1)/2., bw+0.5
+            yl,ym,yh = 0.5, (bh+1)/2., bh+0.5
+            rr,dd = bwcs.pixelxy2radec([xl, xm, xh, xh, xh, xm, xl, xl, xl],
+                                       [yl, yl, yl, ym, yh, yh, yh, ym, yl])
+            self.outline_ra [i,:] = rr
+            self.outline_dec[i,:] = dd
+            # (only after the outline is in place)
+            self.have_outline[i] = True
+        return self.outline_ra[I,:], self.outline_dec[I,:]
+
+    def touching_wcs(self, wcs, I, get_wcs):
+        '''
+        Returns the subset of bricks *I* whose outlines (see get_outlines)
+        overlap the pixel area of *wcs*.
+        '''
+        I = np.asarray(I, dtype=int)
+        if len(I) == 0:
+            return I
+        rr,dd = self.get_outlines(I, get_wcs)
+        ok,bx,by = wcs.radec2pixelxy(rr.ravel(), dd.ravel())
+        shape = rr.shape
+        ok = np.asarray(ok, bool).reshape(shape)
+        bx = np.asarray(bx).reshape(shape)
+        by = np.asarray(by).reshape(shape)
+        W = wcs.get_width()
+        H = wcs.get_height()
+        allok = np.all(ok, axis=1)
+        hit = np.zeros(len(I), bool)
+        hit[allok], exact = polygons_touch_rect(bx[allok], by[allok],
+                                                0.5, W+0.5, 0.5, H+0.5)
+        # Bricks with points that did not project, or with non-convex
+        # outlines: do it the slow, general way.
+        check = np.zeros(len(I), bool)
+        check[allok] = np.logical_not(exact)
+        check[np.logical_not(allok)] = True
+        if np.any(check):
+            from astrometry.util.miscutils import polygons_intersect
+            xl,xm,xh = 0.5, (W+1)/2., W+0.5
+            yl,ym,yh = 0.5, (H+1)/2., H+0.5
+            xy = np.array([[xl,yl], [xm, yl], [xh,yl], [xh,ym], [xh,yh],
+                           [xm,yh], [xl,yh], [xl,ym], [xl,yl]])
+            for j in np.flatnonzero(check):
+                k = ok[j,:]
+                if not np.any(k):
+                    hit[j] = False
+                    continue
+                hit[j] = polygons_intersect(xy, np.vstack((bx[j,k], by[j,k])).T)
+        return I[hit]
+
+def polygons_touch_rect(px, py, x0, x1, y0, y1):
+    '''
+    Vectorized overlap test between N closed polygons (vertices in rows
+    of *px*, *py*) and the rectangle [x0,x1] x [y0,y1], via separating
+    axes.  Returns (overlaps, exact) boolean arrays; the test is exact
+    for convex polygons, while for non-convex ones "overlaps" may be a
+    false positive (exact=False).
+    '''
+    n = len(px)
+    if n == 0:
+        return np.zeros(0, bool), np.zeros(0, bool)
+    hit = ((px.max(axis=1) >= x0) * (px.min(axis=1) <= x1) *
+           (py.max(axis=1) >= y0) * (py.min(axis=1) <= y1))
+    # Edge vectors and their normals
+    ex = np.diff(px, axis=1)
+    ey = np.diff(py, axis=1)
+    nx,ny = -ey, ex
+    # Project polygon vertices and rectangle corners onto each normal
+    pp = nx[:,:,np.newaxis] * px[:,np.newaxis,:] + ny[:,:,np.newaxis] * py[:,np.newaxis,:]
+    cx = np.array([x0, x1, x1, x0])
+    cy = np.array([y0, y0, y1, y1])
+    rp = nx[:,:,np.newaxis] * cx + ny[:,:,np.newaxis] * cy
+    separated = np.any((rp.max(axis=2) < pp.min(axis=2)) +
+                       (rp.min(axis=2) > pp.max(axis=2)), axis=1)
+    hit *= np.logical_not(separated)
+    # Convex if consecutive edges all turn the same way
+    cross = ex * np.roll(ey, -1, axis=1) - ey * np.roll(ex, -1, axis=1)
+    tol = 1e-9 * np.max(np.abs(cross), axis=1)[:,np.newaxis]
+    convex = np.logical_or(np.all(cross >= -tol, axis=1),
+                           np.all(cross <=  tol, axis=1))
+    # A separating axis is a proof of no overlap even for non-convex polygons
+    exact = np.logical_or(convex, np.logical_not(hit))
+    return hit, exact
@@ -0,0 +1,70 @@
+'''
+Per-process cache of the "unique area" masks of bricks (the pixels
+within the brick's RA,Dec bounds), used to mask model and resid bricks
+before coadding (see UniqueBrickMixin in map/views.py).
+
+The mask of a brick is the same every time, but computing it means
+computing RA,Dec for every pixel in the brick, so it is computed once
+per brick and kept as the range of unique pixels in each row.
+'''
+from __future__ import print_function
+
+import numpy as np
+
+from viewer import settings
+from map.filecache import LRUCache
+
+class RowRangeMask(object):
+    '''
+    A binary mask of shape (H, W) that is True for x0[y] <= x < x1[y] in
+    each row y.  It can be indexed like a boolean array with a pair of
+    integer arrays, mask[yy, xx], or sliced, mask[slc].
+    '''
+    def __init__(self, x0, x1, W):
+        self.x0 = x0
+        self.x1 = x1
+        self.shape = (len(x0), W)
+
+    def __getitem__(self, idx):
+        yy,xx = idx
+        if isinstance(yy, slice) and isinstance(xx, slice):
+            H,W = self.shape
+            y = np.arange(H)[yy]
+            x = np.arange(W)[xx]
+            return ((x[np.newaxis,:] >= self.x0[y][:,np.newaxis]) &
+                    (x[np.newaxis,:] <  self.x1[y][:,np.newaxis]))
+        return (xx >= self.x0[yy]) & (xx < self.x1[yy])
+
+def row_range_mask(U):
+    '''
+    Returns boolean mask *U* as a RowRangeMask, or *U* itself if some row
+    is not a single run of True pixels.
+    '''
+    H,W = U.shape
+    # number of runs of True pixels in each row
+    nruns = U[:,0].astype(np.int32) + np.sum(U[:,1:] & ~U[:,:-1], axis=1)
+    if np.any(nruns > 1):
+        return U
+    n = U.sum(axis=1)
+    x0 = np.where(n > 0, np.argmax(U, axis=1), 0).astype(np.int32)
+    x1 = (x0 + n).astype(np.int32)
+    return RowRangeMask(x0, x1, W)
+
+unique_masks = LRUCache(settings.UNIQUE_MASK_CACHE_SIZE)
+
+def get_unique_mask(bwcs, brick):
+    '''
+    Returns the (cached) mask of pixels of brick image *bwcs* within the
+    RA,Dec bounds of *brick*.  The returned mask is shared, so callers
+    must not modify it.
+    '''
+    H,W = bwcs.shape
+    key = (brick.brickname, H, W, tuple(bwcs.get_crval()), tuple(bwcs.get_crpix()))
+    U = unique_masks.get(key)
+    if U is None:
+        from legacypipe.utils import find_unique_pixels
+        U = find_unique_pixels(bwcs, W, H, None,
+                               brick.ra1, brick.ra2, brick.dec1, brick.dec2)
+        U = row_range_mask(U)
+        unique_masks.put(key, U)
+    return U
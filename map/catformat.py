@@ -0,0 +1,123 @@
+'''
+Encoding of catalog query results (dicts of per-object columns) as HTTP
+responses, either as JSON or, if the request has "format=binary", as a
+compact binary columnar format decoded by decodeCatalog() in
+static/utils.js.
+
+Values in the dict can be:
+- numpy arrays: one element (or row, for 2-d arrays, eg "rd") per object;
+- Records: one {field: value} object per object, from per-field arrays;
+- anything else json.dumps can handle (eg, lists of names).
+
+Binary format: the 4 bytes "CAT1", a little-endian uint32 header length,
+a UTF-8 JSON header, padding to a multiple of 8 bytes, then the array
+data, each array little-endian and starting on an 8-byte boundary.  The
+header is {"fields": [...]} with, for each dict entry in order, one of
+  {"name", "kind": "array", "dtype", "shape", "offset"}
+  {"name", "kind": "records", "fields": [{"name", "dtype", "shape", "offset"}, ...]}
+  {"name", "kind": "json", "value"}
+where offsets are relative to the start of the array data.
+'''
+from __future__ import print_function
+import json
+import struct
+
+import numpy as np
+from django.http import HttpResponse
+
+class Records(object):
+    '''
+    A catalog column of {field: value} objects, one per catalog entry,
+    given as a list of (field, array) pairs.
+    '''
+    def __init__(self, fields):
+        self.fields = list(fields)
+
+    def tolist(self):
+        names = [k for k,v in self.fields]
+        cols = [to_json_value(v) for k,v in self.fields]
+        return [dict(zip(names, vals)) for vals in zip(*cols)]
+
+def radec_column(ra, dec):
+    '''The usual "rd" column: an (N x 2) array of [RA, Dec] pairs.'''
+    return np.vstack((np.asarray(ra, np.float64), np.asarray(dec, np.float64))).T
+
+def to_json_value(val):
+    '''Converts numpy arrays (and Records) into plain Python lists.'''
+    if isinstance(val, (np.ndarray, np.generic, Records)):
+        return val.tolist()
+    return val
+
+def encode_json(rtn):
+    '''JSON-encodes a dict of catalog columns.'''
+    return json.dumps(dict([(k, to_json_value(v)) for k,v in rtn.items()]))
+
+# dtypes that map onto JavaScript typed arrays
+_js_dtypes = ['float64', 'float32', 'int32', 'uint32', 'int16', 'uint16', 'int8', 'uint8']
+
+def binary_array(val):
+    '''
+    Returns *val* as a little-endian array of a JavaScript typed array
+    type, or None if it cannot be sent that way.
+    '''
+    if not isinstance(val, np.ndarray):
+        return None
+    if val.dtype == bool:
+        val = val.astype(np.uint8)
+    elif val.dtype.kind in 'iu' and val.dtype.itemsize == 8:
+        # no 64-bit typed arrays; doubles are exact up to 2**53
+        if len(val) and np.max(np.abs(val.astype(np.float64))) >= 2.**53:
+            return None
+        val = val.astype(np.float64)
+    if val.dtype.kind not in 'iuf' or val.dtype.newbyteorder('<').name not in _js_dtypes:
+        return None
+    return np.ascontiguousarray(val, dtype=val.dtype.newbyteorder('<'))
+
+def encode_binary(rtn):
+    '''Encodes a dict of catalog columns in the binary format.'''
+    fields = []
+    blobs = []
+    nbytes = [0]
+    def add_array(name, arr):
+        data = arr.tobytes()
+        desc = dict(name=name, dtype=arr.dtype.name, shape=list(arr.shape),
+                    offset=nbytes[0])
+        blobs.append(data)
+        pad = (-len(data)) % 8
+        if pad:
+            blobs.append(b'\0' * pad)
+        nbytes[0] += len(data) + pad
+        return desc
+
+    for name,val in rtn.items():
+        if isinstance(val, Records):
+            arrs = [(k, binary_array(v)) for k,v in val.fields]
+            if all([a is not None for k,a in arrs]):
+                fields.append(dict(name=name, kind='records',
+                                   fields=[add_array(k, a) for k,a in arrs]))
+                continue
+        else:
+            arr = binary_array(val)
+            if arr is not None:
+                desc = add_array(name, arr)
+                desc.update(kind='array')
+                fields.append(desc)
+                continue
+        fields.append(dict(name=name, kind='json', value=to_json_value(val)))
+
+    header = json.dumps(dict(fields=fields)).encode('utf-8')
+    pad = (-(8 + len(header))) % 8
+    return b''.join([b'CAT1', struct.pack('<I', len(header) + pad), header,
+                     b' ' * pad] + blobs)
+
+def wants_binary(req):
+    return req.GET.get('format', None) == 'binary'
+
+def catalog_response(req, rtn):
+    '''
+    Returns an HttpResponse for the dict of catalog columns *rtn*, in the
+    format the request asked for.
+    '''
+    if wants_binary(req):
+        return HttpResponse(encode_binary(rtn), content_type='application/octet-stream')
+    return HttpResponse(encode_json(rtn), content_type='application/json')
@@ -0,0 +1,358 @@
+'''
+Level-of-detail pyramids of a layer's Tractor catalogs, so that the tiled
+catalog overlays (cat_decals) can show a bounded number of representative
+sources at low zoom, and answer high-zoom tiles from a compact index
+rather than by reading whole-brick Tractor files.
+
+Each brick_primary source gets a "minimum zoom": the first zoom level at
+which it is among the settings.CAT_PYRAMID_SOURCES_PER_TILE brightest
+sources of its Mercator tile; from FULL_ZOOM up, every source is shown.
+(A tile's children hold subsets of its sources, so a source shown at
+one zoom is shown at all higher zooms too.)
+
+A pyramid is a directory holding
+- "top": the sources with minimum zoom < CHUNK_ZOOM, for low-zoom tiles;
+- one level per CHUNK_ZOOM tile ("chunk") with any sources, holding all
+  of that chunk's sources, for tiles at CHUNK_ZOOM and up.
+Each level is a set of memory-mapped .npy columns with rows sorted by
+minimum zoom, then by the Z-order index ("key") of their tile at
+INDEX_ZOOM.  The sources of any tile at or below INDEX_ZOOM then form a
+contiguous range of keys, found by binary search in each minimum-zoom
+segment.
+
+Pyramids live under DATA_DIR/catpyramid and are built offline with
+
+    python -m map.catpyramid ls-dr9-north [...]
+'''
+from __future__ import print_function
+import os
+import json
+import threading
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, 'django-1.9')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'viewer.settings'
+    import django
+    django.setup()
+
+import numpy as np
+
+from viewer import settings
+from map.coverage import merc_tile_x, merc_tile_y
+
+# all sources are shown from this zoom level up
+FULL_ZOOM = 12
+# zoom level of the tiles that sources are split into for building / storage
+CHUNK_ZOOM = 6
+# zoom level of the tile index stored for each source
+INDEX_ZOOM = 16
+
+# Tractor catalog columns kept in the pyramid (those cat_decals sends)
+CAT_COLUMNS = ['ra', 'dec', 'type', 'flux_g', 'flux_r', 'flux_z',
+               'nobs_g', 'nobs_r', 'nobs_z', 'brickname', 'objid']
+
+def tile_key(x, y, zoom):
+    '''Z-order index of Mercator tile x,y at *zoom* (interleaved bits).'''
+    x = np.asarray(x, np.int64)
+    y = np.asarray(y, np.int64)
+    key = np.zeros(np.broadcast(x, y).shape, np.int64)
+    for b in range(zoom):
+        key |= ((x >> b) & 1) << (2*b)
+        key |= ((y >> b) & 1) << (2*b + 1)
+    return key
+
+def source_tile_keys(ra, dec):
+    '''Z-order indices of the INDEX_ZOOM tiles containing the given RA,Decs.'''
+    N = 2**INDEX_ZOOM
+    x = np.floor(merc_tile_x(np.asarray(ra) % 360., INDEX_ZOOM)).astype(np.int64) % N
+    y = np.clip(np.floor(merc_tile_y(np.asarray(dec), INDEX_ZOOM)).astype(np.int64), 0, N-1)
+    return tile_key(x, y, INDEX_ZOOM)
+
+def source_brightness(T):
+    return np.max([np.nan_to_num(T.get('flux_%s' % b)) for b in 'grz'], axis=0)
+
+def assign_min_zoom(key, brightness, maxper, zlo, zhi):
+    '''
+    Returns the minimum zoom level in [zlo, zhi] of each source: the first
+    zoom < zhi at which it is among the *maxper* brightest in its tile,
+    else zhi.
+    '''
+    n = len(key)
+    minzoom = np.zeros(n, np.int8) + zhi
+    # brightest first
+    order = np.argsort(-brightness, kind='mergesort')
+    key = key[order]
+    for zoom in range(zhi-1, zlo-1, -1):
+        tile = key >> (2 * (INDEX_ZOOM - zoom))
+        # group by tile, keeping brightness order within each tile
+        J = np.argsort(tile, kind='mergesort')
+        tile = tile[J]
+        start = np.append(0, np.flatnonzero(np.diff(tile)) + 1)
+        rank = np.arange(n) - np.repeat(start, np.diff(np.append(start, n)))
+        minzoom[order[J[rank < maxper]]] = zoom
+    return minzoom
+
+def write_level(dirnm, T, minzoom, zlo, zhi):
+    '''Writes the sources in table *T* with the given minimum zooms as a pyramid level.'''
+    os.makedirs(dirnm)
+    I = np.lexsort((T.key, minzoom))
+    offsets = np.searchsorted(minzoom[I], np.arange(zlo, zhi+2))
+    for col in CAT_COLUMNS + ['key']:
+        np.save(os.path.join(dirnm, 'col-%s.npy' % col), T.get(col)[I])
+    np.save(os.path.join(dirnm, 'offsets.npy'), offsets)
+    with open(os.path.join(dirnm, 'meta.json'), 'w') as f:
+        json.dump(dict(zlo=zlo, zhi=zhi, columns=CAT_COLUMNS), f)
+
+class PyramidLevel(object):
+    '''One (memory-mapped) level of a catalog pyramid; see write_level.'''
+    def __init__(self, dirnm):
+        self.dirnm = dirnm
+        with open(os.path.join(dirnm, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.zlo = self.meta['zlo']
+        self.zhi = self.meta['zhi']
+        self.offsets = np.load(os.path.join(dirnm, 'offsets.npy'))
+        self.cols = {}
+        self.key = self.get_column('key')
+
+    def get_column(self, col):
+        arr = self.cols.get(col)
+        if arr is None:
+            arr = np.load(os.path.join(self.dirnm, 'col-%s.npy' % col), mmap_mode='r')
+            self.cols[col] = arr
+        return arr
+
+    def tile_rows(self, zoom, x, y):
+        '''Returns the rows of the sources shown in tile zoom,x,y.'''
+        z = min(zoom, INDEX_ZOOM)
+        shift = zoom - z
+        klo = int(tile_key(x >> shift, y >> shift, z)) << (2 * (INDEX_ZOOM - z))
+        khi = klo + 4**(INDEX_ZOOM - z)
+        I = []
+        for m in range(self.zlo, min(zoom, self.zhi) + 1):
+            s0 = self.offsets[m - self.zlo]
+            s1 = self.offsets[m - self.zlo + 1]
+            i0,i1 = np.searchsorted(self.key[s0:s1], [klo, khi])
+            if i1 > i0:
+                I.append(np.arange(s0 + i0, s0 + i1))
+        if len(I) == 0:
+            return np.zeros(0, int)
+        return np.concatenate(I)
+
+    def read(self, I):
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        for col in self.meta['columns']:
+            T.set(col, np.array(self.get_column(col)[I]))
+        return T
+
+def chunk_name(x, y):
+    return 'chunk-%i-%i' % (x, y)
+
+class CatalogPyramid(object):
+    def __init__(self, dirnm):
+        from map.filecache import LRUCache, file_stamp
+        self.dirnm = dirnm
+        self.stamp = file_stamp(os.path.join(dirnm, 'meta.json'))
+        self.top = None
+        # (open levels hold a handful of mmaps each)
+        self.chunks = LRUCache(256)
+
+    def get_level(self, zoom, x, y):
+        if zoom < CHUNK_ZOOM:
+            if self.top is None:
+                self.top = PyramidLevel(os.path.join(self.dirnm, 'top'))
+            return self.top
+        shift = zoom - CHUNK_ZOOM
+        name = chunk_name(x >> shift, y >> shift)
+        level = self.chunks.get(name)
+        if level is None:
+            dirnm = os.path.join(self.dirnm, name)
+            if not os.path.exists(dirnm):
+                return None
+            level = PyramidLevel(dirnm)
+            self.chunks.put(name, level)
+        return level
+
+    def get_tile_catalog(self, zoom, x, y):
+        '''
+        Returns a table of the sources to show in Mercator tile zoom,x,y,
+        or None if there are none.
+        '''
+        level = self.get_level(zoom, x, y)
+        if level is None:
+            return None
+        I = level.tile_rows(zoom, x, y)
+        if len(I) == 0:
+            return None
+        T = level.read(I)
+        if zoom > INDEX_ZOOM:
+            # (we got the whole INDEX_ZOOM tile)
+            N = 2**zoom
+            tx = np.floor(merc_tile_x(T.ra % 360., zoom)).astype(np.int64) % N
+            ty = np.clip(np.floor(merc_tile_y(T.dec, zoom)).astype(np.int64), 0, N-1)
+            T.cut((tx == x) * (ty == y))
+            if len(T) == 0:
+                return None
+        return T
+
+def get_pyramid_dir(name):
+    return os.path.join(settings.DATA_DIR, 'catpyramid', name)
+
+# layer name -> CatalogPyramid
+_pyramids = {}
+_pyramids_lock = threading.Lock()
+
+def get_catalog_pyramid(layer):
+    '''
+    Returns the (per-process) CatalogPyramid of MapLayer *layer*, or None
+    if none has been built.
+    '''
+    from map.filecache import file_stamp
+    dirnm = get_pyramid_dir(layer.name)
+    try:
+        stamp = file_stamp(os.path.join(dirnm, 'meta.json'))
+    except OSError:
+        return None
+    pyr = _pyramids.get(layer.name)
+    if pyr is not None and pyr.stamp == stamp:
+        return pyr
+    with _pyramids_lock:
+        pyr = _pyramids.get(layer.name)
+        if pyr is None or pyr.stamp != stamp:
+            try:
+                pyr = CatalogPyramid(dirnm)
+            except (IOError, OSError, ValueError) as e:
+                print('Failed to open catalog pyramid', dirnm, ':', e)
+                return None
+            _pyramids[layer.name] = pyr
+    return pyr
+
+# (mtime of DATA_DIR/catpyramid, result of catalog_min_zooms)
+_min_zooms = [None, None]
+
+def catalog_min_zooms():
+    '''
+    Returns a dict of layer name -> CAT_PYRAMID_MIN_ZOOM for the layers
+    with a catalog pyramid, for the web page: it asks for the Tractor
+    catalog tiles of other layers only from FULL_ZOOM up.  The result
+    is cached until the pyramid directory changes.
+    '''
+    from map.views import get_layer
+    topdir = os.path.join(settings.DATA_DIR, 'catpyramid')
+    try:
+        mtime = os.stat(topdir).st_mtime
+        if _min_zooms[0] == mtime:
+            return _min_zooms[1]
+        names = os.listdir(topdir)
+    except OSError:
+        return {}
+    zooms = {}
+    for name in names:
+        # (skip the temporary directories of build_catalog_pyramid)
+        if name.endswith('.tmp') or name.endswith('.old'):
+            continue
+        layer = get_layer(name)
+        if layer is not None and get_catalog_pyramid(layer) is not None:
+            zooms[layer.name] = settings.CAT_PYRAMID_MIN_ZOOM
+    _min_zooms[:] = [mtime, zooms]
+    return zooms
+
+def bricks_by_chunk(bricks):
+    '''Returns a dict from CHUNK_ZOOM tile (x,y) to the indices of the bricks touching it.'''
+    N = 2**CHUNK_ZOOM
+    ra1 = bricks.ra1
+    ra2 = bricks.ra2 + 360. * (bricks.ra2 < bricks.ra1)
+    # RA increases to the left
+    x0 = np.floor(merc_tile_x(ra2, CHUNK_ZOOM)).astype(int)
+    x1 = np.floor(merc_tile_x(ra1, CHUNK_ZOOM)).astype(int)
+    y0 = np.clip(np.floor(merc_tile_y(bricks.dec2, CHUNK_ZOOM)).astype(int), 0, N-1)
+    y1 = np.clip(np.floor(merc_tile_y(bricks.dec1, CHUNK_ZOOM)).astype(int), 0, N-1)
+    chunks = {}
+    for i in range(len(bricks)):
+        for x in range(x0[i], x1[i]+1):
+            for y in range(y0[i], y1[i]+1):
+                chunks.setdefault((x % N, y), []).append(i)
+    return chunks
+
+def build_catalog_pyramid(layer, dirnm=None, maxper=None):
+    '''
+    Builds the catalog pyramid of MapLayer *layer* (which must have
+    get_brick_catalogs(), eg DecalsLayer) from its Tractor catalogs.
+    '''
+    import tempfile
+    import shutil
+    from astrometry.util.fits import merge_tables
+
+    if dirnm is None:
+        dirnm = get_pyramid_dir(layer.name)
+    if maxper is None:
+        maxper = settings.CAT_PYRAMID_SOURCES_PER_TILE
+    bricks = layer.get_coverage_bricks()
+    if bricks is None:
+        raise RuntimeError('No bricks for layer %s' % layer.name)
+    chunks = bricks_by_chunk(bricks)
+
+    parent = os.path.dirname(dirnm)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmpdir = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    top = []
+    nsources = 0
+    for i,((cx,cy),I) in enumerate(sorted(chunks.items())):
+        print('Chunk', i+1, 'of', len(chunks), ': tile', CHUNK_ZOOM, cx, cy,
+              ':', len(I), 'bricks')
+        cats = layer.get_brick_catalogs(np.unique(bricks.brickname[np.array(I)]),
+                                        columns=CAT_COLUMNS + ['brick_primary'])
+        if len(cats) == 0:
+            continue
+        T = merge_tables(cats)
+        T.key = source_tile_keys(T.ra, T.dec)
+        # bricks overlap several chunks; keep the sources in this one
+        T.cut((T.key >> (2 * (INDEX_ZOOM - CHUNK_ZOOM))) == int(tile_key(cx, cy, CHUNK_ZOOM)))
+        if len(T) == 0:
+            continue
+        minzoom = assign_min_zoom(T.key, source_brightness(T), maxper,
+                                  CHUNK_ZOOM, FULL_ZOOM)
+        write_level(os.path.join(tmpdir, chunk_name(cx, cy)), T, minzoom,
+                    CHUNK_ZOOM, FULL_ZOOM)
+        nsources += len(T)
+        top.append(T[np.flatnonzero(minzoom == CHUNK_ZOOM)])
+
+    # Only the sources shown at CHUNK_ZOOM can be shown at lower zooms.
+    if len(top):
+        T = merge_tables(top)
+    else:
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        for col in CAT_COLUMNS + ['key']:
+            T.set(col, np.zeros(0, np.int64))
+    minzoom = assign_min_zoom(T.key, source_brightness(T), maxper, 0, CHUNK_ZOOM)
+    I = np.flatnonzero(minzoom < CHUNK_ZOOM)
+    write_level(os.path.join(tmpdir, 'top'), T[I], minzoom[I], 0, CHUNK_ZOOM-1)
+
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump(dict(layer=layer.name, maxper=maxper, full_zoom=FULL_ZOOM,
+                       chunk_zoom=CHUNK_ZOOM, index_zoom=INDEX_ZOOM), f)
+    os.chmod(tmpdir, 0o755)
+    # Swap it in; processes still using an old version keep their mmaps.
+    old = None
+    if os.path.exists(dirnm):
+        old = tempfile.mkdtemp(dir=parent, suffix='.old')
+        os.rename(dirnm, os.path.join(old, 'pyramid'))
+    os.rename(tmpdir, dirnm)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    print('Wrote catalog pyramid', dirnm, 'for layer', layer.name, ':', nsources,
+          'sources,', len(I), 'shown below zoom', CHUNK_ZOOM)
+
+if __name__ == '__main__':
+    import sys
+    from map.views import get_layer
+    for name in sys.argv[1:]:
+        layer = get_layer(name)
+        if layer is None:
+            print('No such layer:', name)
+            continue
+        build_catalog_pyramid(layer)
@@ -150,7 +150,7 @@ def cat_photoz_dr9(req, ver):
     '''
     import numpy as np
     import json
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from map.filecache import kdtree_search_radec, read_table
     from astrometry.util.fits import fits_table, merge_tables
     from astrometry.util.starutil_numpy import radectolb
     tag = 'photoz-dr9'
@@ -190,12 +190,11 @@ def cat_photoz_dr9(req, ver):
                 if not os.path.exists(fn):
                     print('No such file:', fn)
                     continue
-                kd = tree_open(fn)
-                I = tree_search_radec(kd, rc, dc, rad)
+                I = kdtree_search_radec(fn, rc, dc, rad)
                 print('Matched', len(I), 'from', fn)
                 if len(I) == 0:
                     continue
-                T = fits_table(fn, rows=I)
+                T = read_table(fn, rows=I, columns=['ra', 'dec', 'z_phot_mean', 'z_phot_std'])
                 ll,bb = radectolb(T.ra, T.dec)
                 ngc = (bb > 0.)
                 if hemi == 'north':
@@ -232,7 +231,9 @@ def cat_phat_clusters(req, ver):
     if not ver in catversions[tag]:
         raise RuntimeError('Invalid version %i for tag %s' % (ver, tag))
 
-    cat = fits_table(os.path.join(settings.DATA_DIR, 'phat-clusters.fits'))
+    from map.catstore import query_catalog
+    cat = query_catalog(os.path.join(settings.DATA_DIR, 'phat-clusters.fits'),
+                        ralo, rahi, declo, dechi)
     cat.cut((cat.ra  >= ralo ) * (cat.ra  <= rahi) *
             (cat.dec >= declo) * (cat.dec <= dechi))
 
@@ -287,21 +288,21 @@ def cat_gaia_dr2(req, ver, catdir=None, prefix=None, indexing=None):
         val[np.logical_not(np.isfinite(val))] = 0.
         cat.set(c, val)
 
-    return HttpResponse(json.dumps(dict(
-        rd=[(float(o.ra),float(o.dec)) for o in cat],
-        sourceid=[str(o.source_id) for o in cat],
-        gmag=[float(o.phot_g_mean_mag) for o in cat],
-        bpmag=[float(o.phot_bp_mean_mag) for o in cat],
-        rpmag=[float(o.phot_rp_mean_mag) for o in cat],
-        pmra=[float(o.pmra) for o in cat],
-        pmdec=[float(o.pmdec) for o in cat],
-        parallax=[float(o.parallax) for o in cat],
-        pmra_err=[float(o.pmra_error) for o in cat],
-        pmdec_err=[float(o.pmdec_error) for o in cat],
-        parallax_err=[float(o.parallax_error) for o in cat],
-        astrometric_excess_noise=[float(o.astrometric_excess_noise) for o in cat],
-    )),
-                        content_type='application/json')
+    from map.catformat import radec_column, catalog_response
+    return catalog_response(req, dict(
+        rd=radec_column(cat.ra, cat.dec),
+        sourceid=[str(i) for i in cat.source_id.tolist()],
+        gmag=cat.phot_g_mean_mag.astype(float),
+        bpmag=cat.phot_bp_mean_mag.astype(float),
+        rpmag=cat.phot_rp_mean_mag.astype(float),
+        pmra=cat.pmra.astype(float),
+        pmdec=cat.pmdec.astype(float),
+        parallax=cat.parallax.astype(float),
+        pmra_err=cat.pmra_error.astype(float),
+        pmdec_err=cat.pmdec_error.astype(float),
+        parallax_err=cat.parallax_error.astype(float),
+        astrometric_excess_noise=cat.astrometric_excess_noise.astype(float),
+    ))
 
 
 def cat_sdss(req, ver):
@@ -678,7 +679,7 @@ def cat_targets_healpixed(req, ver, tag, catpat, name_func=None, colprefix='', n
     if not ver in catversions[tag]:
         raise RuntimeError('Invalid version %i for tag %s' % (ver, tag))
     from astrometry.util.fits import fits_table, merge_tables
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from map.filecache import kdtree_search_radec, read_table
     from astrometry.util.util import healpix_rangesearch_radec, healpix_xy_to_nested, healpix_side_length_arcmin, healpix_rangesearch_radec_approx
     import numpy as np
     # hackily bump up the healpix search radius...
@@ -705,12 +706,11 @@ def cat_targets_healpixed(req, ver, tag, catpat, name_func=None, colprefix='', n
         if not os.path.exists(fn):
             print('No such file:', fn)
             continue
-        kd = tree_open(fn)
-        I = tree_search_radec(kd, rc, dc, rad)
+        I = kdtree_search_radec(fn, rc, dc, rad)
         print('Matched', len(I), 'from', fn)
         if len(I) == 0:
             continue
-        T = fits_table(fn, rows=I)
+        T = read_table(fn, rows=I, columns=target_columns(colprefix))
         TT.append(T)
     if len(TT) == 0:
         return HttpResponse(json.dumps(dict(rd=[], name=[])),
@@ -767,201 +767,208 @@ def cat_targets_dr9_sv1_supp(req, ver):
 # /global/cscratch1/sd/adamyers/dr9/0.47.0.dev4352/targets/sv1/resolve/bright/
 # /global/cscratch1/sd/adamyers/gaiadr2/0.47.0.dev4352/targets/sv1/resolve/supp/
 
+def target_columns(colprefix=''):
+    '''Columns of DESI target catalogs used by the cat_targets_* and cat_desi_tile endpoints.'''
+    return (['ra', 'dec', 'targetid', 'objtype', 'cmx_target', 'desi_target'] +
+            [colprefix + c for c in ['desi_target', 'bgs_target', 'mws_target',
+                                     'scnd_target']])
+
+def decode_unique(cols, func):
+    '''
+    Returns [func(*vals) for vals in zip(*cols)], but only calls *func*
+    once for each distinct combination of values -- catalogs have many
+    objects but few distinct target bitmasks.
+    '''
+    import numpy as np
+    if len(cols) == 0 or len(cols[0]) == 0:
+        return []
+    # per-column unique values, then unique combinations of their indices
+    uniqs = []
+    codes = []
+    for c in cols:
+        u,inv = np.unique(np.asarray(c), return_inverse=True)
+        uniqs.append(u)
+        codes.append(inv.ravel())
+    combos,inv = np.unique(np.vstack(codes).T, axis=0, return_inverse=True)
+    results = [func(*[u[i] for u,i in zip(uniqs, combo)]) for combo in combos]
+    return [results[i] for i in inv.ravel()]
+
+def target_bit_names(val, bitnames):
+    '''Names (from dict *bitnames*) of the bits set in integer *val*.'''
+    return [bitnames[bit] for bit in range(64)
+            if ((1 << bit) & val) and bit in bitnames]
+
+# https://github.com/desihub/desitarget/blob/master/py/desitarget/cmx/data/cmx_targetmask.yaml
+cmx_bitnames = {
+    0:  'STD_GAIA',
+    1:  'SV0_STD_FAINT',
+    2:  'SV0_STD_BRIGHT',
+    3:  'STD_TEST',
+    4:  'STD_CALSPEC',
+    5:  'STD_DITHER',
+    6:  'SV0_MWS_CLUSTER',
+    7:  'SV0_MWS_CLUSTER_VERYBRIGHT',
+    8:  'SV0_BGS',
+    9:  'SV0_MWS',
+    10: 'SV0_LRG',
+    11: 'SV0_ELG',
+    12: 'SV0_QSO',
+    13: 'SV0_WD',
+    14: 'SV0_QSO_Z5',
+    15: 'BACKUP_BRIGHT',
+    16: 'BACKUP_FAINT',
+    18: 'M31_STD_BRIGHT',
+    19: 'M31_H2PN',      
+    20: 'M31_GC',        
+    21: 'M31_QSO',       
+    22: 'M31_VAR',       
+    23: 'M31_BSPL',      
+    24: 'M31_M31cen',    
+    25: 'M31_M31out',    
+    26: 'ORI_STD_BRIGHT',
+    27: 'ORI_QSO',       
+    28: 'ORI_ORI',       
+    29: 'ORI_HA',        
+    30: 'ROS_STD_BRIGHT',
+    31: 'ROS_QSO',       
+    38: 'ROS_ROSM17',    
+    39: 'ROS_ROS1',      
+    40: 'ROS_HA',        
+    41: 'ROS_ROS2',      
+    42: 'M33_STD_BRIGHT',
+    43: 'M33_H2PN',      
+    44: 'M33_GC',        
+    45: 'M33_QSO',       
+    46: 'M33_M33cen',    
+    47: 'M33_M33out',    
+    53: 'MINI_SV_LRG',       
+    54: 'MINI_SV_ELG',       
+    55: 'MINI_SV_QSO',       
+    56: 'MINI_SV_BGS_BRIGHT',
+    57: 'SV0_MWS_FAINT',     
+    58: 'STD_DITHER_GAIA',   
+    32: 'SKY',
+    33: 'STD_FAINT',
+    35: 'STD_BRIGHT',
+    36: 'BAD_SKY',
+    37: 'SUPP_SKY',
+}
+
 def desitarget_cmx_names(T):
-    names = []
-    colors = []
-    for t in T:
-        cmxbits = []
-        cmx_target = int(t.cmx_target)
-        obj = t.objtype
-        for bit in range(64):
-            if (1 << bit) & cmx_target:
-                cmxbits.append(bit)
-            # https://github.com/desihub/desitarget/blob/master/py/desitarget/cmx/data/cmx_targetmask.yaml
-            cmxnames = [{
-                0:  'STD_GAIA',
-                1:  'SV0_STD_FAINT',
-                2:  'SV0_STD_BRIGHT',
-                3:  'STD_TEST',
-                4:  'STD_CALSPEC',
-                5:  'STD_DITHER',
-                6:  'SV0_MWS_CLUSTER',
-                7:  'SV0_MWS_CLUSTER_VERYBRIGHT',
-                8:  'SV0_BGS',
-                9:  'SV0_MWS',
-                10: 'SV0_LRG',
-                11: 'SV0_ELG',
-                12: 'SV0_QSO',
-                13: 'SV0_WD',
-                14: 'SV0_QSO_Z5',
-                15: 'BACKUP_BRIGHT',
-                16: 'BACKUP_FAINT',
-                18: 'M31_STD_BRIGHT',
-                19: 'M31_H2PN',      
-                20: 'M31_GC',        
-                21: 'M31_QSO',       
-                22: 'M31_VAR',       
-                23: 'M31_BSPL',      
-                24: 'M31_M31cen',    
-                25: 'M31_M31out',    
-                26: 'ORI_STD_BRIGHT',
-                27: 'ORI_QSO',       
-                28: 'ORI_ORI',       
-                29: 'ORI_HA',        
-                30: 'ROS_STD_BRIGHT',
-                31: 'ROS_QSO',       
-                38: 'ROS_ROSM17',    
-                39: 'ROS_ROS1',      
-                40: 'ROS_HA',        
-                41: 'ROS_ROS2',      
-                42: 'M33_STD_BRIGHT',
-                43: 'M33_H2PN',      
-                44: 'M33_GC',        
-                45: 'M33_QSO',       
-                46: 'M33_M33cen',    
-                47: 'M33_M33out',    
-                53: 'MINI_SV_LRG',       
-                54: 'MINI_SV_ELG',       
-                55: 'MINI_SV_QSO',       
-                56: 'MINI_SV_BGS_BRIGHT',
-                57: 'SV0_MWS_FAINT',     
-                58: 'STD_DITHER_GAIA',   
-                32: 'SKY',
-                33: 'STD_FAINT',
-                35: 'STD_BRIGHT',
-                36: 'BAD_SKY',
-                37: 'SUPP_SKY',
-            }.get(b) for b in cmxbits]
-        bitnames = [n for n in cmxnames if n is not None]
+    def cmx_names(cmx_target, obj):
+        bitnames = target_bit_names(int(cmx_target), cmx_bitnames)
         if obj == 'SKY':
             bitnames.append('SKY')
         if obj == 'BAD':
             bitnames.append('BAD')
-        names.append(', '.join(bitnames))
-    return names
+        return ', '.join(bitnames)
+    return decode_unique([T.cmx_target, T.objtype], cmx_names)
 
-def get_target_val(t, nm, cols):
+def get_target_col(T, nm, cols):
+    import numpy as np
     if nm in cols:
-        return int(t.get(nm))
-    return 0
+        return T.get(nm)
+    return np.zeros(len(T), int)
+
+# https://github.com/desihub/desitarget/blob/master/py/desitarget/sv1/data/sv1_targetmask.yaml
+sv1_desi_bitnames = {
+    0:  'LRG',
+    1:  'ELG',
+    2:  'QSO',
+    3:  'LRG_OPT',
+    4:  'LRG_IR',
+    5:  'LRG_SV_OPT',
+    6:  'LRG_SV_IR',
+    7:  'LOWZ_FILLER',
+    8:  'ELG_SV_GTOT',
+    9:  'ELG_SV_GFIB',
+    10: 'ELG_FDR_GTOT',
+    11: 'ELG_FDR_GFIB',
+    12: 'QSO_COLOR_4PASS',
+    13: 'QSO_RF_4PASS',
+    14: 'QSO_COLOR_8PASS',
+    15: 'QSO_RF_8PASS',
+    16: 'QSO_HZ_F',
+    17: 'QSO_Z5',
+    # (skip)
+    #- North vs. South selections for different sub-classes
+    #- Calibration targets
+    32: 'SKY',
+    33: 'STD_FAINT',
+    34: 'STD_WD',
+    35: 'STD_BRIGHT',
+    36: 'BAD_SKY',
+    37: 'SUPP_SKY',
+
+    60: 'BGS_ANY',
+    61: 'MWS_ANY',
+    #62: 'SCND_ANY',
+    }
+sv1_bgs_bitnames = {
+    0:  'BGS_FAINT',
+    1:  'BGS_BRIGHT',
+    2:  'BGS_FAINT_EXT',
+    3:  'BGS_LOWQ',
+    4:  'BGS_FIBMAG',
+    #- (skip) BGS North vs. South selections
+    40: 'BGS_KNOWN_ANY',
+    }
+sv1_mws_bitnames = {
+    0:  'MWS_MAIN_BROAD',
+    1:  'MWS_WD',
+    2:  'MWS_NEARBY',
+    #- (skip) 4: MWS_MAIN north/south splits
+    6:  'MWS_BHB',
+    14: 'MWS_MAIN_FAINT',
+    }
+sv1_scnd_bitnames = {
+    0:  'SCND_VETO',
+    1:  'SCND_UDG',
+    2:  'SCND_FIRST_MALS',
+    3:  'SCND_WD_BINARIES',
+    4:  'SCND_LBG_TOMOG',
+    5:  'SCND_QSO_RED',
+    6:  'SCND_M31_KNOWN',
+    7:  'SCND_M31_QSO',
+    8:  'SCND_M31_STAR',
+    10: 'SCND_MWS_CLUS_GAL_DEEP',
+    11: 'SCND_LOW_MASS_AGN',
+    12: 'SCND_FAINT_HPM',
+    13: 'SCND_GW190412',
+    14: 'SCND_IC134191',
+    15: 'SCND_PV_BRIGHT',
+    16: 'SCND_PV_DARK',
+    17: 'SCND_LOW_Z',
+    18: 'SCND_BHB',
+    19: 'SCND_SPCV',
+    20: 'SCND_DC3R2_GAMA',
+    21: 'SCND_UNWISE_BLUE',
+    22: 'SCND_UNWISE_GREEN',
+    23: 'SCND_HETDEX_MAIN',
+    24: 'SCND_HEXDEX_HP',
+    27: 'SCND_HPM_SOUM',
+    28: 'SCND_SN_HOSTS',
+    29: 'SCND_GAL_CLUS_BCG',
+    30: 'SCND_GAL_CLUS_2ND',
+    31: 'SCND_GAL_CLUS_SAT',
+    32: 'SCND_HSC_HIZ_SNE',
+    33: 'SCND_ISM_CGM_QGP',
+    34: 'SCND_STRONG_LENS',
+    35: 'SCND_WISE_VAR_QSO',
+    36: 'SCND_MWS_CALIB',
+    37: 'SCND_BACKUP_CALIB',
+    38: 'SCND_MWS_MAIN_CLUSTER_SV',
+    39: 'SCND_MWS_RRLYR',
+    }
 
 def desitarget_sv1_names(T, colprefix='sv1_'):
-    names = []
-    colors = []
     cols = T.get_columns()
-    for t in T:
-        desibits = []
-        bgsbits = []
-        mwsbits = []
-        secbits = []
-        desi_target = int(t.get(colprefix + 'desi_target'))
-        bgs_target = get_target_val(t, colprefix + 'bgs_target', cols)
-        mws_target = get_target_val(t, colprefix + 'mws_target', cols)
-        sec_target = get_target_val(t, colprefix + 'scnd_target', cols)
-        if 'objtype' in cols:
-            obj = t.objtype
-        else:
-            obj = ''
-        for bit in range(64):
-            if (1 << bit) & desi_target:
-                desibits.append(bit)
-            if (1 << bit) & bgs_target:
-                bgsbits.append(bit)
-            if (1 << bit) & mws_target:
-                mwsbits.append(bit)
-            if (1 << bit) & sec_target:
-                secbits.append(bit)
-        # https://github.com/desihub/desitarget/blob/master/py/desitarget/sv1/data/sv1_targetmask.yaml
-        desinames = [{
-            0:  'LRG',
-            1:  'ELG',
-            2:  'QSO',
-            3:  'LRG_OPT',
-            4:  'LRG_IR',
-            5:  'LRG_SV_OPT',
-            6:  'LRG_SV_IR',
-            7:  'LOWZ_FILLER',
-            8:  'ELG_SV_GTOT',
-            9:  'ELG_SV_GFIB',
-            10: 'ELG_FDR_GTOT',
-            11: 'ELG_FDR_GFIB',
-            12: 'QSO_COLOR_4PASS',
-            13: 'QSO_RF_4PASS',
-            14: 'QSO_COLOR_8PASS',
-            15: 'QSO_RF_8PASS',
-            16: 'QSO_HZ_F',
-            17: 'QSO_Z5',
-            # (skip)
-            #- North vs. South selections for different sub-classes
-            #- Calibration targets
-            32: 'SKY',
-            33: 'STD_FAINT',
-            34: 'STD_WD',
-            35: 'STD_BRIGHT',
-            36: 'BAD_SKY',
-            37: 'SUPP_SKY',
-
-            60: 'BGS_ANY',
-            61: 'MWS_ANY',
-            #62: 'SCND_ANY',
-            }.get(b) for b in desibits]
-        bgsnames = [{
-            0:  'BGS_FAINT',
-            1:  'BGS_BRIGHT',
-            2:  'BGS_FAINT_EXT',
-            3:  'BGS_LOWQ',
-            4:  'BGS_FIBMAG',
-            #- (skip) BGS North vs. South selections
-            40: 'BGS_KNOWN_ANY',
-            }.get(b) for b in bgsbits]
-        mwsnames = [{
-            0:  'MWS_MAIN_BROAD',
-            1:  'MWS_WD',
-            2:  'MWS_NEARBY',
-            #- (skip) 4: MWS_MAIN north/south splits
-            6:  'MWS_BHB',
-            14: 'MWS_MAIN_FAINT',
-            }.get(b) for b in mwsbits]
-        secondarynames = [{
-            0:  'SCND_VETO',
-            1:  'SCND_UDG',
-            2:  'SCND_FIRST_MALS',
-            3:  'SCND_WD_BINARIES',
-            4:  'SCND_LBG_TOMOG',
-            5:  'SCND_QSO_RED',
-            6:  'SCND_M31_KNOWN',
-            7:  'SCND_M31_QSO',
-            8:  'SCND_M31_STAR',
-            10: 'SCND_MWS_CLUS_GAL_DEEP',
-            11: 'SCND_LOW_MASS_AGN',
-            12: 'SCND_FAINT_HPM',
-            13: 'SCND_GW190412',
-            14: 'SCND_IC134191',
-            15: 'SCND_PV_BRIGHT',
-            16: 'SCND_PV_DARK',
-            17: 'SCND_LOW_Z',
-            18: 'SCND_BHB',
-            19: 'SCND_SPCV',
-            20: 'SCND_DC3R2_GAMA',
-            21: 'SCND_UNWISE_BLUE',
-            22: 'SCND_UNWISE_GREEN',
-            23: 'SCND_HETDEX_MAIN',
-            24: 'SCND_HEXDEX_HP',
-            27: 'SCND_HPM_SOUM',
-            28: 'SCND_SN_HOSTS',
-            29: 'SCND_GAL_CLUS_BCG',
-            30: 'SCND_GAL_CLUS_2ND',
-            31: 'SCND_GAL_CLUS_SAT',
-            32: 'SCND_HSC_HIZ_SNE',
-            33: 'SCND_ISM_CGM_QGP',
-            34: 'SCND_STRONG_LENS',
-            35: 'SCND_WISE_VAR_QSO',
-            36: 'SCND_MWS_CALIB',
-            37: 'SCND_BACKUP_CALIB',
-            38: 'SCND_MWS_MAIN_CLUSTER_SV',
-            39: 'SCND_MWS_RRLYR',
-            }.get(b) for b in secbits]
-        bitnames = [n for n in desinames + bgsnames + mwsnames + secondarynames if n is not None]
+    def sv1_names(desi_target, bgs_target, mws_target, sec_target, obj):
+        desi_target = int(desi_target)
+        bitnames = (target_bit_names(desi_target, sv1_desi_bitnames) +
+                    target_bit_names(int(bgs_target), sv1_bgs_bitnames) +
+                    target_bit_names(int(mws_target), sv1_mws_bitnames) +
+                    target_bit_names(int(sec_target), sv1_scnd_bitnames))
         if obj == 'SKY':
             bitnames.append('SKY')
         if obj == 'BAD':
@@ -969,107 +976,89 @@ def desitarget_sv1_names(T, colprefix='sv1_'):
 
         if len(bitnames) == 0:
             bitnames.append('0x%x' % desi_target)
-        names.append(', '.join(bitnames))
-        # cc = 'white'
-        # if 'QSO' in nn:
-        #     cc = 'cyan'
-        # elif 'LRG' in nn:
-        #     cc = 'red'
-        # elif 'ELG' in nn:
-        #     cc = 'gray'
-        # elif 'BGS' in nn:
-        #     cc = 'orange'
-        # colors.append(cc)
-    return names #, colors
-
+        return ', '.join(bitnames)
+    if 'objtype' in cols:
+        obj = T.objtype
+    else:
+        obj = [''] * len(T)
+    return decode_unique([T.get(colprefix + 'desi_target'),
+                          get_target_col(T, colprefix + 'bgs_target', cols),
+                          get_target_col(T, colprefix + 'mws_target', cols),
+                          get_target_col(T, colprefix + 'scnd_target', cols),
+                          obj], sv1_names)
+
+# https://github.com/desihub/desitarget/blob/master/py/desitarget/data/targetmask.yaml
+desi_bitnames = {
+    0:  'LRG',
+    1:  'ELG',
+    2:  'QSO',
+    8:  'LRG_NORTH',
+    9:  'ELG_NORTH',
+    10: 'QSO_NORTH',
+    16: 'LRG_SOUTH',
+    17: 'ELG_SOUTH',
+    18: 'QSO_SOUTH',
+    32: 'SKY',
+    33: 'STD_FSTAR',
+    34: 'STD_WD',
+    35: 'STD_BRIGHT',
+    36: 'BADSKY',
+    50: 'BRIGHT_OBJECT',
+    51: 'IN_BRIGHT_OBJECT',
+    52: 'NEAR_BRIGHT_OBJECT',
+    60: 'BGS_ANY',
+    61: 'MWS_ANY',
+    62: 'ANCILLARY_ANY',
+}
+bgs_bitnames = {
+    0:  'BGS_FAINT',
+    1:  'BGS_BRIGHT',
+    8:  'BGS_FAINT_NORTH',
+    9:  'BGS_BRIGHT_NORTH',
+    16: 'BGS_FAINT_SOUTH',
+    17: 'BGS_BRIGHT_SOUTH',
+    40: 'BGS_KNOWN_ANY',
+    41: 'BGS_KNOWN_COLLIDED',
+    42: 'BGS_KNOWN_SDSS',
+    43: 'BGS_KNOWN_BOSS',
+}
+mws_bitnames = {
+    0:  'MWS_MAIN',
+    1:  'MWS_WD',
+    2:  'MWS_NEARBY',
+    16: 'MWS_MAIN_VERY_FAINT',
+}
+# If any of the names in value exists, remove the key in bitnames
+# Example: if 'ELG' exists, remove 'ELG_SOUTH' and 'ELG_NORTH'
+bitnames_veto = {
+    'ELG_SOUTH': ['ELG'],
+    'ELG_NORTH': ['ELG'],
+    'QSO_SOUTH': ['QSO'],
+    'QSO_NORTH': ['QSO'],
+    'LRG_NORTH': ['LRG'],
+    'LRG_SOUTH': ['LRG'],
+    'BGS_FAINT_NORTH': ['BGS_FAINT'],
+    'BGS_FAINT_SOUTH': ['BGS_FAINT'],
+    'BGS_BRIGHT_NORTH': ['BGS_BRIGHT'],
+    'BGS_BRIGHT_SOUTH': ['BGS_BRIGHT'],
+    'BGS_ANY': ['BGS_FAINT', 'BGS_BRIGHT', 'BGS_FAINT_NORTH',
+                'BGS_BRIGHT_NORTH', 'BGS_FAINT_SOUTH', 'BGS_BRIGHT_SOUTH',
+                'BGS_KNOWN_ANY', 'BGS_KNOWN_COLLIDED', 'BGS_KNOWN_SDSS',
+                'BGS_KNOWN_BOSS'],
+    'MWS_ANY': ['MWS_MAIN', 'MWS_WD', 'MWS_NEARBY', 'MWS_MAIN_VERY_FAINT'],
+}
 
 def desitarget_color_names(T, colprefix=''):
-    names = []
-    colors = []
-    for t in T:
-        desibits = []
-        bgsbits = []
-        mwsbits = []
-        desi_target = int(t.get(colprefix + 'desi_target'))
-        bgs_target = int(t.get(colprefix + 'bgs_target'))
-        mws_target = int(t.get(colprefix + 'mws_target'))
-        for bit in range(64):
-            if (1 << bit) & desi_target:
-                desibits.append(bit)
-            if (1 << bit) & bgs_target:
-                bgsbits.append(bit)
-            if (1 << bit) & mws_target:
-                mwsbits.append(bit)
-        # https://github.com/desihub/desitarget/blob/master/py/desitarget/data/targetmask.yaml
-        desinames = [{
-            0:  'LRG',
-            1:  'ELG',
-            2:  'QSO',
-            8:  'LRG_NORTH',
-            9:  'ELG_NORTH',
-            10: 'QSO_NORTH',
-            16: 'LRG_SOUTH',
-            17: 'ELG_SOUTH',
-            18: 'QSO_SOUTH',
-            32: 'SKY',
-            33: 'STD_FSTAR',
-            34: 'STD_WD',
-            35: 'STD_BRIGHT',
-            36: 'BADSKY',
-            50: 'BRIGHT_OBJECT',
-            51: 'IN_BRIGHT_OBJECT',
-            52: 'NEAR_BRIGHT_OBJECT',
-            60: 'BGS_ANY',
-            61: 'MWS_ANY',
-            62: 'ANCILLARY_ANY',
-        }.get(b) for b in desibits]
-        bgsnames = [{
-            0:  'BGS_FAINT',
-            1:  'BGS_BRIGHT',
-            8:  'BGS_FAINT_NORTH',
-            9:  'BGS_BRIGHT_NORTH',
-            16: 'BGS_FAINT_SOUTH',
-            17: 'BGS_BRIGHT_SOUTH',
-            40: 'BGS_KNOWN_ANY',
-            41: 'BGS_KNOWN_COLLIDED',
-            42: 'BGS_KNOWN_SDSS',
-            43: 'BGS_KNOWN_BOSS',
-        }.get(b) for b in bgsbits]
-        mwsnames = [{
-            0:  'MWS_MAIN',
-            1:  'MWS_WD',
-            2:  'MWS_NEARBY',
-            16: 'MWS_MAIN_VERY_FAINT',
-        }.get(b) for b in mwsbits]
-
-        bitnames = [n for n in desinames + bgsnames + mwsnames if n is not None]
-        # If any of the names in value exists, remove the key in bitnames
-        # Example: if 'ELG' exists, remove 'ELG_SOUTH' and 'ELG_NORTH'
-        bitnames_veto = {
-            'ELG_SOUTH': ['ELG'],
-            'ELG_NORTH': ['ELG'],
-            'QSO_SOUTH': ['QSO'],
-            'QSO_NORTH': ['QSO'],
-            'LRG_NORTH': ['LRG'],
-            'LRG_SOUTH': ['LRG'],
-            'BGS_FAINT_NORTH': ['BGS_FAINT'],
-            'BGS_FAINT_SOUTH': ['BGS_FAINT'],
-            'BGS_BRIGHT_NORTH': ['BGS_BRIGHT'],
-            'BGS_BRIGHT_SOUTH': ['BGS_BRIGHT'],
-            'BGS_ANY': ['BGS_FAINT', 'BGS_BRIGHT', 'BGS_FAINT_NORTH',
-                        'BGS_BRIGHT_NORTH', 'BGS_FAINT_SOUTH', 'BGS_BRIGHT_SOUTH',
-                        'BGS_KNOWN_ANY', 'BGS_KNOWN_COLLIDED', 'BGS_KNOWN_SDSS',
-                        'BGS_KNOWN_BOSS'],
-            'MWS_ANY': ['MWS_MAIN', 'MWS_WD', 'MWS_NEARBY', 'MWS_MAIN_VERY_FAINT'],
-        }
+    def color_names(desi_target, bgs_target, mws_target):
+        bitnames = (target_bit_names(int(desi_target), desi_bitnames) +
+                    target_bit_names(int(bgs_target), bgs_bitnames) +
+                    target_bit_names(int(mws_target), mws_bitnames))
         for name in bitnames[:]:
             # As described in the comment above, if any of the better_names
             # exist in bitnames, remove the current name
             if any([better_name in bitnames for better_name in bitnames_veto.get(name, [])]):
                 bitnames.remove(name)
 
-        names.append(', '.join(bitnames))
-
         nn = ' '.join(bitnames)
         cc = 'white'
         if 'QSO' in nn:
@@ -1080,13 +1069,16 @@ def desitarget_color_names(T, colprefix=''):
             cc = 'gray'
         elif 'BGS' in nn:
             cc = 'orange'
-        colors.append(cc)
+        return ', '.join(bitnames), cc
+    nc = decode_unique([T.get(colprefix + 'desi_target'),
+                        T.get(colprefix + 'bgs_target'),
+                        T.get(colprefix + 'mws_target')], color_names)
+    names = [n for n,c in nc]
+    colors = [c for n,c in nc]
     return names, colors
 
 def desi_cmx_color_names(T, colprefix=None):
-    names = []
-    colors = []
-    for bits in T.cmx_target:
+    def cmx_color_names(bits):
         bitnames = []
         for bitval,name in [(0x1, 'STD_GAIA'),
                             (0x2, 'SV0_STD_BRIGHT'),
@@ -1098,7 +1090,6 @@ def desi_cmx_color_names(T, colprefix=None):
                 bitnames.append(name)
 
         nn = ' '.join(bitnames)
-        names.append(nn)
 
         cc = 'white'
         if 'BGS' in nn:
@@ -1109,8 +1100,10 @@ def desi_cmx_color_names(T, colprefix=None):
             cc = 'gray'
         else:
             cc = 'white'
-        colors.append(cc)
-
+        return nn, cc
+    nc = decode_unique([T.cmx_target], cmx_color_names)
+    names = [n for n,c in nc]
+    colors = [c for n,c in nc]
     return names, colors
 
 def cat_targets_drAB(req, ver, cats=None, tag='', bgs=False, sky=False, bright=False, dark=False, color_name_func=desitarget_color_names, colprefix='', name_func=None):
@@ -1132,22 +1125,28 @@ def cat_targets_drAB(req, ver, cats=None, tag='', bgs=False, sky=False, bright=F
         raise RuntimeError('Invalid version %i for tag %s' % (ver, tag))
 
     from astrometry.util.fits import fits_table, merge_tables
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from map.filecache import kdtree_search_radec, read_table
     import numpy as np
 
     rc,dc,rad = radecbox_to_circle(ralo, rahi, declo, dechi)
 
+    columns = target_columns(colprefix)
+    if sky:
+        columns += ['apflux_%s' % b for b in 'grz']
+    else:
+        columns += (['flux_%s' % b for b in ['g', 'r', 'z', 'w1', 'w2']] +
+                    ['nobs_%s' % b for b in 'grz'])
+
     '''
     startree -i /project/projectdirs/desi/target/catalogs/targets-dr4-0.20.0.fits -o data/targets-dr4-0.20.0.kd.fits -P -k -T
     '''
     TT = []
     for fn in cats:
-        kd = tree_open(fn)
-        I = tree_search_radec(kd, rc, dc, rad)
+        I = kdtree_search_radec(fn, rc, dc, rad)
         print('Matched', len(I), 'from', fn)
         if len(I) == 0:
             continue
-        T = fits_table(fn, rows=I)
+        T = read_table(fn, rows=I, columns=columns)
         TT.append(T)
     if len(TT) == 0:
         return HttpResponse(json.dumps(dict(rd=[], name=[])),
@@ -1174,23 +1173,22 @@ def cat_targets_drAB(req, ver, cats=None, tag='', bgs=False, sky=False, bright=F
     if name_func is not None:
         names = name_func(T, colprefix=colprefix)
 
-    rtn = dict(rd=[(t.ra, t.dec) for t in T],
-               targetid=[int(t) for t in T.targetid])
+    from map.catformat import Records, radec_column, catalog_response
+    # Convert targetid to string to prevent rounding errors
+    rtn = dict(rd=radec_column(T.ra, T.dec),
+               targetid=[str(t) for t in T.targetid.tolist()])
 
     fluxes = None
     nobs = None
     if sky:
-        fluxes = [dict(g=float(g), r=float(r), z=float(z))
-                  for (g,r,z) in zip(T.apflux_g[:,0], T.apflux_r[:,0], T.apflux_z[:,0])]
+        fluxes = Records([(b, T.get('apflux_%s' % b)[:,0].astype(float))
+                          for b in 'grz'])
     else:
         if 'flux_g' in T.get_columns():
-            fluxes = [dict(g=float(g), r=float(r), z=float(z),
-                           W1=float(W1), W2=float(W2))
-                      for (g,r,z,W1,W2)
-                      in zip(T.flux_g, T.flux_r, T.flux_z, T.flux_w1, T.flux_w2)]
+            fluxes = Records([(b, T.get('flux_%s' % b.lower()).astype(float))
+                              for b in ['g', 'r', 'z', 'W1', 'W2']])
         if 'nobs_g' in T.get_columns():
-            nobs=[dict(g=int(g), r=int(r), z=int(z)) for g,r,z
-                  in zip(T.nobs_g, T.nobs_r, T.nobs_z)],
+            nobs = Records([(b, T.get('nobs_%s' % b)) for b in 'grz'])
 
     if names is not None:
         rtn.update(name=names)
@@ -1200,10 +1198,7 @@ def cat_targets_drAB(req, ver, cats=None, tag='', bgs=False, sky=False, bright=F
         rtn.update(nobs=nobs)
     if fluxes is not None:
         rtn.update(fluxes=fluxes)
-    # Convert targetid to string to prevent rounding errors
-    rtn['targetid'] = [str(s) for s in rtn['targetid']]
-    
-    return HttpResponse(json.dumps(rtn), content_type='application/json')
+    return catalog_response(req, rtn)
 
 def cat_sga_parent(req, ver):
     fn = os.path.join(settings.DATA_DIR, 'sga', 'SGA-parent-v3.0.kd.fits')
@@ -1245,41 +1240,46 @@ def _cat_sga(req, ver, ellipse=False, fn=None, tag='sga', sga=False):
 
     T.cut(np.argsort(-T.radius_arcsec))
 
-    rd = list((float(r),float(d)) for r,d in zip(T.ra, T.dec))
+    from map.catformat import radec_column, catalog_response
+    rd = radec_column(T.ra, T.dec)
     names = [t.strip() for t in T.galaxy]
-    pgc = [int(p) for p in T.pgc]
+    pgc = T.pgc
     typ = [t.strip() if t != 'nan' else '' for t in T.get('morphtype')]
 
-    radius = [float(r) for r in T.radius_arcsec.astype(np.float32)]
-    ab = [float(f) for f in T.ba.astype(np.float32)]
+    radius = T.radius_arcsec.astype(np.float32)
+    ab = T.ba.astype(np.float32)
 
     pax = T.pa.copy().astype(np.float32)
     pax[np.logical_not(np.isfinite(pax))] = 0.
     pax[pax < 0] += 180.
     pax[pax >= 180.] -= 180.
 
-    pa = [float(90.-f) for f in pax]
-    pa_disp = [float(f) for f in pax]
+    pa = 90. - pax.astype(np.float64)
+    pa_disp = pax
     if ellipse:
         color = ['#377eb8']*len(T)
         #'#ff3333'
     else:
         color = ['#e41a1c']*len(T)
         #'#3388ff'
-    z = [float(z) if np.isfinite(z) else -1. for z in T.z_leda.astype(np.float32)]
+    z = T.z_leda.astype(np.float32).astype(np.float64)
+    z[np.logical_not(np.isfinite(z))] = -1.
     groupnames = [t.strip() for t in T.group_name]
 
-    return HttpResponse(json.dumps(dict(rd=rd, name=names, radiusArcsec=radius,
-                                        groupname=groupnames,
-                                        abRatio=ab, posAngle=pa, pgc=pgc, type=typ,
-                                        redshift=z, color=color, posAngleDisplay=pa_disp)),
-                        content_type='application/json')
+    return catalog_response(req, dict(rd=rd, name=names, radiusArcsec=radius,
+                                      groupname=groupnames,
+                                      abRatio=ab, posAngle=pa, pgc=pgc, type=typ,
+                                      redshift=z, color=color, posAngleDisplay=pa_disp))
+
+# SGA columns used by _cat_sga and query_sga_radecbox
+sga_columns = ['ra', 'dec', 'diam', 'sga_id', 'id', 'preburned', 'galaxy', 'pgc',
+               'morphtype', 'ba', 'pa', 'z_leda', 'group_name']
 
 def query_sga_radecbox(fn, ralo, rahi, declo, dechi):
     ra,dec,radius = radecbox_to_circle(ralo, rahi, declo, dechi)
     # max radius for SGA entries?!
     sga_radius = 2.0
-    T = cat_query_radec(fn, ra, dec, radius + sga_radius)
+    T = cat_query_radec(fn, ra, dec, radius + sga_radius, columns=sga_columns)
     if T is None:
         return None
     wcs = radecbox_to_wcs(ralo, rahi, declo, dechi)
@@ -1302,7 +1302,8 @@ def cat_manga(req, ver):
     #     -P -T -k -R ifura -D ifudec
     fn = os.path.join(settings.DATA_DIR, 'manga', 'drpall-v2_4_3.kd.fits')
     tag = 'manga'
-    T = cat_kd(req, ver, tag, fn, racol='ifura', deccol='ifudec')
+    T = cat_kd(req, ver, tag, fn, racol='ifura', deccol='ifudec',
+               columns=['nsa_iauname', 'plate', 'ifudsgn', 'z', 'ifudesignsize'])
     if T is None:
         return HttpResponse(json.dumps(dict(rd=[], name=[], mjd=[], fiber=[],plate=[])),
                             content_type='application/json')
@@ -1364,7 +1365,8 @@ def cat_spec(req, ver):
     import json
     fn = os.path.join(settings.DATA_DIR, 'sdss', 'specObj-dr14-trimmed.kd.fits')
     tag = 'spec'
-    T = cat_kd(req, ver, tag, fn)
+    T = cat_kd(req, ver, tag, fn,
+               columns=['plate', 'label', 'mjd', 'fiberid', 'zwarning'])
     if T is None:
         return HttpResponse(json.dumps(dict(rd=[], name=[], mjd=[], fiber=[],
                                             plate=[], zwarning=[])),
@@ -1374,17 +1376,13 @@ def cat_spec(req, ver):
         plate = int(plate, 10)
         T.cut(T.plate == plate)
 
-    rd = list((float(r),float(d)) for r,d in zip(T.ra, T.dec))
+    from map.catformat import radec_column, catalog_response
+    rd = radec_column(T.ra, T.dec)
     names = [t.strip() for t in T.label]
     # HACK
     #names = [t.split()[0] for t in names]
-    mjd   = [int(x) for x in T.mjd]
-    fiber = [int(x) for x in T.fiberid]
-    plate = [int(x) for x in T.plate]
-    zwarning = [int(x) for x in T.zwarning]
-    return HttpResponse(json.dumps(dict(rd=rd, name=names, mjd=mjd, fiber=fiber, plate=plate,
-                                        zwarning=zwarning)),
-                        content_type='application/json')
+    return catalog_response(req, dict(rd=rd, name=names, mjd=T.mjd, fiber=T.fiberid,
+                                      plate=T.plate, zwarning=T.zwarning))
 
 def cat_masks_dr9(req, ver):
     import json
@@ -1514,7 +1512,7 @@ def cat_gaia_mask(req, ver):
     '''
     fn = os.path.join(settings.DATA_DIR, 'gaia-mask.kd.fits')
     tag = 'masks-dr8'
-    T = cat_kd(req, ver, tag, fn)
+    T = cat_kd(req, ver, tag, fn, columns=['phot_g_mean_mag', 'radius', 'isbright'])
     if T is None:
         return HttpResponse(json.dumps(dict(rd=[], name=[], radiusArcsec=[])),
                             content_type='application/json')
@@ -1530,7 +1528,10 @@ def cat_hsc_dr2_cosmos(req, ver):
     import json
     import numpy as np
     fn = os.path.join(settings.DATA_DIR, 'hsc-dr2', 'cosmos-cat.kd.fits')
-    T = cat_kd(req, ver, 'hsc-dr2-cosmos', fn)
+    T = cat_kd(req, ver, 'hsc-dr2-cosmos', fn,
+               columns=(['%s_psfflux_flux' % b for b in 'griz'] +
+                        ['%s_cmodel_flux' % b for b in 'griz'] +
+                        ['i_extendedness_value']))
     if T is None:
         return HttpResponse(json.dumps(dict(rd=[], name=[], color=[])),
                             content_type='application/json')
@@ -1560,7 +1561,7 @@ def cat_hsc_dr2_cosmos(req, ver):
     return HttpResponse(json.dumps(dict(rd=rd, name=names, color=color)),
                         content_type='application/json')
 
-def cat_kd(req, ver, tag, fn, racol=None, deccol=None):
+def cat_kd(req, ver, tag, fn, racol=None, deccol=None, columns=None):
     ralo = float(req.GET['ralo'])
     rahi = float(req.GET['rahi'])
     declo = float(req.GET['declo'])
@@ -1570,7 +1571,9 @@ def cat_kd(req, ver, tag, fn, racol=None, deccol=None):
         raise RuntimeError('Invalid version %i for tag %s' % (ver, tag))
 
     ra,dec,radius = radecbox_to_circle(ralo, rahi, declo, dechi)
-    T = cat_query_radec(fn, ra, dec, radius)
+    if columns is not None:
+        columns = columns + [racol or 'ra', deccol or 'dec']
+    T = cat_query_radec(fn, ra, dec, radius, columns=columns)
     if T is None:
         debug('No objects in query')
         return None
@@ -1619,15 +1622,17 @@ def radecbox_to_circle(ralo, rahi, declo, dechi):
     rad = degrees_between(rc, dc, ralo, declo)
     return rc, dc, rad
     
-def cat_query_radec(kdfn, ra, dec, radius):
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
-    from astrometry.util.fits import fits_table
-    kd = tree_open(kdfn)
-    I = tree_search_radec(kd, ra, dec, radius)
+def cat_query_radec(kdfn, ra, dec, radius, columns=None):
+    '''
+    Returns the objects (only *columns* of them, if given) in kd-tree file
+    *kdfn* within *radius* deg of *ra*,*dec*; None if there are none.
+    '''
+    from map.filecache import kdtree_search_radec, read_table
+    I = kdtree_search_radec(kdfn, ra, dec, radius)
     #print('Matched', len(I), 'from', fn)
     if len(I) == 0:
         return None
-    T = fits_table(kdfn, rows=I)
+    T = read_table(kdfn, rows=I, columns=columns)
     return T
 
 def cat_spec_deep2(req, ver):
@@ -1645,7 +1650,9 @@ def cat_spec_deep2(req, ver):
     import numpy as np
 
     TT = []
-    T = fits_table(os.path.join(settings.DATA_DIR, 'deep2-zcat-dr4-uniq.fits'))
+    from map.catstore import query_catalog
+    T = query_catalog(os.path.join(settings.DATA_DIR, 'deep2-zcat-dr4-uniq.fits'),
+                      ralo, rahi, declo, dechi)
     debug(len(T), 'spectra')
     if ralo > rahi:
         # RA wrap
@@ -1791,7 +1798,9 @@ def cat_desi_tile(req, ver):
     if not os.path.exists(fn):
         print('Does not exist:', fn)
         return
-    cat = fits_table(fn)
+    from map.filecache import read_table
+    cat = read_table(fn, columns=(['target_ra', 'target_dec', 'fiber'] +
+                                  target_columns('sv1_')))
     cat.ra  = cat.target_ra
     cat.dec = cat.target_dec
     
@@ -1832,7 +1841,8 @@ def cat_tycho2(req, ver):
     #return cat(req, ver, 'tycho2',
     #           os.path.join(settings.DATA_DIR, 'tycho2.fits'))
     import json
-    T = cat_kd(req, ver, 'tycho2', os.path.join(settings.DATA_DIR, 'tycho2-sub.kd.fits'))
+    T = cat_kd(req, ver, 'tycho2', os.path.join(settings.DATA_DIR, 'tycho2-sub.kd.fits'),
+               columns=['name'])
     if T is None:
         rtn = dict(rd=[], name=[])
     else:
@@ -1848,9 +1858,13 @@ def cat_ngc(req, ver):
                os.path.join(settings.DATA_DIR, 'ngcic.fits'))
 
 def cat_GCs_PNe(req, ver):
-    from astrometry.util.fits import fits_table
-    import numpy as np
-    T = fits_table(os.path.join(settings.DATA_DIR,'NGC-star-clusters.fits'))
+    from map.catstore import query_catalog
+    ralo = float(req.GET['ralo'])
+    rahi = float(req.GET['rahi'])
+    declo = float(req.GET['declo'])
+    dechi = float(req.GET['dechi'])
+    T = query_catalog(os.path.join(settings.DATA_DIR,'NGC-star-clusters.fits'),
+                      ralo, rahi, declo, dechi)
     #T.alt_name = np.array(['' if n.startswith('N/A') else n.strip() for n in T.commonnames])
     T.posAngle = T.pa
     T.abRatio = T.ba
@@ -1883,8 +1897,9 @@ def cat(req, ver, tag, fn, T=None):
     import numpy as np
 
     if T is None:
-        T = fits_table(fn)
-        debug(len(T), 'catalog objects')
+        from map.catstore import query_catalog
+        T = query_catalog(fn, ralo, rahi, declo, dechi)
+        debug(len(T), 'catalog objects near box')
     if ralo > rahi:
         # RA wrap
         T.cut(np.logical_or(T.ra > ralo, T.ra < rahi) * (T.dec > declo) * (T.dec < dechi))
@@ -1892,8 +1907,8 @@ def cat(req, ver, tag, fn, T=None):
         T.cut((T.ra > ralo) * (T.ra < rahi) * (T.dec > declo) * (T.dec < dechi))
     debug(len(T), 'in cut')
 
-    rd = list((float(r),float(d)) for r,d in zip(T.ra, T.dec))
-    rtn = dict(rd=rd)
+    from map.catformat import radec_column, catalog_response
+    rtn = dict(rd=radec_column(T.ra, T.dec))
 
     # PS1
     if 'ndetections' in T.columns():
@@ -1913,13 +1928,13 @@ def cat(req, ver, tag, fn, T=None):
     #     T.rename('majax', 'radius')
 
     if 'radius' in T.columns():
-        rtn.update(radiusArcsec=list(float(f) for f in T.radius * 3600.))
+        rtn.update(radiusArcsec=(T.radius * 3600.).astype(float))
 
     if 'posAngle' in T.columns() and 'abRatio' in T.columns():
-        rtn.update(posAngle=list(float(f) for f in T.posAngle),
-                   abRatio =list(float(f) for f in T.abRatio))
+        rtn.update(posAngle=T.posAngle.astype(float),
+                   abRatio =T.abRatio.astype(float))
         
-    return HttpResponse(json.dumps(rtn), content_type='application/json')
+    return catalog_response(req, rtn)
 
 def any_cat(req, name, ver, zoom, x, y, **kwargs):
     from map.views import get_layer
@@ -1930,11 +1945,16 @@ def any_cat(req, name, ver, zoom, x, y, **kwargs):
     return cat_decals(req, ver, zoom, x, y, tag=name, docache=False)
 
 def cat_decals(req, ver, zoom, x, y, tag='decals', docache=True):
-    import json
+    from map.catformat import (Records, radec_column, catalog_response,
+                               wants_binary, encode_binary, encode_json)
+    from map.views import get_layer
+    from map.catpyramid import get_catalog_pyramid
     zoom = int(zoom)
-    if zoom < 12:
-        return HttpResponse(json.dumps(dict(rd=[])),
-                            content_type='application/json')
+    layer = get_layer(tag)
+    # Below zoom 12, only layers with a catalog pyramid have anything to show.
+    pyramid = get_catalog_pyramid(layer)
+    if zoom < 12 and pyramid is None:
+        return catalog_response(req, dict(rd=[]))
 
     try:
         wcs, W, H, zoomscale, zoom,x,y = get_tile_wcs(zoom, x, y)
@@ -1945,25 +1965,37 @@ def cat_decals(req, ver, zoom, x, y, tag='decals', docache=True):
     if not ver in catversions[tag]:
         raise RuntimeError('Invalid version %i for tag %s' % (ver, tag))
 
+    binary = wants_binary(req)
+    if binary:
+        ext = 'bin'
+        content_type = 'application/octet-stream'
+    else:
+        ext = 'json'
+        content_type = 'application/json'
+
     basedir = settings.DATA_DIR
     sendfile_kwargs = dict()
-    if docache:
+    # Pyramid tiles are cheap to answer, and change when the pyramid is
+    # rebuilt, so they are not cached.
+    if docache and pyramid is None:
         cachefn = os.path.join(basedir, 'cats-cache', tag,
-                               '%i/%i/%i/%i.cat.json' % (ver, zoom, x, y))
+                               '%i/%i/%i/%i.cat.%s' % (ver, zoom, x, y, ext))
         if os.path.exists(cachefn):
-            return send_file(cachefn, 'application/json',
+            return send_file(cachefn, content_type,
                              modsince=req.META.get('HTTP_IF_MODIFIED_SINCE'),
                              expires=oneyear)
         sendfile_kwargs.update(expires=oneyear)
     else:
         import tempfile
-        f,cachefn = tempfile.mkstemp(suffix='.json')
+        f,cachefn = tempfile.mkstemp(suffix='.' + ext)
         os.close(f)
         sendfile_kwargs.update(unlink=True)
 
-    from map.views import get_layer
-    layer = get_layer(tag)
-    cat,hdr = layer.get_catalog_in_wcs(wcs)
+    if pyramid is not None:
+        cat = pyramid.get_tile_catalog(zoom, x, y)
+    else:
+        from map.catpyramid import CAT_COLUMNS
+        cat,hdr = layer.get_catalog_in_wcs(wcs, columns=CAT_COLUMNS + ['brick_primary'])
 
     if cat is None:
         rd = []
@@ -1973,24 +2005,26 @@ def cat_decals(req, ver, zoom, x, y, tag='decals', docache=True):
         objids = []
         nobs = []
     else:
-        rd = list(zip(cat.ra, cat.dec))
-        types = list([t[0] for t in cat.get('type')])
-        fluxes = [dict(g=float(g), r=float(r), z=float(z))
-                  for g,r,z in zip(cat.flux_g, cat.flux_r, cat.flux_z)]
-        nobs = [dict(g=int(g), r=int(r), z=int(z))
-                for g,r,z in zip(cat.nobs_g, cat.nobs_r, cat.nobs_z)]
-        bricknames = list(cat.brickname)
-        objids = [int(x) for x in cat.objid]
-
-    json = json.dumps(dict(rd=rd, sourcetype=types, fluxes=fluxes, nobs=nobs,
-                                 bricknames=bricknames, objids=objids))
+        rd = radec_column(cat.ra, cat.dec)
+        types = [t[0] for t in cat.get('type')]
+        fluxes = Records([(b, cat.get('flux_%s' % b).astype(float)) for b in 'grz'])
+        nobs = Records([(b, cat.get('nobs_%s' % b)) for b in 'grz'])
+        bricknames = cat.brickname.tolist()
+        objids = cat.objid
+
+    rtn = dict(rd=rd, sourcetype=types, fluxes=fluxes, nobs=nobs,
+               bricknames=bricknames, objids=objids)
+    if binary:
+        data = encode_binary(rtn)
+    else:
+        data = encode_json(rtn).encode('utf-8')
     if docache:
         trymakedirs(cachefn)
 
-    f = open(cachefn, 'w')
-    f.write(json)
+    f = open(cachefn, 'wb')
+    f.write(data)
     f.close()
-    return send_file(cachefn, 'application/json', **sendfile_kwargs)
+    return send_file(cachefn, content_type, **sendfile_kwargs)
 
 @lru_cache(maxsize=1)
 def get_desi_tiles():
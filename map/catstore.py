@@ -0,0 +1,265 @@
+'''
+Static catalogs (FITS tables) converted into a memory-mapped, columnar,
+spatially-indexed form, so that catalog requests only read the rows in
+the viewport rather than the whole table.
+
+A store is a directory holding one .npy file per column, with rows
+sorted by sky cell, plus an offset table giving the rows in each cell.
+Cells are Dec strips of CELL_SIZE degrees, cut into RA ranges about
+CELL_SIZE degrees wide.  The .npy files are memory-mapped read-only, so
+the pages are shared by all the uwsgi processes.
+
+Stores live under DATA_DIR/catstore and are (re-)built from the FITS
+table on first use, or whenever it changes; or ahead of time with
+
+    python -m map.catstore data/bright.fits [...]
+'''
+from __future__ import print_function
+import os
+import json
+import threading
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, 'django-1.9')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'viewer.settings'
+    import django
+    django.setup()
+
+import numpy as np
+
+from viewer import settings
+
+CELL_SIZE = 0.5
+
+class SkyCells(object):
+    '''The grid of sky cells used to index a catalog store.'''
+    def __init__(self, cellsize):
+        self.cellsize = cellsize
+        self.nrows = int(np.ceil(180. / cellsize))
+        declo = -90. + cellsize * np.arange(self.nrows)
+        dechi = np.minimum(declo + cellsize, 90.)
+        # widest part of each strip
+        cosdec = np.cos(np.deg2rad(np.where(declo * dechi <= 0, 0.,
+                                            np.minimum(np.abs(declo), np.abs(dechi)))))
+        self.ncols = np.maximum(1, np.floor(360. * cosdec / cellsize)).astype(int)
+        self.rowstart = np.append(0, np.cumsum(self.ncols))
+        self.ncells = self.rowstart[-1]
+
+    def get_row(self, dec):
+        return np.clip(np.floor((np.asarray(dec) + 90.) / self.cellsize).astype(int),
+                       0, self.nrows-1)
+
+    def get_col(self, row, ra):
+        n = self.ncols[row]
+        return np.clip(np.floor(np.asarray(ra) / 360. * n).astype(int), 0, n-1)
+
+    def radec_to_cell(self, ra, dec):
+        ra = np.asarray(ra) % 360.
+        row = self.get_row(dec)
+        return self.rowstart[row] + self.get_col(row, ra)
+
+    def cell_ranges_for_radec_box(self, ralo, rahi, declo, dechi):
+        '''
+        Returns a list of (first, last) cell ranges covering the given
+        RA,Dec box, which wraps around RA=0 if ralo > rahi.
+        '''
+        if ralo > rahi:
+            raranges = [(ralo, 360.), (0., rahi)]
+        else:
+            raranges = [(ralo, rahi)]
+        ranges = []
+        for row in range(self.get_row(declo), self.get_row(dechi)+1):
+            for r1,r2 in raranges:
+                if r2 - r1 >= 360.:
+                    c1,c2 = 0, self.ncols[row]-1
+                else:
+                    r1 = min(max(r1, 0.), 360.)
+                    r2 = min(max(r2, 0.), 360.)
+                    c1 = self.get_col(row, r1)
+                    c2 = self.get_col(row, r2)
+                ranges.append((self.rowstart[row] + c1, self.rowstart[row] + c2))
+        return ranges
+
+class CatalogStore(object):
+    '''A (memory-mapped) catalog store directory; see build_catalog_store.'''
+    def __init__(self, dirnm):
+        from map.filecache import file_stamp
+        self.dirnm = dirnm
+        metafn = os.path.join(dirnm, 'meta.json')
+        stamp = file_stamp(metafn)
+        with open(metafn) as f:
+            self.meta = json.load(f)
+        self.cells = SkyCells(self.meta['cellsize'])
+        self.offsets = np.load(os.path.join(dirnm, 'offsets.npy'), mmap_mode='r')
+        # original row number of each row
+        self.rows = np.load(os.path.join(dirnm, 'rows.npy'), mmap_mode='r')
+        # Map all the columns now, so that they all come from the same
+        # version of the store even if a rebuilt one gets swapped in.
+        self.cols = dict([(col, np.load(os.path.join(dirnm, 'col-%s.npy' % col),
+                                        mmap_mode='r'))
+                          for col in self.meta['columns']])
+        if file_stamp(metafn) != stamp:
+            raise ValueError('Catalog store %s changed while opening it' % dirnm)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def columns(self):
+        return list(self.meta['columns'])
+
+    def get_column(self, col):
+        return self.cols[col]
+
+    def radec_box_rows(self, ralo, rahi, declo, dechi):
+        '''
+        Returns the (store) row numbers of objects in the cells touching
+        the given RA,Dec box, in the order of the original table.
+        '''
+        I = [np.arange(self.offsets[c1], self.offsets[c2+1])
+             for c1,c2 in self.cells.cell_ranges_for_radec_box(ralo, rahi, declo, dechi)]
+        if len(I) == 0:
+            return np.zeros(0, int)
+        I = np.concatenate(I)
+        return I[np.argsort(self.rows[I])]
+
+    def read(self, I, columns=None):
+        '''Returns a table of rows *I* (of the given columns, or all).'''
+        from astrometry.util.fits import fits_table
+        if columns is None:
+            columns = self.columns()
+        T = fits_table()
+        for col in columns:
+            T.set(col, np.array(self.get_column(col)[I]))
+        return T
+
+    def query_radec_box(self, ralo, rahi, declo, dechi, columns=None):
+        return self.read(self.radec_box_rows(ralo, rahi, declo, dechi), columns=columns)
+
+def source_stamp(fn):
+    st = os.stat(fn)
+    return [st.st_size, st.st_mtime]
+
+def get_store_dir(fn):
+    import hashlib
+    base = os.path.basename(fn)
+    for ext in ['.gz', '.fits', '.fit']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    # (tables in different directories often share a basename)
+    h = hashlib.md5(os.path.abspath(fn).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(settings.DATA_DIR, 'catstore', '%s-%s' % (base, h))
+
+def build_catalog_store(fn, dirnm, cellsize=CELL_SIZE):
+    '''Converts FITS table *fn* into a catalog store in directory *dirnm*.'''
+    import tempfile
+    import shutil
+    from astrometry.util.fits import fits_table
+
+    stamp = source_stamp(fn)
+    T = fits_table(fn)
+    cells = SkyCells(cellsize)
+    cell = cells.radec_to_cell(T.ra, T.dec)
+    I = np.argsort(cell, kind='mergesort')
+    offsets = np.append(0, np.cumsum(np.bincount(cell, minlength=cells.ncells)))
+
+    parent = os.path.dirname(dirnm)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    tmpdir = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    cols = []
+    for col in T.get_columns():
+        arr = T.get(col)
+        if arr.dtype == object:
+            print('Catalog', fn, ': skipping column', col)
+            continue
+        np.save(os.path.join(tmpdir, 'col-%s.npy' % col), arr[I])
+        cols.append(col)
+    np.save(os.path.join(tmpdir, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmpdir, 'rows.npy'), I)
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump(dict(source=fn, stamp=stamp, cellsize=cellsize, columns=cols), f)
+    os.chmod(tmpdir, 0o755)
+    # Swap it in; processes still using an old version keep their mmaps.
+    old = None
+    if os.path.exists(dirnm):
+        old = tempfile.mkdtemp(dir=parent, suffix='.old')
+        os.rename(dirnm, os.path.join(old, 'store'))
+    os.rename(tmpdir, dirnm)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    print('Wrote catalog store', dirnm, 'for', fn, ':', len(T), 'rows')
+
+# source filename -> CatalogStore
+_stores = {}
+# source filename -> lock held while opening or building its store
+_store_locks = {}
+_stores_lock = threading.Lock()
+
+def get_catalog_store(fn):
+    '''
+    Returns the (per-process) CatalogStore for FITS table *fn*, building
+    it if it is missing or out of date; None if that is not possible.
+    '''
+    try:
+        stamp = source_stamp(fn)
+    except OSError:
+        return None
+    store = _stores.get(fn)
+    if store is not None and store.meta['stamp'] == stamp:
+        return store
+    with _stores_lock:
+        lock = _store_locks.get(fn)
+        if lock is None:
+            lock = _store_locks[fn] = threading.Lock()
+    with lock:
+        store = _stores.get(fn)
+        if store is not None and store.meta['stamp'] == stamp:
+            return store
+        store = open_store(fn, stamp)
+        if store is None and not settings.READ_ONLY_BASEDIR:
+            from map.locks import lock_file, unlock_file
+            dirnm = get_store_dir(fn)
+            lockfn = dirnm + '.lock'
+            flock = lock_file(lockfn, settings.HARAKIRI / 2)
+            try:
+                # (someone else may have just built it)
+                store = open_store(fn, stamp)
+                if store is None:
+                    build_catalog_store(fn, dirnm)
+                    store = open_store(fn, stamp)
+            except Exception as e:
+                print('Failed to build catalog store for', fn, ':', e)
+            finally:
+                if flock is not None:
+                    unlock_file(lockfn, flock[0])
+        if store is not None:
+            _stores[fn] = store
+    return store
+
+def open_store(fn, stamp):
+    dirnm = get_store_dir(fn)
+    try:
+        store = CatalogStore(dirnm)
+    except (IOError, OSError, ValueError):
+        return None
+    if store.meta['stamp'] != stamp:
+        return None
+    return store
+
+def query_catalog(fn, ralo, rahi, declo, dechi, columns=None):
+    '''
+    Returns a table of the objects from FITS table *fn* in (at least)
+    the given RA,Dec box -- callers still need to cut to the exact box.
+    Uses the catalog store if possible, else reads the whole table.
+    '''
+    store = get_catalog_store(fn)
+    if store is None:
+        from astrometry.util.fits import fits_table
+        return fits_table(fn, columns=columns)
+    return store.query_radec_box(ralo, rahi, declo, dechi, columns=columns)
+
+if __name__ == '__main__':
+    import sys
+    for fn in sys.argv[1:]:
+        build_catalog_store(fn, get_store_dir(fn))
@@ -70,13 +70,68 @@ def read_sip_wcs(sourcefn, ext, hdr=None, W=None, H=None, fitsfile=None):
     from astrometry.util.util import Sip
     return read_tansip_wcs(sourcefn, ext, hdr=hdr, W=W, H=H, tansip=Sip)
 
-def get_scaled(scalepat, scalekwargs, scale, basefn, read_wcs=None, read_base_wcs=None,
-               wcs=None, img=None, return_data=False, read_base_image=None):
-    from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.util import Tan
+def scale_down(img, wcs):
+    '''
+    Smooths *img* by a 1-pixel Gaussian and bins it 2x2 (dropping an odd
+    last row or column); returns the float32 result and its WCS.
+    '''
+    from map.downsample import smooth_and_bin
+    I2 = smooth_and_bin(img)
+    # shrink WCS too; include the even size clip; this may be a no-op
+    H,W = I2.shape
+    wcs = wcs.get_subimage(0, 0, W*2, H*2)
+    return I2, wcs.scale(0.5)
+
+def scaled_pyramid(img, wcs, nscales):
+    '''
+    Yields (img, wcs) for *nscales* successive scale_down()s of *img*,
+    each computed in memory from the previous one.
+    '''
+    for i in range(nscales):
+        img,wcs = scale_down(img, wcs)
+        yield img,wcs
+
+def write_scaled_image(fn, img, wcs):
+    '''
+    Writes a scaled image plus its WCS header to *fn* (via a temp file).
+    Returns the filename written.
+    '''
     import tempfile
-    import numpy as np
+    from map.scaledcache import scaled_file_written
+    dirnm = os.path.dirname(fn)
+    hdr = fitsio.FITSHDR()
+    wcs.add_to_header(hdr)
+    trymakedirs(fn)
+    f,tmpfn = tempfile.mkstemp(suffix='.fits.tmp', dir=dirnm)
+    os.close(f)
+    #debug('Temp file', tmpfn)
+    # To avoid overwriting the (empty) temp file (and fitsio
+    # debuging "Removing existing file")
+    os.unlink(tmpfn)
+    fitsio.write(tmpfn, img, header=hdr, clobber=True)
+    os.rename(tmpfn, fn)
+    debug('Wrote', fn)
+    scaled_file_written(fn)
+    return fn
 
+def get_scaled(scalepat, scalekwargs, scale, basefn, read_wcs=None, read_base_wcs=None,
+               wcs=None, img=None, return_data=False, read_base_image=None,
+               maxscale=None):
+    '''
+    Returns the filename of image *basefn* downsampled *scale* times
+    (scalepat % dict(scale=scale, **scalekwargs)), creating it if
+    necessary; or (img, wcs, filename) if *return_data*.
+
+    Missing scales are created in one pass: the highest existing lower
+    scale (or *basefn*) is read once, and the scales above it, up to
+    *scale* or *maxscale* if larger, are computed in memory and written.
+    *img*, *wcs*: the scale-1 image and its WCS, if already in hand.
+
+    With READ_ONLY_BASEDIR, new scaled images go in the side cache (see
+    map/scaledcache.py).  Only one thread / process at a time creates a
+    given scaled image; others wait for it.
+    '''
+    from map.scaledcache import find_scaled_file, build_scaled_file
     if scale <= 0:
         return basefn
     fn = scalepat % dict(scale=scale, **scalekwargs)
@@ -87,31 +142,60 @@ def get_scaled(scalepat, scalekwargs, scale, basefn, read_wcs=None, read_base_wc
     #if not os.path.exists(fn) and os.path.exists(fn + '.fz'):
     #    fn += '.fz'
         
-    if os.path.exists(fn):
+    def read_scaled(fn):
+        F = fitsio.FITS(fn)
+        #img = F[0].read()
+        #hdr = F[0].read_header()
+        img = F[-1].read()
+        hdr = F[-1].read_header()
+        H,W = img.shape
+        wcs = read_wcs(fn, 0, hdr=hdr, W=W, H=H, fitsfile=F)
+        return img,wcs,fn
+
+    efn = find_scaled_file(fn)
+    if efn is not None:
         if return_data:
-            F = fitsio.FITS(fn)
-            #img = F[0].read()
-            #hdr = F[0].read_header()
-            img = F[-1].read()
-            hdr = F[-1].read_header()
-            H,W = img.shape
-            wcs = read_wcs(fn, 0, hdr=hdr, W=W, H=H, fitsfile=F)
-            return img,wcs,fn
-        return fn
+            return read_scaled(efn)
+        return efn
 
-    F = None
+    rtn = build_scaled_file(fn, lambda wfn: _build_scaled(
+        scalepat, scalekwargs, scale, basefn, read_wcs, read_base_wcs, wcs, img,
+        read_base_image, maxscale))
+    if rtn is None:
+        return None
+    if not isinstance(rtn, tuple):
+        # (built by someone else)
+        if return_data:
+            return read_scaled(rtn)
+        return rtn
+    if return_data:
+        return rtn
+    return rtn[2]
+
+def _build_scaled(scalepat, scalekwargs, scale, basefn, read_wcs, read_base_wcs,
+                  wcs, img, read_base_image, maxscale):
+    '''
+    Creates the missing scaled images for get_scaled, returning
+    (img, wcs, filename) of scale *scale*, or None.
+    '''
+    from map.scaledcache import find_scaled_file, writable_scaled_filename
+    srcscale = scale - 1
     if img is None:
-        sourcefn = get_scaled(scalepat, scalekwargs, scale-1, basefn,
-                              read_base_wcs=read_base_wcs, read_wcs=read_wcs,
-                              read_base_image=read_base_image)
+        # Start from the highest scale we already have.
+        while (srcscale > 0 and
+               find_scaled_file(scalepat % dict(scale=srcscale, **scalekwargs)) is None):
+            srcscale -= 1
+        if srcscale == 0:
+            sourcefn = basefn
+        else:
+            sourcefn = find_scaled_file(scalepat % dict(scale=srcscale, **scalekwargs))
         debug('Source:', sourcefn)
         if sourcefn is None or not os.path.exists(sourcefn):
             debug('Image source file', sourcefn, 'not found')
             return None
+        F = None
         try:
-            #debug('Reading image:', sourcefn, 'for scale', scale, '; read_base_image is', read_base_image)
-
-            if scale == 1 and read_base_image is not None:
+            if srcscale == 0 and read_base_image is not None:
                 img,hdr = read_base_image(sourcefn)
             else:
                 F = fitsio.FITS(sourcefn)
@@ -124,53 +208,24 @@ def get_scaled(scalepat, scalekwargs, scale, basefn, read_wcs=None, read_base_wc
             import traceback
             traceback.print_exc()
             return None
-
-    H,W = img.shape
-    # make even size; smooth down
-    if H % 2 == 1:
-        img = img[:-1,:]
-    if W % 2 == 1:
-        img = img[:,:-1]
-    img = gaussian_filter(img, 1.)
-    # bin
-    I2 = (img[::2,::2] + img[1::2,::2] + img[1::2,1::2] + img[::2,1::2])/4.
-    I2 = I2.astype(np.float32)
-
-    # shrink WCS too
-    if wcs is None:
-        if scale == 1:
-            # Use the given function to read base WCS.
-            if read_base_wcs is not None:
+        if wcs is None:
+            if srcscale == 0 and read_base_wcs is not None:
+                # Use the given function to read base WCS.
                 read_wcs = read_base_wcs
-        wcs = read_wcs(sourcefn, 0, hdr=hdr, W=W, H=H, fitsfile=F)
-    # include the even size clip; this may be a no-op
-    H,W = img.shape
-    wcs = wcs.get_subimage(0, 0, W, H)
-    wcs2 = wcs.scale(0.5)
-
-    dirnm = os.path.dirname(fn)
-
-    ro = settings.READ_ONLY_BASEDIR
-    if ro:
-        dirnm = None
-
-    hdr = fitsio.FITSHDR()
-    wcs2.add_to_header(hdr)
-    trymakedirs(fn)
-    f,tmpfn = tempfile.mkstemp(suffix='.fits.tmp', dir=dirnm)
-    os.close(f)
-    #debug('Temp file', tmpfn)
-    # To avoid overwriting the (empty) temp file (and fitsio
-    # debuging "Removing existing file")
-    os.unlink(tmpfn)
-    fitsio.write(tmpfn, I2, header=hdr, clobber=True)
-    if not ro:
-        os.rename(tmpfn, fn)
-        debug('Wrote', fn)
-    else:
-        print('Leaving temp file for get_scaled:', scalepat, scalekwargs, scale, basefn)
-        fn = tmpfn
-    if return_data:
-        return I2,wcs2,fn
-    return fn
-
+            H,W = img.shape
+            wcs = read_wcs(sourcefn, 0, hdr=hdr, W=W, H=H, fitsfile=F)
+
+    topscale = scale
+    if maxscale is not None:
+        topscale = max(scale, maxscale)
+    rtn = None
+    s = srcscale
+    for I2,wcs2 in scaled_pyramid(img, wcs, topscale - srcscale):
+        s += 1
+        sfn = scalepat % dict(scale=s, **scalekwargs)
+        if s == scale:
+            sfn = write_scaled_image(writable_scaled_filename(sfn), I2, wcs2)
+            rtn = (I2, wcs2, sfn)
+        elif find_scaled_file(sfn) is None:
+            write_scaled_image(writable_scaled_filename(sfn), I2, wcs2)
+    return rtn
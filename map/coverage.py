@@ -0,0 +1,160 @@
+'''
+Per-layer coverage maps: which Mercator tiles can possibly contain any
+data, so that MapLayer.get_tile() can answer tiles outside a survey's
+footprint without looking up bricks or touching the filesystem.
+
+A layer's coverage is a bitmask of the tiles at zoom
+settings.COVERAGE_ZOOM touched by its bricks' RA,Dec boxes (grown by
+one tile, to be safe), plus the OR-ed down versions of it for lower
+zooms; higher zooms use their parent tile at COVERAGE_ZOOM.  It is
+computed from MapLayer.get_coverage_bricks() and saved in the layer's
+tile directory (delete that file when a layer gets new bricks).
+'''
+from __future__ import print_function
+import os
+import threading
+import numpy as np
+
+from viewer import settings
+
+class TileCoverage(object):
+    def __init__(self, bits):
+        '''
+        *bits*: boolean array, 2**zoom x 2**zoom, of tiles [y, x] with data.
+        '''
+        bits = np.asarray(bits, bool)
+        n = bits.shape[0]
+        self.zoom = int(np.round(np.log2(n)))
+        assert(bits.shape == (n, n) and n == 2**self.zoom)
+        self.levels = [None] * (self.zoom + 1)
+        self.levels[self.zoom] = bits
+        for z in range(self.zoom - 1, -1, -1):
+            b = self.levels[z + 1]
+            self.levels[z] = (b[0::2, 0::2] | b[1::2, 0::2] |
+                              b[0::2, 1::2] | b[1::2, 1::2])
+
+    def has_tile(self, zoom, x, y):
+        '''Could Mercator tile zoom,x,y contain any data?'''
+        if zoom > self.zoom:
+            shift = zoom - self.zoom
+            x >>= shift
+            y >>= shift
+            zoom = self.zoom
+        return bool(self.levels[zoom][y, x])
+
+def merc_tile_y(dec, zoom):
+    '''(Fractional) Mercator tile row at *dec*; see get_tile_wcs.'''
+    dec = np.clip(dec, -89.99, 89.99)
+    return 2.**zoom / (2.*np.pi) * (np.pi - np.log(np.tan(np.pi/4. + np.deg2rad(dec)/2.)))
+
+def merc_tile_x(ra, zoom):
+    '''(Fractional) Mercator tile column at *ra*; see get_tile_wcs.'''
+    return (360. - ra) / 360. * 2.**zoom
+
+def tile_bitmask_for_boxes(ra1, ra2, dec1, dec2, zoom, margin=1):
+    '''
+    Returns a 2**zoom x 2**zoom boolean array [y, x] of the tiles
+    overlapping (within *margin* tiles) any of the given RA,Dec boxes.
+    '''
+    N = 2**zoom
+    ra1 = np.atleast_1d(ra1).astype(float)
+    ra2 = np.atleast_1d(ra2).astype(float)
+    # boxes written across RA=0 as ra1 > ra2
+    ra2 = ra2 + 360. * (ra2 < ra1)
+    # RA increases to the left
+    x0 = np.floor(merc_tile_x(ra2, zoom)).astype(int) - margin
+    x1 = np.floor(merc_tile_x(ra1, zoom)).astype(int) + margin
+    y0 = np.floor(merc_tile_y(dec2, zoom)).astype(int) - margin
+    y1 = np.floor(merc_tile_y(dec1, zoom)).astype(int) + margin
+    y0 = np.clip(y0, 0, N-1)
+    y1 = np.clip(y1, 0, N-1)
+    # boxes spanning all RAs
+    full = (x1 - x0 + 1) >= N
+    x0[full] = 0
+    x1[full] = N-1
+    # wrap, and split boxes running past the right edge into two
+    w = x1 - x0
+    x0 = x0 % N
+    x1 = x0 + w
+    wrap = x1 >= N
+    x0 = np.append(x0, np.zeros(np.sum(wrap), int))
+    x1 = np.append(np.minimum(x1, N-1), x1[wrap] - N)
+    y0 = np.append(y0, y0[wrap])
+    y1 = np.append(y1, y1[wrap])
+    # Paint the rectangles via a 2-d cumulative sum of their corners
+    paint = np.zeros((N+1, N+1), np.int32)
+    np.add.at(paint, (y0,   x0  ),  1)
+    np.add.at(paint, (y0,   x1+1), -1)
+    np.add.at(paint, (y1+1, x0  ), -1)
+    np.add.at(paint, (y1+1, x1+1),  1)
+    paint = np.cumsum(np.cumsum(paint, axis=0), axis=1)
+    return paint[:N, :N] > 0
+
+def read_coverage(fn):
+    import fitsio
+    packed,hdr = fitsio.read(fn, header=True)
+    zoom = hdr['COVZOOM']
+    N = 2**zoom
+    bits = np.unpackbits(packed.ravel())[:N*N].reshape(N, N)
+    return TileCoverage(bits)
+
+def write_coverage(fn, cov):
+    import fitsio
+    import tempfile
+    from map.utils import trymakedirs
+    trymakedirs(fn)
+    f,tmpfn = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(fn))
+    os.close(f)
+    packed = np.packbits(cov.levels[cov.zoom].ravel())
+    fitsio.write(tmpfn, packed, header=[dict(name='COVZOOM', value=cov.zoom)],
+                 clobber=True)
+    os.chmod(tmpfn, 0o644)
+    os.rename(tmpfn, fn)
+
+# layer name -> TileCoverage or None
+_coverage = {}
+_coverage_lock = threading.Lock()
+
+def get_coverage(layer):
+    '''
+    Returns the (cached) TileCoverage for MapLayer *layer*, or None if
+    its footprint is unknown (ie, any tile may have data).
+    '''
+    zoom = settings.COVERAGE_ZOOM
+    if zoom is None:
+        return None
+    try:
+        return _coverage[layer.name]
+    except KeyError:
+        pass
+    with _coverage_lock:
+        if layer.name in _coverage:
+            return _coverage[layer.name]
+        cov = load_coverage(layer, zoom)
+        _coverage[layer.name] = cov
+    return cov
+
+def load_coverage(layer, zoom):
+    fn = layer.get_coverage_filename(zoom)
+    if fn is not None and os.path.exists(fn):
+        try:
+            return read_coverage(fn)
+        except Exception as e:
+            print('Failed to read coverage file', fn, ':', e)
+    try:
+        bricks = layer.get_coverage_bricks()
+    except Exception as e:
+        print('Failed to get bricks for coverage of layer', layer.name, ':', e)
+        return None
+    if bricks is None:
+        return None
+    cov = TileCoverage(tile_bitmask_for_boxes(bricks.ra1, bricks.ra2,
+                                              bricks.dec1, bricks.dec2, zoom))
+    print('Coverage for layer', layer.name, ':', np.sum(cov.levels[zoom]),
+          'of', 4**zoom, 'tiles at zoom', zoom)
+    if fn is not None and not settings.READ_ONLY_BASEDIR:
+        try:
+            write_coverage(fn, cov)
+        except Exception as e:
+            print('Failed to write coverage file', fn, ':', e)
+    return cov
@@ -0,0 +1,71 @@
+'''
+Downsampling used to build image pyramids (scaled images and top-level
+tiles): smooth by a Gaussian of sigma 1 pixel, then bin 2x2.
+
+This gives the same result (to float32 precision) as
+
+    img = scipy.ndimage.gaussian_filter(img, 1.)
+    img = (img[::2,::2] + img[1::2,::2] + img[1::2,1::2] + img[::2,1::2]) / 4.
+
+but the smoothing and binning are done together, as one 10-tap filter
+per axis evaluated only at the output pixels, in float32, on blocks of
+rows so that the temporary arrays stay small.
+'''
+from __future__ import print_function
+
+import numpy as np
+
+# scipy.ndimage.gaussian_filter(sigma=1) truncates the kernel at 4 sigma.
+_G = np.exp(-0.5 * np.arange(-4, 5)**2)
+_G /= _G.sum()
+# Gaussian then average of 2 pixels: taps at offsets -4 .. +5 from 2*i.
+KERNEL = 0.5 * (np.append(_G, 0.) + np.append(0., _G))
+KERNEL_OFFSETS = np.arange(-4, 6)
+
+def reflect_index(i, n):
+    '''
+    Maps indices *i* into [0, n) by mirroring about the edges, as
+    scipy.ndimage's "reflect" mode does (d c b a | a b c d | d c b a).
+    '''
+    i = np.asarray(i) % (2*n)
+    return np.where(i < n, i, 2*n - 1 - i)
+
+def _bin_axis1(img, out):
+    # Smooth & bin along axis 1 of *img* (float32), into *out*.
+    W2 = out.shape[1]
+    W = 2 * W2
+    cols = reflect_index(np.arange(KERNEL_OFFSETS[0], W + KERNEL_OFFSETS[-1]), W)
+    padded = img[:, cols]
+    out[:] = 0.
+    for k,dx in zip(KERNEL, KERNEL_OFFSETS):
+        x0 = dx - KERNEL_OFFSETS[0]
+        out += np.float32(k) * padded[:, x0 : x0 + W : 2]
+    return out
+
+def smooth_and_bin(img, block=512):
+    '''
+    Smooths 2-d image *img* by a 1-pixel Gaussian and bins it 2x2
+    (dropping an odd last row or column), returning a float32 image
+    half the size.  The output is computed *block* rows at a time.
+    '''
+    H,W = img.shape
+    H2,W2 = H//2, W//2
+    H,W = 2*H2, 2*W2
+    out = np.empty((H2, W2), np.float32)
+    if H2 == 0 or W2 == 0:
+        return out
+    ylo,yhi = KERNEL_OFFSETS[0], KERNEL_OFFSETS[-1]
+    for i0 in range(0, H2, block):
+        i1 = min(H2, i0 + block)
+        # input rows needed for output rows i0 .. i1-1
+        rows = reflect_index(np.arange(2*i0 + ylo, 2*i1 + yhi), H)
+        sub = np.asarray(img[rows, :W], np.float32)
+        # bin along x first: halves the work along y
+        tmp = _bin_axis1(sub, np.empty((len(rows), W2), np.float32))
+        o = out[i0:i1]
+        o[:] = 0.
+        n = i1 - i0
+        for k,dy in zip(KERNEL, KERNEL_OFFSETS):
+            y0 = dy - ylo
+            o += np.float32(k) * tmp[y0 : y0 + 2*n : 2]
+    return out
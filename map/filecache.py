@@ -0,0 +1,231 @@
+'''
+Per-process caches of open FITS files, and of the metadata we parse from
+them (headers, WCS, number of HDUs), so that rendering a tile does not
+re-open and re-parse the same brick files over and over; and of open
+kd-trees, so that catalog queries do not re-load them.
+
+Entries are keyed by filename and are dropped when the file changes
+on disk (inode, size or mtime).
+'''
+from __future__ import print_function
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from viewer import settings
+
+class LRUCache(object):
+    '''
+    A thread-safe, size-bounded dict that forgets its least-recently
+    used entries.  *maxsize* <= 0 disables the cache.  If *maxbytes* > 0,
+    the total of the *nbytes* given to put() is also kept below it.
+    '''
+    def __init__(self, maxsize, maxbytes=0):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                val = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = val
+            return val
+
+    def put(self, key, val, nbytes=0):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self._remove(key)
+            self.data[key] = val
+            self.sizes[key] = nbytes
+            self.nbytes += nbytes
+            while len(self.data) > self.maxsize or (
+                    self.maxbytes > 0 and self.nbytes > self.maxbytes and
+                    len(self.data) > 1):
+                self._remove(next(iter(self.data)))
+
+    def _remove(self, key, default=None):
+        val = self.data.pop(key, default)
+        self.nbytes -= self.sizes.pop(key, 0)
+        return val
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+def file_stamp(fn):
+    '''
+    Returns a value that changes when file *fn* is replaced or modified;
+    raises OSError if it does not exist.
+    '''
+    st = os.stat(fn)
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+class CachedFits(object):
+    '''An open fitsio.FITS object plus a lock that serializes access to it.'''
+    def __init__(self, fn):
+        import fitsio
+        self.fits = fitsio.FITS(fn)
+        self.lock = threading.RLock()
+
+fits_handles = LRUCache(settings.FITS_HANDLE_CACHE_SIZE)
+fits_metadata = LRUCache(settings.FITS_METADATA_CACHE_SIZE)
+kd_trees = LRUCache(settings.KDTREE_CACHE_SIZE, settings.KDTREE_CACHE_BYTES)
+# process that opened the files in fits_handles and kd_trees
+_handles_pid = os.getpid()
+
+def _check_fork():
+    '''
+    Drops the open file handles inherited from a parent process (eg,
+    render-tiles multiprocessing, or uwsgi without lazy-apps): they share
+    file offsets with the parent's, and their locks may be held.
+    '''
+    global fits_handles, kd_trees, _handles_pid
+    if _handles_pid == os.getpid():
+        return
+    fits_handles = LRUCache(settings.FITS_HANDLE_CACHE_SIZE)
+    kd_trees = LRUCache(settings.KDTREE_CACHE_SIZE, settings.KDTREE_CACHE_BYTES)
+    _handles_pid = os.getpid()
+
+@contextmanager
+def open_fits(fn):
+    '''
+    Context manager yielding an open fitsio.FITS object for *fn*, taken
+    from (or added to) the per-process handle cache.  The handle is
+    locked for the duration of the "with" block.
+
+    Gzipped files are not pooled, since cfitsio decompresses them into
+    memory on open.
+    '''
+    import fitsio
+    if fn.endswith('.gz'):
+        with fitsio.FITS(fn) as F:
+            yield F
+        return
+    _check_fork()
+    stamp = file_stamp(fn)
+    c = fits_handles.get(fn)
+    if c is None or c[0] != stamp:
+        c = (stamp, CachedFits(fn))
+        fits_handles.put(fn, c)
+    cf = c[1]
+    with cf.lock:
+        yield cf.fits
+
+def _cached(key, fn, func):
+    try:
+        stamp = file_stamp(fn)
+    except OSError:
+        return func()
+    key = key + (fn, stamp)
+    val = fits_metadata.get(key)
+    if val is None:
+        val = func()
+        if val is not None:
+            fits_metadata.put(key, val)
+    return val
+
+def read_image(fn, ext, slc=None, header=False):
+    '''
+    Reads HDU *ext* of FITS file *fn* (or the pixel slice *slc* of it),
+    optionally also returning its (cached) header.
+    '''
+    with open_fits(fn) as F:
+        f = F[ext]
+        if slc is None:
+            img = f.read()
+        else:
+            img = f[slc]
+    if header:
+        return img, read_header(fn, ext)
+    return img
+
+def read_header(fn, ext):
+    '''Returns the (cached) header of HDU *ext* of FITS file *fn*.'''
+    def read():
+        with open_fits(fn) as F:
+            return F[ext].read_header()
+    return _cached(('hdr', ext), fn, read)
+
+def get_hdu_count(fn):
+    '''Returns the (cached) number of HDUs in FITS file *fn*.'''
+    def read():
+        with open_fits(fn) as F:
+            return len(F)
+    return _cached(('nhdu',), fn, read)
+
+def get_wcs(fn, ext, read_wcs):
+    '''
+    Returns the (cached) result of *read_wcs(fn, ext)*.  The returned WCS
+    object is shared, so callers must not modify it.
+    '''
+    return _cached(('wcs', ext, read_wcs), fn, lambda: read_wcs(fn, ext))
+
+def get_table_columns(fn, ext=1):
+    '''Returns the (cached) column names, in lower case, of table HDU *ext* of FITS file *fn*.'''
+    def read():
+        with open_fits(fn) as F:
+            return [c.lower() for c in F[ext].get_colnames()]
+    return _cached(('cols', ext), fn, read)
+
+def read_table(fn, columns=None, rows=None, ext=1):
+    '''
+    Reads FITS table *fn* with fits_table, reading only those of the
+    given *columns* that the table has (or all columns, if None), and
+    only *rows*, if given.
+    '''
+    from astrometry.util.fits import fits_table
+    if columns is not None:
+        have = get_table_columns(fn, ext)
+        wanted = []
+        for c in columns:
+            if c.lower() in have and not c in wanted:
+                wanted.append(c)
+        columns = wanted
+    return fits_table(fn, ext=ext, rows=rows, columns=columns)
+
+class CachedKdTree(object):
+    '''An open kd-tree plus a lock that serializes searches in it.'''
+    def __init__(self, fn, treename=None):
+        from astrometry.libkd.spherematch import tree_open
+        if treename is None:
+            self.kd = tree_open(fn)
+        else:
+            self.kd = tree_open(fn, treename)
+        self.lock = threading.Lock()
+
+def kdtree_search_radec(fn, ra, dec, radius, treename=None):
+    '''
+    Returns the indices of the objects in kd-tree file *fn* within
+    *radius* degrees of *ra*,*dec*, keeping the tree open (in a
+    per-process pool, limited in number of trees / open files and in
+    total file size) for next time.
+    '''
+    from astrometry.libkd.spherematch import tree_search_radec
+    _check_fork()
+    stamp = file_stamp(fn)
+    key = (fn, treename)
+    c = kd_trees.get(key)
+    if c is None or c[0] != stamp:
+        c = (stamp, CachedKdTree(fn, treename))
+        # (stamp[1] is the file size)
+        kd_trees.put(key, c, nbytes=stamp[1])
+    ckd = c[1]
+    with ckd.lock:
+        return tree_search_radec(ckd.kd, ra, dec, radius)
@@ -0,0 +1,116 @@
+'''
+Locking helpers for work that several uwsgi threads / processes may try
+to do at the same time (eg, rendering the same uncached tile).
+'''
+from __future__ import print_function
+import os
+import time
+import threading
+
+from map.utils import trymakedirs
+
+def lock_file(fn, timeout):
+    '''
+    Takes an exclusive fcntl lock on lock file *fn* (creating it),
+    waiting up to *timeout* seconds.  Returns (fd, waited), or None if
+    we timed out or could not create the file.  Release with
+    unlock_file().
+    '''
+    import fcntl
+    t0 = time.time()
+    waited = False
+    while True:
+        try:
+            trymakedirs(fn)
+            fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return None
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if time.time() - t0 > timeout:
+                    os.close(fd)
+                    return None
+                waited = True
+                time.sleep(0.05)
+        # The previous holder deletes the file when it is done; make
+        # sure the file we locked is still the one at that path.
+        try:
+            st = os.stat(fn)
+            fst = os.fstat(fd)
+            if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+                return fd, waited
+        except OSError:
+            pass
+        os.close(fd)
+
+def unlock_file(fn, fd):
+    '''Removes lock file *fn* and releases our lock on it.'''
+    try:
+        os.unlink(fn)
+    except OSError:
+        pass
+    os.close(fd)
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def single_flight(key, func, lockfn=None, cached=None, timeout=60.):
+    '''
+    Returns func(), making sure that only one caller at a time computes
+    it for a given *key*:
+
+    - other threads of this process asking for the same *key* wait for
+      (up to *timeout* seconds) and share the result;
+    - if *lockfn* is given, other processes are excluded with a lock on
+      that file; a process that had to wait calls *cached()* first, and
+      only runs func() if that returns None (ie, the other process did
+      not leave the result somewhere we can find it).
+
+    If waiting times out, or the lock file cannot be created, we just
+    call func() ourselves.
+    '''
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _flights[key] = flight
+    if not leader:
+        if flight.done.wait(timeout) and flight.ok:
+            return flight.result
+        return func()
+    try:
+        result = _run_locked(func, lockfn, cached, timeout)
+        flight.result = result
+        flight.ok = True
+        return result
+    finally:
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        flight.done.set()
+
+def _run_locked(func, lockfn, cached, timeout):
+    if lockfn is None:
+        return func()
+    lock = lock_file(lockfn, timeout)
+    if lock is None:
+        return func()
+    fd,waited = lock
+    try:
+        if waited and cached is not None:
+            result = cached()
+            if result is not None:
+                return result
+        return func()
+    finally:
+        unlock_file(lockfn, fd)
@@ -35,7 +35,7 @@ class PhatLayer(MapLayer):
         return os.path.join(settings.DATA_DIR, 'm31_full_%s_scale%i.fits' % (band, scale))
 
     def render_into_wcs(self, wcs, zoom, x, y, bands=None, general_wcs=False,
-                        scale=None, tempfiles=None):
+                        scale=None, tempfiles=None, weights=None):
         import numpy as np
         from astrometry.util.resample import resample_with_wcs, OverlapError
 
@@ -0,0 +1,138 @@
+'''
+Optional on-disk cache of "resampling tables": the mapping from the
+pixels of a brick image to the pixels of a Mercator tile (or metatile),
+used by MapLayer.resample_brick in place of resample_with_wcs.
+
+A table holds, for each tile pixel (Yo, Xo) that the brick covers, the
+nearest brick pixel (Yi, Xi) and the sub-pixel offsets (dx, dy) that set
+the Lanczos-3 interpolation weights.  Since these depend only on the
+brick and tile geometry, re-rendering a tile (eg, after changing the
+color stretch or bumping its tile version) only needs the interpolation.
+A table takes 16 bytes per tile pixel (with the int16 coordinates of
+MapLayer.get_pixel_coord_type; 24 with int32).
+
+Tables live under RESAMPLE_TABLE_DIR/<layer>/<scale>/<zoom>/<x>/, which
+is kept below RESAMPLE_TABLE_BYTES by deleting the least-recently used
+ones; each process also keeps up to RESAMPLE_TABLE_CACHE_BYTES of them in
+memory.  Delete the directory if a data release's brick WCSes change.
+'''
+from __future__ import print_function
+import os
+import threading
+
+import numpy as np
+
+from viewer import settings
+from map.filecache import LRUCache
+
+def get_table_filename(name, brickname, band, scale, tile, box):
+    '''
+    Filename of the table for brick *brickname* (in *band*, or None if
+    all bands share its WCS) at *scale*, pixel box *box* = (xlo, ylo,
+    xhi, yhi) of it, and the *n* x *n* block of tiles *tile* = (zoom,
+    x, y, n).
+    '''
+    zoom,x,y,n = tile
+    parts = [brickname]
+    if band is not None:
+        parts.append(str(band))
+    parts.append('%i-%i-%i-%i' % tuple(box))
+    return os.path.join(settings.RESAMPLE_TABLE_DIR, name, '%i' % scale,
+                        '%i' % zoom, '%i' % x, '%i-%i' % (y, n),
+                        '_'.join(parts) + '.npz')
+
+def compute_table(wcs, subwcs, coordtype):
+    '''
+    Computes the resampling table from image *subwcs* into *wcs*, as a
+    dict of arrays (of length zero if they do not overlap).
+    '''
+    from astrometry.util.resample import resample_with_wcs, OverlapError
+    try:
+        # (just to find the target pixels the image covers)
+        Yo,Xo,nil,nil,nil = resample_with_wcs(wcs, subwcs, [], intType=coordtype)
+    except OverlapError:
+        Yo = Xo = np.zeros(0, coordtype)
+    # Exact source pixel positions of those pixels
+    rr,dd = wcs.pixelxy2radec(Xo + 1., Yo + 1.)[-2:]
+    ok,fx,fy = subwcs.radec2pixelxy(rr, dd)
+    fx = fx - 1.
+    fy = fy - 1.
+    h,w = subwcs.shape
+    I = np.flatnonzero(ok * (fx > -0.5) * (fx < w - 0.5) * (fy > -0.5) * (fy < h - 0.5))
+    Xi = np.round(fx[I]).astype(coordtype)
+    Yi = np.round(fy[I]).astype(coordtype)
+    return dict(Yo=Yo[I].astype(coordtype), Xo=Xo[I].astype(coordtype), Yi=Yi, Xi=Xi,
+                dx=(fx[I] - Xi).astype(np.float32), dy=(fy[I] - Yi).astype(np.float32))
+
+def resample_with_table(table, imgs):
+    '''
+    Lanczos-3 interpolates images *imgs* (which have the shape of the
+    table's source image) at the table's pixels, as resample_with_wcs
+    would.  Returns a list of arrays.
+    '''
+    from astrometry.util.util import lanczos3_interpolate
+    n = len(table['Xi'])
+    laccs = [np.zeros(n, np.float32) for img in imgs]
+    lanczos3_interpolate(table['Xi'].astype(np.int32), table['Yi'].astype(np.int32),
+                         table['dx'], table['dy'], laccs,
+                         [img.astype(np.float32) for img in imgs])
+    return laccs
+
+# (up to 4096 tables and RESAMPLE_TABLE_CACHE_BYTES)
+tables = LRUCache(4096, maxbytes=settings.RESAMPLE_TABLE_CACHE_BYTES)
+
+# bytes this process has written since it last checked the directory size
+_written = [None]
+_written_lock = threading.Lock()
+
+def get_resample_table(fn, wcs, subwcs, coordtype):
+    '''
+    Returns the resampling table cached in file *fn*, computing and
+    saving it if necessary.
+    '''
+    import tempfile
+    from map.utils import trymakedirs
+    table = tables.get(fn)
+    if table is not None:
+        return table
+    try:
+        with np.load(fn) as f:
+            table = dict(f)
+        # (mark as recently used, for trimming)
+        os.utime(fn, None)
+    except (IOError, OSError, ValueError):
+        table = None
+    if table is None:
+        table = compute_table(wcs, subwcs, coordtype)
+        tmpfn = None
+        try:
+            trymakedirs(fn)
+            f,tmpfn = tempfile.mkstemp(suffix='.npz.tmp', dir=os.path.dirname(fn))
+            with os.fdopen(f, 'wb') as out:
+                np.savez(out, **table)
+            os.rename(tmpfn, fn)
+            tmpfn = None
+            table_written(fn)
+        except (IOError, OSError) as e:
+            print('Failed to save resampling table', fn, ':', e)
+            if tmpfn is not None:
+                try:
+                    os.unlink(tmpfn)
+                except OSError:
+                    pass
+    tables.put(fn, table, nbytes=sum([a.nbytes for a in table.values()]))
+    return table
+
+def table_written(fn):
+    '''Trims the table directory once this process has written 1% of its limit.'''
+    from map.scaledcache import trim_in_background
+    maxbytes = settings.RESAMPLE_TABLE_BYTES
+    if maxbytes <= 0:
+        return
+    with _written_lock:
+        if _written[0] is not None:
+            _written[0] += os.path.getsize(fn)
+            if _written[0] < maxbytes / 100:
+                return
+        _written[0] = 0
+    trim_in_background(settings.RESAMPLE_TABLE_DIR, maxbytes)
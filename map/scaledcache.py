@@ -0,0 +1,188 @@
+'''
+Finding and building scaled images, and the side cache for them on
+read-only deployments.
+
+With READ_ONLY_BASEDIR, the scaled images that would normally be written
+under DATA_DIR are written under READ_ONLY_CACHE_DIR instead (at the
+same relative path), so that they persist across requests and workers
+while the data tree stays untouched.  The cache directory is kept below
+READ_ONLY_CACHE_BYTES by deleting the least-recently used files; files
+are "used" when they are looked up here, which sets their access time.
+'''
+from __future__ import print_function
+import os
+import time
+import threading
+
+from viewer import settings
+
+def get_cache_filename(fn):
+    '''Where scaled image *fn* is written when the data tree is read-only.'''
+    fn = os.path.abspath(fn)
+    data = os.path.abspath(settings.DATA_DIR)
+    if fn.startswith(data + os.sep):
+        rel = os.path.relpath(fn, data)
+    else:
+        rel = os.path.join('abs', fn.lstrip(os.sep))
+    return os.path.join(settings.READ_ONLY_CACHE_DIR, rel)
+
+def writable_scaled_filename(fn):
+    '''Where a new scaled image that belongs at *fn* should be written.'''
+    if settings.READ_ONLY_BASEDIR:
+        return get_cache_filename(fn)
+    return fn
+
+# Only update access times this often (seconds).
+TOUCH_INTERVAL = 3600.
+
+def find_scaled_file(fn):
+    '''
+    Returns the filename of existing scaled image *fn* -- *fn* itself,
+    or its copy in the side cache -- or None if it does not exist.
+    '''
+    if os.path.exists(fn):
+        return fn
+    if not settings.READ_ONLY_BASEDIR:
+        return None
+    cfn = get_cache_filename(fn)
+    try:
+        st = os.stat(cfn)
+    except OSError:
+        return None
+    now = time.time()
+    if st.st_atime < now - TOUCH_INTERVAL:
+        try:
+            os.utime(cfn, (now, st.st_mtime))
+        except OSError:
+            pass
+    return cfn
+
+# bytes this process has written to the cache since it last checked its size
+_written = [None]
+_written_lock = threading.Lock()
+
+def scaled_file_written(fn):
+    '''
+    Records that file *fn* was written; if it is in the side cache,
+    trims the cache when this process has written enough to matter.
+    '''
+    maxbytes = settings.READ_ONLY_CACHE_BYTES
+    if not settings.READ_ONLY_BASEDIR or maxbytes <= 0:
+        return
+    if not os.path.abspath(fn).startswith(
+            os.path.abspath(settings.READ_ONLY_CACHE_DIR) + os.sep):
+        return
+    try:
+        nbytes = os.path.getsize(fn)
+    except OSError:
+        return
+    with _written_lock:
+        # (check at startup, then after every 1% of the limit)
+        if _written[0] is not None:
+            _written[0] += nbytes
+            if _written[0] < maxbytes / 100:
+                return
+        _written[0] = 0
+    trim_in_background(settings.READ_ONLY_CACHE_DIR, maxbytes)
+
+# directory -> thread trimming it
+_trimmers = {}
+_trimmers_lock = threading.Lock()
+
+def trim_in_background(dirnm, maxbytes):
+    '''
+    Runs trim_cache(dirnm, maxbytes) in a daemon thread, so that the
+    request that noticed the cache growing does not wait for it; does
+    nothing if this process is already trimming *dirnm*.
+    '''
+    with _trimmers_lock:
+        t = _trimmers.get(dirnm)
+        if t is not None and t.is_alive():
+            return
+        t = threading.Thread(target=trim_cache, args=(dirnm, maxbytes),
+                             name='trim ' + dirnm)
+        t.daemon = True
+        _trimmers[dirnm] = t
+        t.start()
+
+def trim_cache(dirnm, maxbytes, minage=TOUCH_INTERVAL):
+    '''
+    Deletes the least-recently used files in *dirnm* until it holds at
+    most 90% of *maxbytes*, sparing files used in the last *minage*
+    seconds (at least TOUCH_INTERVAL, since access times are only
+    updated that often) -- unless it is still over *maxbytes* without
+    them (eg, during a bulk render), in which case only files used
+    in the last minute are spared.  Only one process at a time does
+    this; others skip it.
+    '''
+    import fcntl
+    lockfn = os.path.join(dirnm, 'trim.lock')
+    try:
+        fd = os.open(lockfn, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return
+        files = []
+        total = 0
+        for root, dirs, fns in os.walk(dirnm):
+            for fn in fns:
+                if fn.endswith('.lock') or fn.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+                total += st.st_size
+        if total <= maxbytes:
+            return
+        files.sort()
+        target = 0.9 * maxbytes
+        now = time.time()
+        ndel = 0
+        for age in [minage, 60.]:
+            if total <= maxbytes:
+                break
+            tooold = now - age
+            keep = []
+            for atime, size, path in files:
+                if total <= target or atime > tooold:
+                    keep.append((atime, size, path))
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                ndel += 1
+            files = keep
+        print('Trimmed cache', dirnm, ': deleted', ndel, 'files; now', total, 'bytes')
+    finally:
+        os.close(fd)
+
+def build_scaled_file(fn, create):
+    '''
+    Returns the filename of existing scaled image *fn* (see
+    find_scaled_file), or else the result of create(wfn), which should
+    write it to *wfn* (see writable_scaled_filename) and return that.
+
+    Only one thread / process at a time builds a given file; the others
+    wait for it (up to HARAKIRI/2 seconds) and then use its result.  The
+    builder holds an fcntl lock on a lock file next to the output, which
+    the kernel releases if the builder dies, so stale lock files do not
+    block anyone.
+    '''
+    from map.locks import single_flight
+    efn = find_scaled_file(fn)
+    if efn is not None:
+        return efn
+    wfn = writable_scaled_filename(fn)
+    return single_flight(('scaled', wfn), lambda: create(wfn),
+                         lockfn=wfn + '.lock',
+                         cached=lambda: find_scaled_file(fn),
+                         timeout=settings.HARAKIRI / 2)
@@ -1,3 +1,173 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+def to_int64(v):
+    # Python int with bit 63 set -> negative int64 value
+    if v >= (1 << 63):
+        v -= (1 << 64)
+    return v
+
+def random_masks(rng, n, bits):
+    '''*n* int64 masks, each with a random few of *bits* set.'''
+    import numpy as np
+    masks = []
+    for i in range(n):
+        v = 0
+        for b in rng.choice(bits, size=rng.randint(0, 4), replace=False):
+            v |= (1 << int(b))
+        masks.append(to_int64(v))
+    return np.array(masks, np.int64)
+
+def row_bit_names(val, bitnames):
+    # The per-row bit decoding that the catalog endpoints used to do.
+    bits = []
+    for bit in range(64):
+        if (1 << bit) & val:
+            bits.append(bit)
+    return [n for n in [bitnames.get(b) for b in bits] if n is not None]
+
+class TargetNamesTest(SimpleTestCase):
+    '''
+    The DESI target name & color functions decode each distinct
+    combination of bitmasks once (decode_unique); check that they give
+    the same results as decoding every row.
+    '''
+    def target_table(self, n=500, seed=42):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        rng = np.random.RandomState(seed)
+        T = fits_table()
+        # named bits, including the veto pairs, and unnamed ones
+        T.desi_target = random_masks(rng, n, [0, 1, 2, 8, 9, 10, 16, 17, 18, 20,
+                                              32, 36, 45, 60, 61, 63])
+        T.bgs_target = random_masks(rng, n, [0, 1, 3, 8, 9, 16, 17, 40, 41, 63])
+        T.mws_target = random_masks(rng, n, [0, 1, 2, 6, 14, 16, 30])
+        T.scnd_target = random_masks(rng, n, [0, 1, 9, 38, 50])
+        T.cmx_target = random_masks(rng, n, [0, 1, 2, 3, 8, 9, 17, 32, 63])
+        T.objtype = np.array(['TGT', 'SKY', 'BAD', ''])[rng.randint(0, 4, size=n)]
+        T.sv1_desi_target = T.desi_target
+        T.sv1_bgs_target = T.bgs_target
+        T.sv1_mws_target = T.mws_target
+        T.sv1_scnd_target = T.scnd_target
+        return T
+
+    def test_color_names(self):
+        from map.cats import (desitarget_color_names, desi_bitnames, bgs_bitnames,
+                              mws_bitnames, bitnames_veto)
+        T = self.target_table()
+        names,colors = desitarget_color_names(T)
+        self.assertEqual(len(names), len(T))
+        for i in range(len(T)):
+            bitnames = (row_bit_names(int(T.desi_target[i]), desi_bitnames) +
+                        row_bit_names(int(T.bgs_target[i]), bgs_bitnames) +
+                        row_bit_names(int(T.mws_target[i]), mws_bitnames))
+            for name in bitnames[:]:
+                if any([b in bitnames for b in bitnames_veto.get(name, [])]):
+                    bitnames.remove(name)
+            nn = ' '.join(bitnames)
+            cc = 'white'
+            if 'QSO' in nn:
+                cc = 'cyan'
+            elif 'LRG' in nn:
+                cc = 'red'
+            elif 'ELG' in nn:
+                cc = 'gray'
+            elif 'BGS' in nn:
+                cc = 'orange'
+            self.assertEqual(names[i], ', '.join(bitnames))
+            self.assertEqual(colors[i], cc)
+
+        # veto rules
+        T = T[:3]
+        T.desi_target[:] = [(1 << 1) | (1 << 17), (1 << 17), (1 << 60)]
+        T.bgs_target[:] = [0, 0, (1 << 0) | (1 << 8)]
+        T.mws_target[:] = 0
+        names,colors = desitarget_color_names(T)
+        self.assertEqual(names, ['ELG', 'ELG_SOUTH', 'BGS_FAINT'])
+        self.assertEqual(colors, ['gray', 'gray', 'orange'])
+
+    def test_sv1_names(self):
+        from map.cats import (desitarget_sv1_names, sv1_desi_bitnames, sv1_bgs_bitnames,
+                              sv1_mws_bitnames, sv1_scnd_bitnames)
+        T = self.target_table()
+        names = desitarget_sv1_names(T)
+        self.assertEqual(len(names), len(T))
+        for i in range(len(T)):
+            desi_target = int(T.sv1_desi_target[i])
+            bitnames = (row_bit_names(desi_target, sv1_desi_bitnames) +
+                        row_bit_names(int(T.sv1_bgs_target[i]), sv1_bgs_bitnames) +
+                        row_bit_names(int(T.sv1_mws_target[i]), sv1_mws_bitnames) +
+                        row_bit_names(int(T.sv1_scnd_target[i]), sv1_scnd_bitnames))
+            if T.objtype[i] == 'SKY':
+                bitnames.append('SKY')
+            if T.objtype[i] == 'BAD':
+                bitnames.append('BAD')
+            if len(bitnames) == 0:
+                bitnames.append('0x%x' % desi_target)
+            self.assertEqual(names[i], ', '.join(bitnames))
+
+        # without objtype and optional target columns; unnamed bits
+        T = T[:3]
+        T.delete_column('objtype')
+        T.delete_column('sv1_scnd_target')
+        T.sv1_desi_target[:] = [(1 << 20), to_int64(1 << 63), 0]
+        T.sv1_bgs_target[:] = 0
+        T.sv1_mws_target[:] = 0
+        self.assertEqual(desitarget_sv1_names(T),
+                         ['0x100000', '-0x8000000000000000', '0x0'])
+
+    def test_cmx_names(self):
+        from map.cats import desitarget_cmx_names, desi_cmx_color_names, cmx_bitnames
+        T = self.target_table()
+        names = desitarget_cmx_names(T)
+        cnames,colors = desi_cmx_color_names(T)
+        for i in range(len(T)):
+            bitnames = row_bit_names(int(T.cmx_target[i]), cmx_bitnames)
+            if T.objtype[i] == 'SKY':
+                bitnames.append('SKY')
+            if T.objtype[i] == 'BAD':
+                bitnames.append('BAD')
+            self.assertEqual(names[i], ', '.join(bitnames))
+
+            bits = T.cmx_target[i]
+            bitnames = []
+            for bitval,name in [(0x1, 'STD_GAIA'), (0x2, 'SV0_STD_BRIGHT'),
+                                (0x4, 'STD_TEST'), (0x8, 'CALSPEC'),
+                                (0x100, 'SV0_BGS'), (0x200, 'SV0_MWS'),]:
+                if bits & bitval:
+                    bitnames.append(name)
+            nn = ' '.join(bitnames)
+            cc = 'white'
+            if 'BGS' in nn:
+                cc = 'orange'
+            elif 'MWS' in nn:
+                cc = 'cyan'
+            self.assertEqual(cnames[i], nn)
+            self.assertEqual(colors[i], cc)
+
+    def test_decode_unique_empty(self):
+        from map.cats import decode_unique
+        self.assertEqual(decode_unique([[], []], lambda a,b: a), [])
+
+class SmoothAndBinTest(SimpleTestCase):
+    '''
+    map.downsample.smooth_and_bin should match a sigma=1 Gaussian
+    filter followed by 2x2 binning.
+    '''
+    def reference(self, img):
+        from scipy.ndimage import gaussian_filter
+        H,W = img.shape
+        img = gaussian_filter(img[:H//2*2, :W//2*2].astype(float), 1.)
+        return (img[::2,::2] + img[1::2,::2] + img[1::2,1::2] + img[::2,1::2]) / 4.
+
+    def test_smooth_and_bin(self):
+        import numpy as np
+        from map.downsample import smooth_and_bin
+        rng = np.random.RandomState(42)
+        for shape,block in [((64, 48), 512), ((37, 50), 4), ((9, 11), 1), ((2, 2), 512)]:
+            img = rng.normal(size=shape).astype(np.float32) * 100.
+            out = smooth_and_bin(img, block=block)
+            ref = self.reference(img)
+            self.assertEqual(out.dtype, np.float32)
+            self.assertEqual(out.shape, ref.shape)
+            self.assertTrue(np.allclose(out, ref, rtol=1e-5, atol=1e-4),
+                            'shape %s: max diff %g' % (shape, np.abs(out - ref).max()))
@@ -0,0 +1,165 @@
+'''
+Storage for pre-rendered JPEG map tiles.
+
+MapLayer.get_tile() and render-tiles.py read and write tiles through a
+tile store, selected by settings.TILE_STORE:
+
+'files': one JPEG per tile, <tiledir>/<ver>/<zoom>/<x>/<y>.jpg
+  (the original layout).
+
+'sqlite': MBTiles-style SQLite archives, one per tile version and band
+  of settings.TILE_STORE_ZOOMS_PER_FILE zoom levels, eg
+  <tiledir>/<ver>/tiles-z12-15.mbtiles.  Writes are atomic
+  transactions and the databases are in WAL mode, so readers are not
+  blocked by (one-at-a-time) writers from other processes.
+'''
+from __future__ import print_function
+import os
+import threading
+import time
+
+from viewer import settings
+from map.utils import trymakedirs, send_file, send_data, oneyear
+
+class DirectoryTileStore(object):
+    '''One JPEG file per tile.'''
+    def __init__(self, tiledir):
+        self.tiledir = tiledir
+
+    def get_filename(self, ver, zoom, x, y):
+        return os.path.join(self.tiledir,
+                            '%i' % ver, '%i' % zoom, '%i' % x, '%i.jpg' % y)
+
+    def has_tile(self, ver, zoom, x, y):
+        return os.path.exists(self.get_filename(ver, zoom, x, y))
+
+    def get(self, ver, zoom, x, y):
+        '''Returns the JPEG data for a tile, or None.'''
+        fn = self.get_filename(ver, zoom, x, y)
+        try:
+            with open(fn, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def send_tile(self, ver, zoom, x, y, modsince=None, filename=None):
+        '''Returns an HTTP response for a stored tile, or None.'''
+        fn = self.get_filename(ver, zoom, x, y)
+        if not os.path.exists(fn):
+            return None
+        return send_file(fn, 'image/jpeg', expires=oneyear, modsince=modsince,
+                         filename=filename)
+
+    def put(self, ver, zoom, x, y, data):
+        import tempfile
+        fn = self.get_filename(ver, zoom, x, y)
+        trymakedirs(fn)
+        f,tmpfn = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(fn))
+        os.write(f, data)
+        os.close(f)
+        os.chmod(tmpfn, 0o644)
+        os.rename(tmpfn, fn)
+
+class SqliteTileStore(object):
+    '''MBTiles-style SQLite archives, one per (version, zoom band).'''
+    def __init__(self, tiledir, zooms_per_file=4):
+        self.tiledir = tiledir
+        self.zooms_per_file = max(1, zooms_per_file)
+        # Per-thread (and per-process) open connections
+        self.local = threading.local()
+
+    def get_filename(self, ver, zoom):
+        z0 = zoom - (zoom % self.zooms_per_file)
+        z1 = z0 + self.zooms_per_file - 1
+        return os.path.join(self.tiledir, '%i' % ver,
+                            'tiles-z%i-%i.mbtiles' % (z0, z1))
+
+    def get_db(self, fn, create=False):
+        import sqlite3
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.dbs = {}
+        db = self.local.dbs.get(fn)
+        if db is not None:
+            return db
+        if not create and not os.path.exists(fn):
+            return None
+        if create:
+            trymakedirs(fn)
+        # Wait (rather than fail) while another process is writing
+        db = sqlite3.connect(fn, timeout=60.)
+        if create:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, '
+                           'tile_column INTEGER, tile_row INTEGER, tile_data BLOB, '
+                           'mtime REAL, '
+                           'PRIMARY KEY (zoom_level, tile_column, tile_row))')
+                db.execute('CREATE TABLE IF NOT EXISTS metadata '
+                           '(name TEXT PRIMARY KEY, value TEXT)')
+                db.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'jpg')")
+        self.local.dbs[fn] = db
+        return db
+
+    def get_row(self, zoom, y):
+        # MBTiles rows count up from the south (TMS convention)
+        return (1 << zoom) - 1 - y
+
+    def lookup(self, ver, zoom, x, y):
+        import sqlite3
+        db = self.get_db(self.get_filename(ver, zoom))
+        if db is None:
+            return None
+        try:
+            return db.execute('SELECT tile_data, mtime FROM tiles WHERE zoom_level=? '
+                              'AND tile_column=? AND tile_row=?',
+                              (zoom, x, self.get_row(zoom, y))).fetchone()
+        except sqlite3.OperationalError:
+            # eg, database created but tables not yet
+            return None
+
+    def has_tile(self, ver, zoom, x, y):
+        return self.lookup(ver, zoom, x, y) is not None
+
+    def get(self, ver, zoom, x, y):
+        '''Returns the JPEG data for a tile, or None.'''
+        r = self.lookup(ver, zoom, x, y)
+        if r is None:
+            return None
+        return bytes(r[0])
+
+    def send_tile(self, ver, zoom, x, y, modsince=None, filename=None):
+        '''Returns an HTTP response for a stored tile, or None.'''
+        r = self.lookup(ver, zoom, x, y)
+        if r is None:
+            return None
+        data,mtime = r
+        return send_data(bytes(data), 'image/jpeg', mtime, expires=oneyear,
+                         modsince=modsince, filename=filename)
+
+    def put(self, ver, zoom, x, y, data):
+        import sqlite3
+        db = self.get_db(self.get_filename(ver, zoom), create=True)
+        with db:
+            db.execute('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?)',
+                       (zoom, x, self.get_row(zoom, y), sqlite3.Binary(data),
+                        time.time()))
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_tile_store(tiledir):
+    '''Returns the (shared) tile store for the given tile directory.'''
+    kind = settings.TILE_STORE
+    key = (kind, tiledir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            if kind == 'files':
+                store = DirectoryTileStore(tiledir)
+            elif kind == 'sqlite':
+                store = SqliteTileStore(tiledir, settings.TILE_STORE_ZOOMS_PER_FILE)
+            else:
+                raise RuntimeError('Unknown TILE_STORE "%s"' % kind)
+            _stores[key] = store
+    return store
@@ -1,6 +1,7 @@
 import numpy as np
 from astrometry.util.miscutils import clip_wcs
 import os
+import threading
 
 oneyear = (3600 * 24 * 365)
 
@@ -24,42 +25,132 @@ def trymakedirs(fn):
         except:
             pass
 
-def save_jpeg(fn, rgb, **kwargs):
-    import pylab as plt
-    import tempfile
-    f,tempfn = tempfile.mkstemp(suffix='.png')
-    os.close(f)
-    plt.imsave(tempfn, rgb, **kwargs)
-    cmd = 'pngtopnm %s | pnmtojpeg -quality 90 > %s' % (tempfn, fn)
-    os.system(cmd)
-    os.unlink(tempfn)
+_pool = None
+_pool_pid = None
+_pool_local = threading.local()
+
+def _pool_worker_init():
+    _pool_local.in_pool = True
+
+def pool_map(func, args, threads=1):
+    '''
+    Runs func(arg) for each element of *args* on a shared, per-process
+    thread pool of (at most) *threads* threads, and returns the results in order.
+
+    Calls made from inside a pool worker (eg, rendering a scaled image
+    from within a brick read) run serially, so recursion cannot deadlock
+    the pool.
+    '''
+    global _pool, _pool_pid
+    args = list(args)
+    if (threads <= 1 or len(args) <= 1 or
+        getattr(_pool_local, 'in_pool', False)):
+        return [func(a) for a in args]
+    # Re-create the pool after a fork (uwsgi workers, multiproc)
+    if _pool is None or _pool_pid != os.getpid():
+        from concurrent.futures import ThreadPoolExecutor
+        _pool = ThreadPoolExecutor(max_workers=threads,
+                                   initializer=_pool_worker_init)
+        _pool_pid = os.getpid()
+    futures = [_pool.submit(func, a) for a in args]
+    return [f.result() for f in futures]
+
+def rgb_to_uint8(rgb, cmap=None, vmin=None, vmax=None, origin=None):
+    '''
+    Quantizes an image to an H x W x 3 uint8 array the way matplotlib's
+    imsave does: float RGB(A) in [0,1] is scaled by 255 and truncated;
+    uint8 passes through; 2-D images go through the colormap *cmap*
+    (with *vmin*, *vmax*).  Any alpha channel is dropped.
+    '''
+    rgb = np.asarray(rgb)
+    if rgb.ndim == 2:
+        import matplotlib.cm
+        sm = matplotlib.cm.ScalarMappable(cmap=cmap)
+        sm.set_clim(vmin, vmax)
+        rgb = sm.to_rgba(rgb, bytes=True)
+    elif rgb.dtype != np.uint8:
+        rgb = (np.clip(rgb, 0., 1.) * 255).astype(np.uint8)
+    rgb = rgb[:,:,:3]
+    if origin == 'lower':
+        rgb = rgb[::-1,:,:]
+    return np.ascontiguousarray(rgb)
+
+def save_jpeg(fn, rgb, quality=90, **kwargs):
+    '''
+    Encodes *rgb* (as for matplotlib's imsave; *kwargs* are passed to
+    rgb_to_uint8) as JPEG, writing to *fn*, a filename or file-like object.
+    '''
+    from PIL import Image
+    img = Image.fromarray(rgb_to_uint8(rgb, **kwargs), 'RGB')
+    img.save(fn, format='JPEG', quality=quality)
 
 def send_file(fn, content_type, unlink=False, modsince=None, expires=3600,
               filename=None):
-    import datetime
-    from django.http import HttpResponseNotModified, StreamingHttpResponse
+    from django.http import StreamingHttpResponse
     '''
     modsince: If-Modified-Since header string from the client.
     '''
     st = os.stat(fn)
+    if is_not_modified(st.st_mtime, modsince):
+        if unlink:
+            os.unlink(fn)
+        from django.http import HttpResponseNotModified
+        return HttpResponseNotModified()
     f = open(fn, 'rb')
     if unlink:
         os.unlink(fn)
-    # file was last modified...
-    lastmod = datetime.datetime.fromtimestamp(st.st_mtime)
-
-    if modsince:
-        #print('If-modified-since:', modsince #Sat, 22 Nov 2014 01:12:39 GMT)
-        ifmod = datetime.datetime.strptime(modsince, '%a, %d %b %Y %H:%M:%S %Z')
-        #print('Parsed:', ifmod)
-        #print('Last mod:', lastmod)
-        dt = (lastmod - ifmod).total_seconds()
-        if dt < 1:
-            return HttpResponseNotModified()
-
     res = StreamingHttpResponse(f, content_type=content_type)
     # res['Cache-Control'] = 'public, max-age=31536000'
     res['Content-Length'] = st.st_size
+    set_cache_headers(res, st.st_mtime, expires, filename)
+    return res
+
+def send_data(data, content_type, mtime, modsince=None, expires=3600,
+              filename=None):
+    '''
+    Like send_file, for in-memory *data* last modified at (unix time) *mtime*.
+    '''
+    from django.http import HttpResponse, HttpResponseNotModified
+    if is_not_modified(mtime, modsince):
+        return HttpResponseNotModified()
+    res = HttpResponse(data, content_type=content_type)
+    res['Content-Length'] = len(data)
+    set_cache_headers(res, mtime, expires, filename)
+    return res
+
+_blank_tile = None
+
+def send_blank_tile(modsince=None, filename=None):
+    '''
+    Returns static/blank.jpg (kept in memory) as an HTTP response, rather
+    than a redirect to it.
+    '''
+    global _blank_tile
+    if _blank_tile is None:
+        from viewer import settings
+        fn = os.path.join(settings.STATIC_ROOT, 'blank.jpg')
+        with open(fn, 'rb') as f:
+            _blank_tile = (f.read(), os.path.getmtime(fn))
+    data,mtime = _blank_tile
+    return send_data(data, 'image/jpeg', mtime, modsince=modsince,
+                     filename=filename)
+
+def is_not_modified(mtime, modsince):
+    import datetime
+    if not modsince:
+        return False
+    # file was last modified...
+    lastmod = datetime.datetime.fromtimestamp(mtime)
+    #print('If-modified-since:', modsince #Sat, 22 Nov 2014 01:12:39 GMT)
+    ifmod = datetime.datetime.strptime(modsince, '%a, %d %b %Y %H:%M:%S %Z')
+    #print('Parsed:', ifmod)
+    #print('Last mod:', lastmod)
+    dt = (lastmod - ifmod).total_seconds()
+    return dt < 1
+
+def set_cache_headers(res, mtime, expires, filename):
+    import datetime
+    lastmod = datetime.datetime.fromtimestamp(mtime)
     if filename is not None:
         res['Content-Disposition'] = 'attachment; filename="%s"' % filename
     # expires in an hour?
@@ -68,7 +159,29 @@ def send_file(fn, content_type, unlink=False, modsince=None, expires=3600,
     timefmt = '%a, %d %b %Y %H:%M:%S GMT'
     res['Expires'] = then.strftime(timefmt)
     res['Last-Modified'] = lastmod.strftime(timefmt)
-    return res
+
+def ra_ranges_overlap(ralo, rahi, ra1, ra2):
+    x1 = np.cos(np.deg2rad(ralo))
+    y1 = np.sin(np.deg2rad(ralo))
+
+    x2 = np.cos(np.deg2rad(rahi))
+    y2 = np.sin(np.deg2rad(rahi))
+
+    x3 = np.cos(np.deg2rad(ra1))
+    y3 = np.sin(np.deg2rad(ra1))
+
+    x4 = np.cos(np.deg2rad(ra2))
+    y4 = np.sin(np.deg2rad(ra2))
+
+    #cw31 = x1*y3 - x3*y1
+    cw32 = x2*y3 - x3*y2
+
+    cw41 = x1*y4 - x4*y1
+    #cw42 = x2*y4 - x4*y2
+
+    #print('3:', cw31, cw32)
+    #print('4:', cw41, cw42)
+    return np.logical_and(cw32 <= 0, cw41 >= 0)
 
 class RARange(object):
     def __init__(self, rlo, rhi):
@@ -125,7 +238,7 @@ class MercWCSWrapper(object):
     def __getattr__(self, name):
         return getattr(self.wcs, name)
     def __setattr__(self, name, val):
-        if name in ['wcs', 'wrap']:
+        if name in ['wcs', 'wrap', 'tile']:
             self.__dict__[name] = val
             return
         return setattr(self.wcs, name, val)
@@ -155,9 +268,29 @@ def get_tile_wcs(zoom, x, y):
                                   zoomscale, W, H, 1)
     if wcs is not None:
         wcs = MercWCSWrapper(wcs, 2**zoom * W)
+        # (zoom, x, y, n): which block of tiles this is
+        wcs.tile = (zoom, x, y, 1)
 
     return wcs, W, H, zoomscale, zoom,x,y
 
+def get_metatile_wcs(zoom, x0, y0, n):
+    '''
+    Mercator WCS covering the *n* x *n* block of tiles whose top-left
+    tile is (x0, y0); tile (x0+i, y0+j) is pixels [256*j : 256*(j+1),
+    256*i : 256*(i+1)] of it.
+    '''
+    from astrometry.util.util import anwcs_create_mercator_2
+    zoomscale = 2.**zoom
+    W,H = 256,256
+    rx = (zoomscale/2 - x0) * W
+    ry = (zoomscale/2 - y0) * H
+    wcs = anwcs_create_mercator_2(180., 0., rx + 0.5, ry + 0.5,
+                                  zoomscale, n*W, n*H, 1)
+    if wcs is not None:
+        wcs = MercWCSWrapper(wcs, 2**zoom * W)
+        wcs.tile = (zoom, x0, y0, n)
+    return wcs
+
 
 
 def tiles_touching_wcs(wcs, zoom):
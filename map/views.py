@@ -19,8 +19,9 @@ except:
 
 from django import forms
 from viewer import settings
-from map.utils import (get_tile_wcs, trymakedirs, save_jpeg, ra2long, ra2long_B,
-                       send_file, oneyear)
+from map.utils import (get_tile_wcs, get_metatile_wcs, trymakedirs, save_jpeg,
+                       ra2long, ra2long_B, send_file, oneyear, pool_map,
+                       ra_ranges_overlap)
 from map.coadds import get_scaled
 from map.cats import get_random_galaxy, get_desi_tile_radec
 
@@ -402,6 +403,10 @@ def _index(req,
 
     #print('Small catalog URL:', smallcaturl)
 
+    import json
+    from map.catpyramid import catalog_min_zooms
+    catalog_min_zoom = json.dumps(catalog_min_zooms())
+
     # includes a leaflet pattern for subdomains
     tileurl = settings.TILE_URL
 
@@ -510,6 +515,7 @@ def _index(req,
                 hostname_url=hostname_url,
                 uploadurl=uploadurl,
                 caturl=caturl, bricksurl=bricksurl,
+                catalog_min_zoom=catalog_min_zoom,
                 smallcaturl=smallcaturl,
                 namequeryurl=namequeryurl,
                 ccdsurl=ccdsurl,
@@ -788,6 +794,11 @@ class MapLayer(object):
         self.basedir = os.path.join(settings.DATA_DIR, self.name)
         self.tiledir = os.path.join(settings.DATA_DIR, 'tiles', self.name)
         self.scaleddir = os.path.join(settings.DATA_DIR, 'scaled', self.name)
+        # scale -> BrickIndex
+        self.brick_indexes = {}
+        # cached result of get_fused_layer()
+        self.fused_layer = None
+        self.fused_layer_found = False
 
     def has_cutouts(self):
         return False
@@ -804,6 +815,22 @@ class MapLayer(object):
     def get_bricks(self):
         pass
 
+    def get_bricks_for_scale(self, scale):
+        return self.get_bricks()
+
+    def get_brick_index(self, scale):
+        '''
+        Returns a (cached) spatial index over get_bricks_for_scale(scale).
+        '''
+        from map.brickindex import BrickIndex
+        if scale is None:
+            scale = 0
+        index = self.brick_indexes.get(scale)
+        if index is None:
+            index = BrickIndex(self.get_bricks_for_scale(scale))
+            self.brick_indexes[scale] = index
+        return index
+
     def get_bands(self):
         pass
 
@@ -820,6 +847,82 @@ class MapLayer(object):
                               '%i' % ver, '%i' % zoom, '%i' % x, '%i.jpg' % y)
         return tilefn
 
+    def get_coverage_bricks(self):
+        '''
+        Returns the bricks (with ra1,ra2,dec1,dec2 boxes) outside of which
+        this layer has no data, for map/coverage.py, or None if unknown.
+        '''
+        bricks = self.get_bricks_for_scale(0)
+        if bricks is None or len(bricks) == 0:
+            return None
+        cols = bricks.get_columns()
+        if not all([c in cols for c in ['ra1', 'ra2', 'dec1', 'dec2']]):
+            return None
+        bands = self.get_bands()
+        if bands is not None and len(bands) > 0:
+            has = ['has_%s' % band for band in bands]
+            if all([h in cols for h in has]):
+                import numpy as np
+                bricks = bricks[np.any([bricks.get(h) for h in has], axis=0)]
+        return bricks
+
+    def get_coverage_filename(self, zoom):
+        return os.path.join(self.tiledir, 'coverage-z%i.fits' % zoom)
+
+    def get_derived_dir(self):
+        '''
+        Where images derived from this layer's data files are cached (see
+        get_derived_image): the scaled-image directory, or under
+        READ_ONLY_CACHE_DIR if we cannot write there.
+        '''
+        if settings.READ_ONLY_BASEDIR:
+            return os.path.join(settings.READ_ONLY_CACHE_DIR, self.name)
+        return self.scaleddir
+
+    def get_derived_image(self, fn, derivedfn, make_image, compress=False):
+        '''
+        Returns *derivedfn*, after writing the image returned by
+        make_image() to it if it does not exist or is older than data
+        file *fn*.  Only one thread / process at a time does that.  With
+        *compress*, the image is written (losslessly) tile-compressed,
+        in HDU 1.
+        '''
+        import tempfile
+        import fitsio
+        from map.locks import single_flight
+        from map.scaledcache import scaled_file_written
+        def cached():
+            try:
+                if os.stat(derivedfn).st_mtime >= os.stat(fn).st_mtime:
+                    return derivedfn
+            except OSError:
+                pass
+            return None
+        if cached() is not None:
+            return derivedfn
+        def create():
+            img = make_image()
+            trymakedirs(derivedfn)
+            f,tmpfn = tempfile.mkstemp(suffix='.fits.tmp', dir=os.path.dirname(derivedfn))
+            os.close(f)
+            os.unlink(tmpfn)
+            if compress:
+                # (qlevel=0: no quantization)
+                fitsio.write(tmpfn, img, compress='GZIP_2', qlevel=0, clobber=True)
+            else:
+                fitsio.write(tmpfn, img, clobber=True)
+            os.rename(tmpfn, derivedfn)
+            print('Wrote', derivedfn)
+            scaled_file_written(derivedfn)
+            return derivedfn
+        return single_flight(('derived', derivedfn), create, lockfn=derivedfn + '.lock',
+                             cached=cached, timeout=settings.HARAKIRI / 2)
+
+    def get_tile_store(self, ver, zoom, x, y):
+        '''Where pre-rendered JPEG tile (ver, zoom, x, y) lives; see map/tilestore.py'''
+        from map.tilestore import get_tile_store
+        return get_tile_store(self.tiledir)
+
     def get_scale(self, zoom, x, y, wcs):
         import numpy as np
         from astrometry.util.starutil_numpy import arcsec_between
@@ -865,8 +968,8 @@ class MapLayer(object):
         d2 = degrees_between(rr[1], dd[1], rr[2], dd[2])
         rad = 1.01 * max(d1,d2)/2.
 
-        B = self.bricks_within_range(rc, dc, rad, scale=scale)
-        if B is None:
+        I = self.brick_indices_within_range(rc, dc, rad, scale=scale)
+        if I is None:
             # Previously...
             '''Assumes WCS is axis-aligned and normal parity'''
             rlo,d = wcs.pixelxy2radec(W, H/2)[-2:]
@@ -878,76 +981,35 @@ class MapLayer(object):
             #print('RA,Dec bounds of WCS:', rlo,rhi,dlo,dhi)
             return self.bricks_touching_radec_box(rlo, rhi, dlo, dhi, scale=scale)
 
-        from astrometry.util.miscutils import polygons_intersect
-        import numpy as np
-
-        keep = []
-        xl,xm,xh = 0.5, (W+1)/2., W+0.5
-        yl,ym,yh = 0.5, (H+1)/2., H+0.5
-        xy = np.array([[xl,yl], [xm, yl], [xh,yl], [xh,ym], [xh,yh],
-                       [xm,yh], [xl,yh], [xl,ym], [xl,yl]])
-
+        # Keep the bricks whose outlines overlap the WCS.
+        index = self.get_brick_index(scale)
+        I = index.touching_wcs(wcs, I,
+                               lambda brick: self.get_scaled_wcs(brick, None, scale))
+        if len(I) == 0:
+            return None
+        B = index.bricks[I]
         if debug_ps is not None:
             plt.clf()
-            plt.plot(xy[:,0], xy[:,1], 'k-')
-
-        for i,brick in enumerate(B):
-            bwcs = self.get_scaled_wcs(brick, None, scale)
-            bh,bw = bwcs.shape
-            # walk the boundary
-            xl,xm,xh = 0.5, (bw+1)/2., bw+0.5
-            yl,ym,yh = 0.5, (bh+1)/2., bh+0.5
-            rr,dd = bwcs.pixelxy2radec([xl, xm, xh, xh, xh, xm, xl, xl, xl],
-                                       [yl, yl, yl, ym, yh, yh, yh, ym, yl])
-            #try:
-            #    ok,bx,by = wcs.radec2pixelxy(rr, dd, wrap=False)
-            #except:
-            ok,bx,by = wcs.radec2pixelxy(rr, dd)
-
-            # xx1 = np.linspace(xl, xh, 100)
-            # yy1 = np.array([yl]*100)
-            # xx2 = np.array([xh]*100)
-            # yy2 = np.linspace(yl, yh, 100)
-            # xx3 = np.linspace(xh, xl, 100)
-            # yy3 = np.array([yh]*100)
-            # xx4 = np.array([xl]*100)
-            # yy4 = np.linspace(yh, yl, 100)
-            # rr,dd = bwcs.pixelxy2radec(np.hstack((xx1,xx2,xx3,xx4)), np.hstack((yy1,yy2,yy3,yy4)))
-            # try:
-            #     ok,bx,by = wcs.radec2pixelxy(rr, dd, wrap=False)
-            # except:
-            #     ok,bx,by = wcs.radec2pixelxy(rr, dd)
-
-            bx = bx[ok]
-            by = by[ok]
-            if len(bx) == 0:
-                continue
-            if polygons_intersect(xy, np.vstack((bx, by)).T):
-                if debug_ps is not None:
-                    plt.plot(bx, by, '-')
-                keep.append(i)
-            #else:
-            #    plt.plot(bx, by, 'r-')
-        if debug_ps is not None:
+            plt.plot([0.5, W+0.5, W+0.5, 0.5, 0.5], [0.5, 0.5, H+0.5, H+0.5, 0.5], 'k-')
+            rr,dd = index.get_outlines(I, None)
+            for r,d in zip(rr, dd):
+                ok,bx,by = wcs.radec2pixelxy(r, d)
+                plt.plot(bx, by, '-')
             debug_ps.savefig()
-
-        # print('Looking for bricks touching WCS', wcs)
-        # # DEBUG
-        # if True:
-        #     rlo,d = wcs.pixelxy2radec(W, H/2)[-2:]
-        #     rhi,d = wcs.pixelxy2radec(1, H/2)[-2:]
-        #     r,d1 = wcs.pixelxy2radec(W/2, 1)[-2:]
-        #     r,d2 = wcs.pixelxy2radec(W/2, H)[-2:]
-        #     #print('Approx RA,Dec range', rlo,rhi, 'Dec', d1,d2)
-
-        #print('Bricks within range:', B.brickname)
-        if len(keep) == 0:
-            return None
-        #print('Bricks touching:', B.brickname[np.array(keep)])
-        B.cut(keep)
         return B
 
     def bricks_within_range(self, ra, dec, radius, scale=None):
+        I = self.brick_indices_within_range(ra, dec, radius, scale=scale)
+        if I is None:
+            return None
+        return self.get_brick_index(scale).bricks[I]
+
+    def brick_indices_within_range(self, ra, dec, radius, scale=None):
+        '''
+        Layers that can list the bricks that might touch a circle return
+        their indices in get_brick_index(scale); others return None and
+        get the RA,Dec box query instead.
+        '''
         return None
 
     def bricks_touching_general_wcs(self, wcs, scale=None):
@@ -1011,14 +1073,13 @@ class MapLayer(object):
         return bricks
 
     def get_filename(self, brick, band, scale, tempfiles=None):
+        from map.scaledcache import build_scaled_file
         if scale == 0:
             return self.get_base_filename(brick, band)
         fn = self.get_scaled_filename(brick, band, scale)
         #print('Filename:', fn)
-        if os.path.exists(fn):
-            return fn
-        #print('Creating', fn)
-        fn = self.create_scaled_image(brick, band, scale, fn, tempfiles=tempfiles)
+        fn = build_scaled_file(fn, lambda wfn: self.create_scaled_image(
+            brick, band, scale, wfn, tempfiles=tempfiles))
         if fn is None:
             return None
         if os.path.exists(fn):
@@ -1026,61 +1087,42 @@ class MapLayer(object):
         return None
 
     def create_scaled_image(self, brick, band, scale, fn, tempfiles=None):
-        from scipy.ndimage.filters import gaussian_filter
-        import fitsio
-        import tempfile
-        import numpy as np
-
-        # Read scale-1 image and scale it
-        sourcefn = self.get_filename(brick, band, scale-1)
+        '''
+        Creates scaled image *fn* of *brick*, *band*, together with the
+        other missing scales up to self.maxscale: the highest existing
+        lower scale is read once and the rest of the pyramid computed in
+        memory (see coadds.scaled_pyramid).
+        *fn* is where to write it (see get_filename).
+        '''
+        from map.coadds import scaled_pyramid, write_scaled_image
+        from map.scaledcache import find_scaled_file, writable_scaled_filename
+
+        # Start from the highest scale we already have.
+        srcscale = scale - 1
+        while (srcscale > 0 and
+               find_scaled_file(self.get_scaled_filename(brick, band, srcscale)) is None):
+            srcscale -= 1
+        sourcefn = self.get_filename(brick, band, srcscale)
         if sourcefn is None or not os.path.exists(sourcefn):
             print('create_scaled_image: brick', brick.brickname, 'band', band, 'scale', scale, ': Image source file', sourcefn, 'not found')
             return None
-        ro = settings.READ_ONLY_BASEDIR
-        if ro:
-            print('Read-only; not creating scaled', brick, band, scale)
-            return None
-        img = self.read_image(brick, band, scale-1, None, fn=sourcefn)
-        wcs = self.read_wcs(brick, band, scale-1, fn=sourcefn)
-
-        H,W = img.shape
-        # make even size; smooth down
-        if H % 2 == 1:
-            img = img[:-1,:]
-        if W % 2 == 1:
-            img = img[:,:-1]
-        img = gaussian_filter(img, 1.)
-        # bin
-        I2 = (img[::2,::2] + img[1::2,::2] + img[1::2,1::2] + img[::2,1::2])/4.
-        I2 = I2.astype(np.float32)
-        # include the even size clip; this may be a no-op
-        H,W = img.shape
-        wcs = wcs.get_subimage(0, 0, W, H)
-        wcs2 = wcs.scale(0.5)
-
-        dirnm = os.path.dirname(fn)
-        if ro:
-            dirnm = None
-        hdr = fitsio.FITSHDR()
-        wcs2.add_to_header(hdr)
-        trymakedirs(fn)
-        f,tmpfn = tempfile.mkstemp(suffix='.fits.tmp', dir=dirnm)
-        os.close(f)
-        os.unlink(tmpfn)
-        fitsio.write(tmpfn, I2, header=hdr, clobber=True)
-        if not ro:
-            os.rename(tmpfn, fn)
-            info('Wrote', fn)
-        else:
-            print('Leaving temp file for get_scaled:', fn, '->', tmpfn)
-            # import traceback
-            # for line in traceback.format_stack():
-            #     print(line.strip())
-            if tempfiles is not None:
-                tempfiles.append(tmpfn)
-            fn = tmpfn
+        img = self.read_image(brick, band, srcscale, None, fn=sourcefn)
+        wcs = self.read_wcs(brick, band, srcscale, fn=sourcefn)
+
+        s = srcscale
+        for img,wcs in scaled_pyramid(img, wcs, max(scale, self.maxscale) - srcscale):
+            s += 1
+            if s == scale:
+                sfn = fn
+            else:
+                sfn = self.get_scaled_filename(brick, band, s)
+                if find_scaled_file(sfn) is not None:
+                    continue
+                sfn = writable_scaled_filename(sfn)
+            write_scaled_image(sfn, img, wcs)
+            print('Wrote', sfn)
         return fn
-        
+
     def get_base_filename(self, brick, band, **kwargs):
         pass
 
@@ -1095,34 +1137,42 @@ class MapLayer(object):
         return 0
     
     def read_image(self, brick, band, scale, slc, fn=None):
-        import fitsio
+        from map.filecache import read_image
         if fn is None:
             fn = self.get_filename(brick, band, scale)
         debug('Reading image from', fn)
         ext = self.get_fits_extension(scale, fn)
-        f = fitsio.FITS(fn)[ext]
-        if slc is None:
-            return f.read()
-        img = f[slc]
-        return img
+        return read_image(fn, ext, slc)
 
     def read_wcs(self, brick, band, scale, fn=None):
         from map.coadds import read_tan_wcs
+        from map.filecache import get_wcs
         if fn is None:
             fn = self.get_filename(brick, band, scale)
         if fn is None:
             return None
         ext = self.get_fits_extension(scale, fn)
-        return read_tan_wcs(fn, ext)
+        return get_wcs(fn, ext, read_tan_wcs)
 
     def get_pixel_coord_type(self, scale):
         import numpy as np
         return np.int16
 
     def render_into_wcs(self, wcs, zoom, x, y, bands=None, general_wcs=False,
-                        scale=None, tempfiles=None):
+                        scale=None, tempfiles=None, fused=False, weights=None):
+        '''
+        Renders this layer into the given *wcs*, returning a list of
+        images (one per band), or None if no bricks touch it.
+
+        With *fused*, renders all of get_fused_layers() in the same pass
+        (sharing brick selection and resampling), returning a list of
+        per-band image lists, one per layer.
+
+        If *weights* is a list, the total weight map (over bands) of the
+        rendered image -- zero where no brick pixels landed -- is
+        appended to it; with *fused*, one per layer.
+        '''
         import numpy as np
-        from astrometry.util.resample import resample_with_wcs, OverlapError
 
         #print('render_into_wcs: wcs', wcs, 'zoom,x,y', zoom,x,y, 'general wcs?', general_wcs)
 
@@ -1157,215 +1207,307 @@ class MapLayer(object):
 
         coordtype = self.get_pixel_coord_type(scale)
 
-        rimgs = []
-        for band in bands:
-            rimg = np.zeros((H,W), np.float32)
-            rw   = np.zeros((H,W), np.float32)
+        # Read & resample all (brick, bands) jobs -- in parallel, if
+        # enabled -- then accumulate in order.  If the bands of a brick
+        # share a WCS, they are resampled together.
+        jobs = []
+        shared = self.bands_share_wcs(scale)
+        brickjobs = {}
+        for iband,band in enumerate(bands):
             bandbricks = self.bricks_for_band(bricks, band)
             for brick in bandbricks:
-                brickname = brick.brickname
-                #print('Reading', brickname, 'band', band, 'scale', scale)
-                # call get_filename to possibly generate scaled version
-                fn = self.get_filename(brick, band, scale, tempfiles=tempfiles)
-                print('Reading', brickname, 'band', band, 'scale', scale, '-> fn', fn)
-                if fn is None:
+                if shared and brick.brickname in brickjobs:
+                    brickjobs[brick.brickname][1].append((iband, band))
                     continue
-
-                try:
-                    bwcs = self.read_wcs(brick, band, scale, fn=fn)
-                    if bwcs is None:
-                        print('No such file:', brickname, band, scale, 'fn', fn)
-                        continue
-                except:
-                    print('Failed to read WCS:', brickname, band, scale, 'fn', fn)
-                    savecache = False
-                    import traceback
-                    import sys
-                    traceback.print_exc(None, sys.stdout)
+                job = (brick, [(iband, band)])
+                jobs.append(job)
+                if shared:
+                    brickjobs[brick.brickname] = job
+        threads = settings.RENDER_THREADS
+        if debug_ps is not None:
+            threads = 1
+        def render_one(job):
+            brick, ibands = job
+            return self.resample_brick(wcs, brick, [band for iband,band in ibands],
+                                       scale, target_ra, target_dec,
+                                       coordtype, tempfiles=tempfiles, fused=fused)
+        results = pool_map(render_one, jobs, threads=threads)
+
+        nout = len(self.get_fused_layers()) if fused else 1
+        rimgs = [[np.zeros((H,W), np.float32) for band in bands] for i in range(nout)]
+        rws   = [[np.zeros((H,W), np.float32) for band in bands] for i in range(nout)]
+        for (brick,ibands),bres in zip(jobs, results):
+            if bres is None:
+                continue
+            for (iband,band),res in zip(ibands, bres):
+                if res is None:
                     continue
+                if not fused:
+                    res = [res]
+                for k,r in enumerate(res):
+                    if r is None:
+                        continue
+                    Yo,Xo,resamp,wt = r
+                    rimgs[k][iband][Yo,Xo] += resamp * wt
+                    rws  [k][iband][Yo,Xo] += wt
+
+        for rim,rw in zip(rimgs, rws):
+            for rimg,w in zip(rim, rw):
+                #print('Median image weight:', np.median(w.ravel()))
+                rimg /= np.maximum(w, 1e-18)
+        if weights is not None:
+            weights.extend([sum(rw) for rw in rws])
+        if fused:
+            return rimgs
+        return rimgs[0]
 
-                # Check for pixel overlap area (projecting target WCS edges into this brick)
-                ok,xx,yy = bwcs.radec2pixelxy(target_ra, target_dec)
-                xx = xx.astype(np.int)
-                yy = yy.astype(np.int)
-
-                #print('Brick', brickname, 'band', band, 'shape', bwcs.shape, 'pixel coords', xx, yy)
-
-                imW,imH = int(bwcs.get_width()), int(bwcs.get_height())
-                M = 10
-                xlo = np.clip(xx.min() - M, 0, imW)
-                xhi = np.clip(xx.max() + M, 0, imW)
-                ylo = np.clip(yy.min() - M, 0, imH)
-                yhi = np.clip(yy.max() + M, 0, imH)
-                #print('-- x range', xlo,xhi, 'y range', ylo,yhi)
-                if xlo >= xhi or ylo >= yhi:
-                    print('No pixel overlap')
-                    continue
+    def bands_share_wcs(self, scale):
+        '''
+        Do all bands of a brick (at this *scale*) have the same WCS?  If
+        so, render_into_wcs resamples them together.
+        '''
+        return False
 
-                if debug_ps is not None:
-                    plt.clf()
-                    plt.plot([1,1,imW,imW,1], [1,imH,imH,1,1], 'k-')
-                    plt.plot(xx, yy, 'r-')
-                    plt.plot([xlo,xlo,xhi,xhi,xlo], [ylo,yhi,yhi,ylo,ylo], 'm-')
-                    plt.title('black=brick, red=target')
-                    debug_ps.savefig()
-
-                    plt.clf()
-                    xx1 = np.linspace(1, imW, 100)
-                    yy1 = np.array([1]*100)
-                    xx2 = np.array([imW]*100)
-                    yy2 = np.linspace(1, imH, 100)
-                    xx3 = np.linspace(imW, 1, 100)
-                    yy3 = np.array([imH]*100)
-                    xx4 = np.array([1]*100)
-                    yy4 = np.linspace(imH, 1, 100)
-                    rr,dd = bwcs.pixelxy2radec(np.hstack((xx1,xx2,xx3,xx4)), np.hstack((yy1,yy2,yy3,yy4)))
-                    plt.plot(rr, dd, 'k-')
-                    plt.plot(target_ra, target_dec, 'r-')
-                    xx1 = np.linspace(1, W, 100)
-                    yy1 = np.array([1]*100)
-                    xx2 = np.array([W]*100)
-                    yy2 = np.linspace(1, H, 100)
-                    xx3 = np.linspace(W, 1, 100)
-                    yy3 = np.array([H]*100)
-                    xx4 = np.array([1]*100)
-                    yy4 = np.linspace(H, 1, 100)
-                    rr,dd = wcs.pixelxy2radec(np.hstack((xx1,xx2,xx3,xx4)), np.hstack((yy1,yy2,yy3,yy4)))
-                    plt.plot(rr, dd, 'm-', lw=2, alpha=0.5)
-                    plt.title('black=brick, red=target')
-                    debug_ps.savefig()
-                    
-                    
-
-                subwcs = bwcs.get_subimage(xlo, ylo, xhi-xlo, yhi-ylo)
-                slc = slice(ylo,yhi), slice(xlo,xhi)
-                try:
-                    img = self.read_image(brick, band, scale, slc, fn=fn)
-                except:
-                    print('Failed to read image:', brickname, band, scale, 'fn', fn)
-                    savecache = False
-                    import traceback
-                    import sys
-                    traceback.print_exc(None, sys.stdout)
-                    continue
+    def get_resample_table_filename(self, wcs, brick, band, scale, box):
+        '''
+        Where the table for resampling pixel *box* of *brick* (in *band*)
+        into Mercator tile *wcs* is cached (see map/resampletable.py), or
+        None if it is not.
+        '''
+        tile = getattr(wcs, 'tile', None)
+        if tile is None or settings.RESAMPLE_TABLE_DIR is None:
+            return None
+        from map.resampletable import get_table_filename
+        if self.bands_share_wcs(scale):
+            band = None
+        return get_table_filename(self.name, brick.brickname, band, scale, tile, box)
 
+    def resample_brick(self, wcs, brick, bands, scale, target_ra, target_dec,
+                       coordtype, tempfiles=None, fused=False):
+        '''
+        Reads the part of one brick that overlaps the target *wcs* in
+        each of *bands* (which must share a WCS, if more than one) and
+        resamples them, computing the pixel mapping once.  Returns a list
+        with, for each band, (Yo, Xo, resampled pixels, weight), or None
+        if the brick contributes no pixels in that band; or None if it
+        contributes none at all.
+
+        With *fused*, reads the brick for each of get_fused_layers() and
+        resamples them together, returning, for each band, a list with
+        one such tuple (or None) per layer.
+
+        This is called from render_into_wcs, possibly from a worker thread.
+        '''
+        import numpy as np
+        from astrometry.util.resample import resample_with_wcs, OverlapError
 
-                # DEBUG
-                # sh,sw = subwcs.shape
-                # rr,dd = subwcs.pixelxy2radec([1,1,sw,sw], [1,sh,sh,1])
-                # ok,xx,yy = wcs.radec2pixelxy(rr, dd)
-                # print('Sub-WCS corners -> target pixels', xx.astype(int), yy.astype(int))
+        W = int(wcs.get_width())
+        H = int(wcs.get_height())
 
-                #ok,xx,yy = wcs.radec2pixelxy(target_ra, target_dec)
-                #print('Target_ra,dec to target pix:', xx, yy)
+        brickname = brick.brickname
+        #print('Reading', brickname, 'band', band, 'scale', scale)
+        # call get_filename to possibly generate scaled version
+        fns = []
+        for band in bands:
+            fn = self.get_filename(brick, band, scale, tempfiles=tempfiles)
+            print('Reading', brickname, 'band', band, 'scale', scale, '-> fn', fn)
+            fns.append(fn)
+        B = [i for i,fn in enumerate(fns) if fn is not None]
+        if len(B) == 0:
+            return None
+        band = bands[B[0]]
+        fn = fns[B[0]]
 
-                #rr,dd = bwcs.pixelxy2radec([xlo,xlo,xhi,xhi], [ylo,yhi,yhi,ylo])
-                #ok,xx,yy = wcs.radec2pixelxy(rr, dd)
-                #print('WCS corners -> target pixels', xx.astype(int), yy.astype(int))
+        try:
+            bwcs = self.read_wcs(brick, band, scale, fn=fn)
+            if bwcs is None:
+                print('No such file:', brickname, band, scale, 'fn', fn)
+                return None
+        except:
+            print('Failed to read WCS:', brickname, band, scale, 'fn', fn)
+            import traceback
+            import sys
+            traceback.print_exc(None, sys.stdout)
+            return None
 
-                #print('BWCS shape', bwcs.shape, 'desired subimage shape', yhi-ylo, xhi-xlo,
-                #'subwcs shape', subwcs.shape, 'img shape', img.shape)
-                ih,iw = subwcs.shape
-                assert(np.iinfo(coordtype).max > max(ih,iw))
-                oh,ow = wcs.shape
-                assert(np.iinfo(coordtype).max > max(oh,ow))
+        # Check for pixel overlap area (projecting target WCS edges into this brick)
+        ok,xx,yy = bwcs.radec2pixelxy(target_ra, target_dec)
+        xx = xx.astype(np.int)
+        yy = yy.astype(np.int)
+
+        #print('Brick', brickname, 'band', band, 'shape', bwcs.shape, 'pixel coords', xx, yy)
+
+        imW,imH = int(bwcs.get_width()), int(bwcs.get_height())
+        M = 10
+        xlo = np.clip(xx.min() - M, 0, imW)
+        xhi = np.clip(xx.max() + M, 0, imW)
+        ylo = np.clip(yy.min() - M, 0, imH)
+        yhi = np.clip(yy.max() + M, 0, imH)
+        #print('-- x range', xlo,xhi, 'y range', ylo,yhi)
+        if xlo >= xhi or ylo >= yhi:
+            print('No pixel overlap')
+            return None
 
-                #print('Resampling', img.shape)
-                try:
-                    Yo,Xo,Yi,Xi,[resamp] = resample_with_wcs(wcs, subwcs, [img],
-                                                             intType=coordtype)
-                except OverlapError:
-                    #debug('Resampling exception')
-                    continue
+        if debug_ps is not None:
+            plt.clf()
+            plt.plot([1,1,imW,imW,1], [1,imH,imH,1,1], 'k-')
+            plt.plot(xx, yy, 'r-')
+            plt.plot([xlo,xlo,xhi,xhi,xlo], [ylo,yhi,yhi,ylo,ylo], 'm-')
+            plt.title('black=brick, red=target')
+            debug_ps.savefig()
 
-                #print('Resampling', len(Yo), 'pixels')
+            plt.clf()
+            xx1 = np.linspace(1, imW, 100)
+            yy1 = np.array([1]*100)
+            xx2 = np.array([imW]*100)
+            yy2 = np.linspace(1, imH, 100)
+            xx3 = np.linspace(imW, 1, 100)
+            yy3 = np.array([imH]*100)
+            xx4 = np.array([1]*100)
+            yy4 = np.linspace(imH, 1, 100)
+            rr,dd = bwcs.pixelxy2radec(np.hstack((xx1,xx2,xx3,xx4)), np.hstack((yy1,yy2,yy3,yy4)))
+            plt.plot(rr, dd, 'k-')
+            plt.plot(target_ra, target_dec, 'r-')
+            xx1 = np.linspace(1, W, 100)
+            yy1 = np.array([1]*100)
+            xx2 = np.array([W]*100)
+            yy2 = np.linspace(1, H, 100)
+            xx3 = np.linspace(W, 1, 100)
+            yy3 = np.array([H]*100)
+            xx4 = np.array([1]*100)
+            yy4 = np.linspace(H, 1, 100)
+            rr,dd = wcs.pixelxy2radec(np.hstack((xx1,xx2,xx3,xx4)), np.hstack((yy1,yy2,yy3,yy4)))
+            plt.plot(rr, dd, 'm-', lw=2, alpha=0.5)
+            plt.title('black=brick, red=target')
+            debug_ps.savefig()
 
-                bmask = self.get_brick_mask(scale, bwcs, brick)
-                if bmask is not None:
-                    # Assume bmask is a binary mask as large as the bwcs.
-                    # Shift the Xi,Yi coords
-                    I = np.flatnonzero(bmask[Yi+ylo, Xi+xlo])
-                    if len(I) == 0:
-                        continue
-                    Yo = Yo[I]
-                    Xo = Xo[I]
-                    Yi = Yi[I]
-                    Xi = Xi[I]
-                    resamp = resamp[I]
-
-                    #print('get_brick_mask:', len(Yo), 'pixels')
-
-                # print('xlo xhi', xlo,xhi, 'ylo yhi', ylo,yhi,
-                #       'image shape', img.shape,
-                #       'Xi range', Xi.min(), Xi.max(),
-                #       'Yi range', Yi.min(), Yi.max(),
-                #       'subwcs shape', subwcs.shape)
-
-                #if not np.all(np.isfinite(img[Yi,Xi])):
-                if not np.all(np.isfinite(resamp)):
-                    ok, = np.nonzero(np.isfinite(resamp))
-                    Yo = Yo[ok]
-                    Xo = Xo[ok]
-                    Yi = Yi[ok]
-                    Xi = Xi[ok]
-                    resamp = resamp[ok]
-
-                ok = self.filter_pixels(scale, img, wcs, subwcs, Yo,Xo,Yi,Xi)
-                if ok is not None:
-                    Yo = Yo[ok]
-                    Xo = Xo[ok]
-                    Yi = Yi[ok]
-                    Xi = Xi[ok]
-                    resamp = resamp[ok]
-
-                wt = self.get_pixel_weights(band, brick, scale)
-
-                #rimg[Yo,Xo] += img[Yi,Xi] * wt
-                rimg[Yo,Xo] += resamp * wt
-                rw  [Yo,Xo] += wt
-
-                #print('Coadded', len(Yo), 'pixels;', (nz-np.sum(rw==0)), 'new')
-
-                if False:
-                    #import pylab as plt
-                    dest = np.zeros(wcs.shape, bool)
-                    dest[Yo,Xo] = True
-                    source = np.zeros(bwcs.shape, bool)
-                    source[Yi + ylo, Xi + xlo] = True
-                    subsource = np.zeros(subwcs.shape, bool)
-                    subsource[Yi, Xi] = True
-                    destval = np.zeros(wcs.shape, float)
-                    destval[Yo,Xo] = img[Yi,Xi]
-                    plt.clf()
-                    plt.subplot(2,3,1)
-                    plt.imshow(dest, interpolation='nearest', origin='lower')
-                    plt.title('dest')
-                    plt.subplot(2,3,2)
-                    plt.imshow(source, interpolation='nearest', origin='lower')
-                    plt.title('source')
-                    plt.subplot(2,3,4)
-                    plt.imshow(subsource, interpolation='nearest', origin='lower')
-                    plt.title('sub-source')
-                    plt.subplot(2,3,5)
-                    plt.imshow(destval, interpolation='nearest', origin='lower',
-                               vmin=-0.001, vmax=0.01)
-                    plt.title('dest')
-
-                    plt.subplot(2,3,3)
-                    plt.imshow(rimg / np.maximum(rw, 1e-18),
-                               interpolation='nearest', origin='lower',
-                               vmin=-0.001, vmax=0.01)
-                    plt.title('rimg')
-                    plt.subplot(2,3,6)
-                    plt.imshow(rw, interpolation='nearest', origin='lower')
-                    plt.title('rw')
-                    plt.savefig('render-%s-%s.png' % (brickname, band))
-
-            #print('Median image weight:', np.median(rw.ravel()))
-            rimg /= np.maximum(rw, 1e-18)
-            #print('Median image value:', np.median(rimg.ravel()))
-            rimgs.append(rimg)
-        return rimgs
+        subwcs = bwcs.get_subimage(xlo, ylo, xhi-xlo, yhi-ylo)
+        slc = slice(ylo,yhi), slice(xlo,xhi)
+        if fused:
+            layers = self.get_fused_layers()
+        else:
+            layers = [self]
+        # (band index, layer index, image) to resample
+        imgs = []
+        for i in B:
+            band,fn = bands[i], fns[i]
+            try:
+                if fused:
+                    bimgs = self.read_fused_images(brick, band, scale, slc, fn=fn)
+                else:
+                    bimgs = [self.read_image(brick, band, scale, slc, fn=fn)]
+            except:
+                print('Failed to read image:', brickname, band, scale, 'fn', fn)
+                import traceback
+                import sys
+                traceback.print_exc(None, sys.stdout)
+                continue
+            # (only resample the layers that have this brick)
+            imgs.extend([(i, k, img) for k,img in enumerate(bimgs) if img is not None])
+        if len(imgs) == 0:
+            return None
+
+        ih,iw = subwcs.shape
+        assert(np.iinfo(coordtype).max > max(ih,iw))
+        oh,ow = wcs.shape
+        assert(np.iinfo(coordtype).max > max(oh,ow))
+
+        #print('Resampling', img.shape)
+        tablefn = self.get_resample_table_filename(wcs, brick, band, scale,
+                                                   (xlo, ylo, xhi, yhi))
+        if tablefn is not None:
+            from map.resampletable import get_resample_table, resample_with_table
+            table = get_resample_table(tablefn, wcs, subwcs, coordtype)
+            if len(table['Yo']) == 0:
+                return None
+            Yo,Xo,Yi,Xi = table['Yo'], table['Xo'], table['Yi'], table['Xi']
+            resamps = resample_with_table(table, [img for i,k,img in imgs])
+        else:
+            try:
+                Yo,Xo,Yi,Xi,resamps = resample_with_wcs(wcs, subwcs,
+                                                        [img for i,k,img in imgs],
+                                                        intType=coordtype)
+            except OverlapError:
+                #debug('Resampling exception')
+                return None
+
+        #print('Resampling', len(Yo), 'pixels')
+
+        res = [[None] * len(layers) for band in bands]
+        for (i,k,img),resamp in zip(imgs, resamps):
+            res[i][k] = layers[k].cut_resampled_pixels(wcs, brick, bands[i], scale,
+                                                       bwcs, subwcs, xlo, ylo, img,
+                                                       Yo, Xo, Yi, Xi, resamp)
+        if fused:
+            return res
+        return [r[0] for r in res]
+
+    def cut_resampled_pixels(self, wcs, brick, band, scale, bwcs, subwcs, xlo, ylo,
+                             img, Yo, Xo, Yi, Xi, resamp):
+        '''
+        Applies this layer's brick mask and pixel filters to the pixels
+        of *brick* resampled into *wcs* by resample_brick.  Returns
+        (Yo, Xo, resampled pixels, weight), or None.
+        '''
+        import numpy as np
+        bmask = self.get_brick_mask(scale, bwcs, brick)
+        if bmask is not None:
+            # Assume bmask is a binary mask (or RowRangeMask) as large
+            # as the bwcs.  Shift the Xi,Yi coords
+            I = np.flatnonzero(bmask[Yi+ylo, Xi+xlo])
+            if len(I) == 0:
+                return None
+            Yo = Yo[I]
+            Xo = Xo[I]
+            Yi = Yi[I]
+            Xi = Xi[I]
+            resamp = resamp[I]
+
+            #print('get_brick_mask:', len(Yo), 'pixels')
+
+        if not np.all(np.isfinite(resamp)):
+            ok, = np.nonzero(np.isfinite(resamp))
+            Yo = Yo[ok]
+            Xo = Xo[ok]
+            Yi = Yi[ok]
+            Xi = Xi[ok]
+            resamp = resamp[ok]
+
+        ok = self.filter_pixels(scale, img, wcs, subwcs, Yo,Xo,Yi,Xi)
+        if ok is not None:
+            Yo = Yo[ok]
+            Xo = Xo[ok]
+            Yi = Yi[ok]
+            Xi = Xi[ok]
+            resamp = resamp[ok]
+
+        wt = self.get_pixel_weights(band, brick, scale)
+        return Yo,Xo,resamp,wt
+
+    def get_fused_layers(self):
+        '''Layers rendered by render_into_wcs(fused=True).'''
+        return [self]
+
+    def get_fused_layer(self):
+        '''
+        Returns the ResidMixin layer that renders this layer's tiles
+        together with its image / model layers (see FUSED_RESID_TILES),
+        or None.
+        '''
+        if not self.fused_layer_found:
+            basename = self.name
+            if basename.endswith('-model'):
+                basename = basename[:-6]
+            fused = get_layer(basename + '-resid')
+            if fused is not None and self not in fused.get_fused_layers():
+                fused = None
+            self.fused_layer = fused
+            self.fused_layer_found = True
+        return self.fused_layer
+
+    def read_fused_images(self, brick, band, scale, slc, fn=None):
+        '''Reads the images for get_fused_layers(), for resample_brick.'''
+        return [self.read_image(brick, band, scale, slc, fn=fn)]
 
     def get_brick_mask(self, scale, bwcs, brick):
         return None
@@ -1412,57 +1554,149 @@ class MapLayer(object):
             # Set default version...?
             ver = tileversions[self.name][-1]
 
-        if (not get_images) and (wcs is None):
-            tilefn = self.get_tile_filename(ver, zoom, x, y)
-            print('Tile image filename:', tilefn, 'exists?', os.path.exists(tilefn))
-            if os.path.exists(tilefn) and not ignoreCached:
-                print('Sending tile', tilefn)
-                return send_file(tilefn, 'image/jpeg', expires=oneyear,
-                                 modsince=req.META.get('HTTP_IF_MODIFIED_SINCE'),
-                                 filename=filename)
+        if wcs is None and not get_images and x >= 0 and y >= 0:
+            # Outside the footprint?  Answer without looking at bricks or files.
+            from map.coverage import get_coverage
+            cov = get_coverage(self)
+            if cov is not None and not cov.has_tile(zoom, x, y):
+                if return_if_not_found and not forcecache:
+                    return
+                from map.utils import send_blank_tile
+                return send_blank_tile(modsince=req.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                       filename=filename)
+
+        store = None
+        if wcs is None:
+            store = self.get_tile_store(ver, zoom, x, y)
+        if (not get_images) and (store is not None) and not ignoreCached:
+            res = store.send_tile(ver, zoom, x, y,
+                                  modsince=req.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                  filename=filename)
+            if res is not None:
+                print('Sending cached tile', ver, zoom, x, y)
+                return res
 
         from astrometry.util.resample import resample_with_wcs, OverlapError
         from astrometry.util.util import Tan
         import numpy as np
         import fitsio
-    
-        if wcs is None:
-            wcs, W, H, zoomscale, zoom,x,y = get_tile_wcs(zoom, x, y)
-
-        # ok,ra,dec = wcs.pixelxy2radec([1, W/2, W, W, W, W/2, 1, 1],
-        #                            [1, 1, 1, H/2, H, H, H, H/2])
-        # print('WCS range: RA', ra.min(), ra.max(), 'Dec', dec.min(), dec.max())
-            
-        rimgs = self.render_into_wcs(wcs, zoom, x, y, bands=bands, tempfiles=tempfiles)
-        #print('rimgs:', rimgs)
-        if rimgs is None:
-            if get_images:
-                return None
-            if return_if_not_found and not forcecache:
-                return
-            from django.http import HttpResponseRedirect
-            return HttpResponseRedirect(settings.STATIC_URL + 'blank.jpg')
-    
-        if get_images and not write_jpeg:
-            return rimgs
-    
-        if bands is None:
-            bands = self.get_bands()
-        rgb = self.get_rgb(rimgs, bands)
+        import tempfile
 
         if forcecache:
             savecache = True
-        if savecache:
-            trymakedirs(tilefn)
+
+        if store is not None and not get_images:
+            # When caching, render the whole metatile around this tile.
+            n = 1
+            if savecache:
+                n = self.get_metatile_size(zoom)
+            x0 = x - (x % n)
+            y0 = y - (y % n)
+            # Many clients can ask for the same uncached tile at once:
+            # render it once and share the result.
+            from map.locks import single_flight
+            def read_block(layer, lver):
+                # The tiles of this block that are in *layer*'s cache.
+                tiles = {}
+                for yy in range(y0, min(y0 + n, int(zoomscale))):
+                    for xx in range(x0, min(x0 + n, int(zoomscale))):
+                        jpeg = layer.get_tile_store(lver, zoom, xx, yy).get(lver, zoom, xx, yy)
+                        if jpeg is not None:
+                            tiles[(xx, yy)] = jpeg
+                return tiles
+            def cached():
+                # (for when another process rendered the block)
+                if ignoreCached:
+                    return None
+                tiles = read_block(self, ver)
+                if (x, y) not in tiles:
+                    return None
+                return tiles
+            fused = None
+            if (settings.FUSED_RESID_TILES and savecache and bands is None
+                and ver == tileversions.get(self.name, [1])[-1]):
+                fused = self.get_fused_layer()
+            if fused is not None:
+                # Render (and cache) this block for the whole
+                # image / model / resid family at once.
+                fver = tileversions.get(fused.name, [1])[-1]
+                def cached_fused():
+                    # Same shape as render_fused_tiles' result: the
+                    # result is shared by requests for all the layers.
+                    if ignoreCached:
+                        return None
+                    tiles = dict([(layer.name,
+                                   read_block(layer, tileversions.get(layer.name, [1])[-1]))
+                                  for layer in fused.get_fused_layers()])
+                    if (x, y) not in tiles[self.name]:
+                        return None
+                    return tiles
+                tiles = single_flight((fused.name, 'fused', zoom, x0, y0, n),
+                                      lambda: fused.render_fused_tiles(zoom, x0, y0, n,
+                                                                       tempfiles=tempfiles),
+                                      lockfn=fused.get_tile_lock_filename(fver, zoom, x0, y0),
+                                      cached=cached_fused, timeout=settings.TILE_RENDER_WAIT)
+                tiles = tiles[self.name]
+            else:
+                tiles = single_flight((self.name, ver, zoom, x0, y0, n, str(bands)),
+                                      lambda: self.render_tiles_jpeg(ver, zoom, x0, y0, n, savecache,
+                                                                     bands=bands,
+                                                                     tempfiles=tempfiles),
+                                      lockfn=(self.get_tile_lock_filename(ver, zoom, x0, y0)
+                                              if savecache else None),
+                                      cached=cached, timeout=settings.TILE_RENDER_WAIT)
+            jpeg = tiles.get((x, y))
+            if jpeg is None and not ignoreCached:
+                # The tile may have been cached since the shared result
+                # was made.
+                jpeg = store.get(ver, zoom, x, y)
+            if jpeg is None:
+                if return_if_not_found and not forcecache:
+                    return
+                from django.http import HttpResponseRedirect
+                return HttpResponseRedirect(settings.STATIC_URL + 'blank.jpg')
+            wcs = get_tile_wcs(zoom, x, y)[0]
+            f,tilefn = tempfile.mkstemp(suffix='.jpg')
+            os.write(f, jpeg)
+            os.close(f)
         else:
-            import tempfile
+            if wcs is None:
+                wcs, W, H, zoomscale, zoom,x,y = get_tile_wcs(zoom, x, y)
+
+            # ok,ra,dec = wcs.pixelxy2radec([1, W/2, W, W, W, W/2, 1, 1],
+            #                            [1, 1, 1, H/2, H, H, H, H/2])
+            # print('WCS range: RA', ra.min(), ra.max(), 'Dec', dec.min(), dec.max())
+
+            rimgs = self.render_into_wcs(wcs, zoom, x, y, bands=bands, tempfiles=tempfiles)
+            #print('rimgs:', rimgs)
+            if rimgs is None:
+                if get_images:
+                    return None
+                if return_if_not_found and not forcecache:
+                    return
+                from django.http import HttpResponseRedirect
+                return HttpResponseRedirect(settings.STATIC_URL + 'blank.jpg')
+
+            if get_images and not write_jpeg:
+                return rimgs
+
+            if bands is None:
+                bands = self.get_bands()
+            rgb = self.get_rgb(rimgs, bands)
+
             f,tilefn = tempfile.mkstemp(suffix='.jpg')
             os.close(f)
 
-        self.write_jpeg(tilefn, rgb)
-    
-        if get_images:
-            return rimgs
+            self.write_jpeg(tilefn, rgb)
+
+            if savecache and store is not None:
+                with open(tilefn, 'rb') as f:
+                    store.put(ver, zoom, x, y, f.read())
+                debug('Saved tile', ver, zoom, x, y, 'to', store.tiledir)
+
+            if get_images:
+                os.unlink(tilefn)
+                return rimgs
 
         if ("lslga" in req.GET or "lslga-model" in req.GET
             or 'sga' in req.GET or 'sga-parent' in req.GET):
@@ -1545,17 +1779,96 @@ class MapLayer(object):
 
             img.save(tilefn)
     
-        return send_file(tilefn, 'image/jpeg', unlink=(not savecache),
+        return send_file(tilefn, 'image/jpeg', unlink=True,
                          filename=filename)
 
+    def get_metatile_size(self, zoom):
+        '''
+        Side length (in tiles) of the block of tiles rendered together
+        when a tile is missing from the cache; 1 = no metatiles.
+        '''
+        n = settings.METATILE_SIZE
+        # At low zoom the block would be a large fraction of the sky
+        # (and the Mercator WCS wraps at half the world width).
+        while n > 1 and 2**zoom < 4*n:
+            n //= 2
+        return n
+
+    def render_metatile(self, wcs, zoom, x0, y0, n, **kwargs):
+        '''Renders the n x n block of tiles at (x0, y0), whose WCS is *wcs*.'''
+        return self.render_into_wcs(wcs, zoom, x0, y0, **kwargs)
+
+    def render_tiles_jpeg(self, ver, zoom, x0, y0, n, savecache, bands=None,
+                          tempfiles=None):
+        '''
+        Renders the *n* x *n* block of Mercator tiles with top-left tile
+        (x0, y0) in a single render_into_wcs call, and returns a dict of
+        (x, y) -> JPEG data, also saving them in the tile store if
+        *savecache*.
+        Tiles with no data are left out (so the dict may be empty).
+        '''
+        weights = []
+        if n == 1:
+            wcs = get_tile_wcs(zoom, x0, y0)[0]
+            rimgs = self.render_into_wcs(wcs, zoom, x0, y0, bands=bands,
+                                         tempfiles=tempfiles, weights=weights)
+        else:
+            wcs = get_metatile_wcs(zoom, x0, y0, n)
+            rimgs = self.render_metatile(wcs, zoom, x0, y0, n, bands=bands,
+                                         tempfiles=tempfiles, weights=weights)
+        weight = None
+        if len(weights) == 1:
+            weight = weights[0]
+        return self.jpeg_tiles(rimgs, ver, zoom, x0, y0, n, savecache, bands=bands,
+                               weight=weight)
+
+    def jpeg_tiles(self, rimgs, ver, zoom, x0, y0, n, savecache, bands=None,
+                   weight=None):
+        '''
+        Cuts the rendered *n* x *n* block of tiles *rimgs* into JPEG tiles;
+        see render_tiles_jpeg.  If the block's weight map *weight* is
+        given, tiles where it is all zero (no bricks) are skipped, so
+        that they get served as blank tiles rather than cached.
+        '''
+        from io import BytesIO
+        tiles = {}
+        if rimgs is None:
+            return tiles
+        if bands is None:
+            bands = self.get_bands()
+        S = 256
+        for j in range(n):
+            for i in range(n):
+                x,y = x0 + i, y0 + j
+                if (weight is not None and
+                    not (weight[j*S:(j+1)*S, i*S:(i+1)*S] > 0).any()):
+                    continue
+                ims = [im[j*S:(j+1)*S, i*S:(i+1)*S] for im in rimgs]
+                rgb = self.get_rgb(ims, bands)
+                out = BytesIO()
+                self.write_jpeg(out, rgb)
+                jpeg = out.getvalue()
+                if savecache:
+                    store = self.get_tile_store(ver, zoom, x, y)
+                    store.put(ver, zoom, x, y, jpeg)
+                    debug('Saved tile', ver, zoom, x, y, 'to', store.tiledir)
+                tiles[(x, y)] = jpeg
+        return tiles
+
+    def get_tile_lock_filename(self, ver, zoom, x, y):
+        '''Lock file held (across processes) while rendering a tile.'''
+        return os.path.join(self.tiledir, 'locks', '%i-%i-%i-%i.lock' % (ver, zoom, x, y))
+
     def write_jpeg(self, fn, rgb):
         # no jpeg output support in matplotlib in some installations...
+        # save_jpeg encodes in-process with PIL.
+        # *fn* may also be a file-like object.
         if self.hack_jpeg:
             save_jpeg(fn, rgb)
             debug('Wrote', fn)
         else:
             import pylab as plt
-            plt.imsave(fn, rgb)
+            plt.imsave(fn, rgb, format='jpg')
             debug('Wrote', fn)
 
     def get_tile_view(self):
@@ -1883,9 +2196,11 @@ class DecalsLayer(MapLayer):
             ccds = ccds[:Nmax]
         return ccds
 
-    def get_catalog_in_wcs(self, wcs):
+    def get_catalog_in_wcs(self, wcs, columns=None):
         from astrometry.util.fits import fits_table, merge_tables
         # returns cat,hdr
+        # (*columns*: the Tractor columns to read -- all if None --
+        # which must include brick_primary)
 
         H,W = wcs.shape
         X = wcs.pixelxy2radec([1,1,1,W/2,W,W,W,W/2],
@@ -1903,7 +2218,7 @@ class DecalsLayer(MapLayer):
                 print('Does not exist:', catfn)
                 continue
             debug('Reading catalog', catfn)
-            T = fits_table(catfn)
+            T = fits_table(catfn, columns=columns)
             T.cut(T.brick_primary)
             print('File', catfn, 'cut to', len(T), 'primary')
             if len(T) == 0:
@@ -1919,6 +2234,23 @@ class DecalsLayer(MapLayer):
             cat = merge_tables(cat, columns='fillzero')
         return cat,hdr
 
+    def get_brick_catalogs(self, bricknames, columns=None):
+        '''
+        Returns a list of the (brick_primary) Tractor catalogs of the
+        given bricks, skipping missing ones; for map/catpyramid.py.
+        '''
+        from astrometry.util.fits import fits_table
+        cats = []
+        for brickname in bricknames:
+            catfn = self.survey.find_file('tractor', brick=brickname)
+            if not os.path.exists(catfn):
+                continue
+            T = fits_table(catfn, columns=columns)
+            T.cut(T.brick_primary)
+            if len(T):
+                cats.append(T)
+        return cats
+
     def get_catalog(self, req, ralo, rahi, declo, dechi):
         from map.cats import radecbox_to_wcs
         wcs = radecbox_to_wcs(ralo, rahi, declo, dechi)
@@ -1976,6 +2308,10 @@ class DecalsLayer(MapLayer):
             return 1
         return 0
 
+    def bands_share_wcs(self, scale):
+        # All bands of a brick are coadded onto the same pixel grid.
+        return True
+
 class DecalsInvvarLayer(DecalsLayer):
     def get_scale(self, zoom, x, y, wcs):
         return 0
@@ -2018,10 +2354,10 @@ class RebrickedMixin(object):
         # ... except for images where fitsio (1.0.5) screwed up the fpack...
         if not os.path.exists(fn):
             return 1
-        import fitsio
-        F = fitsio.FITS(fn)
-        debug('File', fn, 'has', len(F), 'hdus')
-        if len(F) == 1:
+        from map.filecache import get_hdu_count
+        nhdus = get_hdu_count(fn)
+        debug('File', fn, 'has', nhdus, 'hdus')
+        if nhdus == 1:
             return 0
         return 1
 
@@ -2033,18 +2369,21 @@ class RebrickedMixin(object):
 
     def get_scaled_wcs(self, brick, band, scale):
         pass
+
+    def bands_share_wcs(self, scale):
+        # Scaled images are rendered into get_scaled_wcs(), which is the
+        # same for all bands.
+        if scale > 0:
+            return True
+        return super(RebrickedMixin, self).bands_share_wcs(scale)
     
     def create_scaled_image(self, brick, band, scale, fn, tempfiles=None):
         import numpy as np
-        from scipy.ndimage.filters import gaussian_filter
         import fitsio
         import tempfile
+        from map.downsample import smooth_and_bin
+        from map.scaledcache import scaled_file_written
 
-        ro = settings.READ_ONLY_BASEDIR
-        if ro:
-            print('Read-only; not creating scaled', brick, band, scale)
-            return None
-        
         # Create scaled-down image (recursively).
         #print('Creating scaled-down image for', brick.brickname, band, 'scale', scale)
         # This is a little strange -- we resample into a WCS twice
@@ -2061,17 +2400,8 @@ class RebrickedMixin(object):
         img = imgs[0]
         del imgs
 
-        H,W = img.shape
-        # make even size
-        if H % 2 == 1:
-            img = img[:-1,:]
-        if W % 2 == 1:
-            img = img[:,:-1]
-        # smooth
-        img = gaussian_filter(img, 1.)
-        # bin
-        img = (img[::2,::2] + img[1::2,::2] + img[1::2,1::2] + img[::2,1::2])/4.
-        img = img.astype(np.float32)
+        # smooth & bin (dropping any odd last row / column)
+        img = smooth_and_bin(img)
         H,W = img.shape
         # create half-size WCS
         wcs = wcs.get_subimage(0, 0, W*2, H*2)
@@ -2093,8 +2423,11 @@ class RebrickedMixin(object):
         fitsio.write(tmpfn + compress, img, header=hdr, clobber=True)
         os.rename(tmpfn, fn)
         print('Wrote', fn)
+        scaled_file_written(fn)
+        return fn
 
     def get_filename(self, brick, band, scale, tempfiles=None):
+        from map.scaledcache import build_scaled_file
         #print('RebrickedMixin.get_filename: brick', brick, 'band', band, 'scale', scale)
         if scale == 0:
             #return self.get_base_filename(brick, band)
@@ -2102,9 +2435,8 @@ class RebrickedMixin(object):
                                                             tempfiles=tempfiles)
         fn = self.get_scaled_filename(brick, band, scale)
         #print('Filename:', fn)
-        if os.path.exists(fn):
-            return fn
-        fn = self.create_scaled_image(brick, band, scale, fn, tempfiles=tempfiles)
+        fn = build_scaled_file(fn, lambda wfn: self.create_scaled_image(
+            brick, band, scale, wfn, tempfiles=tempfiles))
         if fn is None:
             return None
         if os.path.exists(fn):
@@ -2199,12 +2531,15 @@ class RebrickedMixin(object):
                                   bricks=None):
         import numpy as np
         if bricks is None:
-            bricks = self.get_bricks_for_scale(scale)
-        #print('scale', scale, ':', len(bricks), 'total bricks')
-        I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
-        #print(len(I), 'bricks overlap Dec range')
-        ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
-        I = I[ok]
+            index = self.get_brick_index(scale)
+            bricks = index.bricks
+            I = index.touching_radec_box(ralo, rahi, declo, dechi)
+        else:
+            #print('scale', scale, ':', len(bricks), 'total bricks')
+            I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
+            #print(len(I), 'bricks overlap Dec range')
+            ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
+            I = I[ok]
         #print(len(I), 'bricks overlap Dec and RA range')
         if len(I) == 0:
             #print('Bricks touching RA,Dec box', ralo, rahi, 'Dec', declo, dechi, 'scale', scale,
@@ -2268,6 +2603,9 @@ class ResidMixin(object):
         self.model_layer = model_layer
         self.rgbkwargs = dict(mnmx=(-5,5))
 
+    def get_fused_layer(self):
+        return self
+
     def read_image(self, brick, band, scale, slc, fn=None):
         # Note, we drop the fn arg.
         img = self.image_layer.read_image(brick, band, scale, slc)
@@ -2286,6 +2624,52 @@ class ResidMixin(object):
         ifn = self.image_layer.get_filename(brick, band, scale, tempfiles=tempfiles)
         return ifn
 
+    def get_fused_layers(self):
+        return [self.image_layer, self.model_layer, self]
+
+    def read_fused_images(self, brick, band, scale, slc, fn=None):
+        # Read each brick once for all three layers.
+        img = self.image_layer.read_image(brick, band, scale, slc)
+        if img is None:
+            return [None, None, None]
+        # (a missing or broken model brick must not drop the image brick)
+        try:
+            mod = self.model_layer.read_image(brick, band, scale, slc)
+        except:
+            print('Failed to read model image:', brick.brickname, band, scale)
+            import traceback
+            traceback.print_exc()
+            mod = None
+        if mod is None:
+            return [img, None, None]
+        return [img, mod, img - mod]
+
+    def render_fused_tiles(self, zoom, x0, y0, n, tempfiles=None):
+        '''
+        Renders the *n* x *n* block of Mercator tiles with top-left tile
+        (x0, y0) for the image, model and resid layers in one pass, saving
+        them in each layer's tile store (at its latest tile version).
+        Returns a dict of layer name -> {(x, y): JPEG data}.
+        '''
+        from map.views import tileversions
+        if n == 1:
+            wcs = get_tile_wcs(zoom, x0, y0)[0]
+        else:
+            wcs = get_metatile_wcs(zoom, x0, y0, n)
+        weights = []
+        rimgs = self.render_into_wcs(wcs, zoom, x0, y0, tempfiles=tempfiles, fused=True,
+                                     weights=weights)
+        layers = self.get_fused_layers()
+        if rimgs is None:
+            rimgs = [None] * len(layers)
+            weights = [None] * len(layers)
+        tiles = {}
+        for layer,rims,weight in zip(layers, rimgs, weights):
+            ver = tileversions.get(layer.name, [1])[-1]
+            tiles[layer.name] = layer.jpeg_tiles(rims, ver, zoom, x0, y0, n, True,
+                                                 weight=weight)
+        return tiles
+
 class UniqueBrickMixin(object):
     '''For model and resid layers where only blobs within the brick's unique area
     are fit -- thus bricks should be masked to their unique area before coadding.
@@ -2293,11 +2677,8 @@ class UniqueBrickMixin(object):
     def get_brick_mask(self, scale, bwcs, brick):
         if scale > 0:
             return None
-        from legacypipe.utils import find_unique_pixels
-        H,W = bwcs.shape
-        U = find_unique_pixels(bwcs, W, H, None, 
-                               brick.ra1, brick.ra2, brick.dec1, brick.dec2)
-        return U
+        from map.brickmask import get_unique_mask
+        return get_unique_mask(bwcs, brick)
 
 class DecalsResidLayer(ResidMixin, UniqueBrickMixin, DecalsLayer):
     pass
@@ -2393,7 +2774,8 @@ class SdssLayer(MapLayer):
         if scale == 0:
             return fn
         fnargs = dict(band=band, brickname=brickname)
-        fn = get_scaled(self.get_scaled_pattern(), fnargs, scale, fn)
+        fn = get_scaled(self.get_scaled_pattern(), fnargs, scale, fn,
+                        maxscale=self.maxscale)
         return fn
     
     def get_scaled_pattern(self):
@@ -2512,12 +2894,13 @@ class HscLayer(RebrickedMixin, MapLayer):
     
     def read_wcs(self, brick, band, scale, fn=None):
         from map.coadds import read_tan_from_header
+        from map.filecache import get_wcs
         if fn is None:
             fn = self.get_filename(brick, band, scale)
         if fn is None:
             return None
         ext = self.get_fits_extension(scale, fn)
-        return read_tan_from_header(fn, ext)
+        return get_wcs(fn, ext, read_tan_from_header)
 
 
 class LegacySurveySplitLayer(MapLayer):
@@ -2639,21 +3022,14 @@ class LegacySurveySplitLayer(MapLayer):
         cat.writeto(outfn, header=hdr)
         return send_file(outfn, 'image/fits', unlink=True, filename=fn)
 
-    def get_catalog_in_wcs(self, wcs):
+    def get_catalog_in_wcs(self, wcs, columns=None):
         from astrometry.util.fits import merge_tables
         allcats = []
         hdr = None
         for layer,above in [(self.top,True), (self.bottom,False)]:
-            cat,h = layer.get_catalog_in_wcs(wcs)
+            cat,h = layer.get_catalog_in_wcs(wcs, columns=columns)
             if cat is not None and len(cat)>0:
-                if above:
-                    cat.cut(cat.dec >= self.decsplit)
-                else:
-                    from astrometry.util.starutil_numpy import radectolb
-                    import numpy as np
-                    l,b = radectolb(cat.ra, cat.dec)
-                    sgc = (b < 0.)
-                    cat.cut(np.logical_or(cat.dec < self.decsplit, sgc))
+                self.cut_catalog(cat, above)
                 allcats.append(cat)
             if h is not None:
                 hdr = h
@@ -2663,6 +3039,26 @@ class LegacySurveySplitLayer(MapLayer):
             allcats = merge_tables(allcats, columns='fillzero')
         return allcats,hdr
 
+    def cut_catalog(self, cat, above):
+        '''Cuts a catalog from the top (*above*) or bottom layer to the part we show.'''
+        if above:
+            cat.cut(cat.dec >= self.decsplit)
+        else:
+            from astrometry.util.starutil_numpy import radectolb
+            import numpy as np
+            l,b = radectolb(cat.ra, cat.dec)
+            sgc = (b < 0.)
+            cat.cut(np.logical_or(cat.dec < self.decsplit, sgc))
+
+    def get_brick_catalogs(self, bricknames, columns=None):
+        cats = []
+        for layer,above in [(self.top,True), (self.bottom,False)]:
+            for cat in layer.get_brick_catalogs(bricknames, columns=columns):
+                self.cut_catalog(cat, above)
+                if len(cat):
+                    cats.append(cat)
+        return cats
+
     def get_bricks(self):
         from astrometry.util.fits import merge_tables
         BB = merge_tables([l.get_bricks() for l in self.layers], columns='fillzero')
@@ -2687,7 +3083,7 @@ class LegacySurveySplitLayer(MapLayer):
             return 1
         return 0
 
-    def render_into_wcs(self, wcs, zoom, x, y, general_wcs=False, **kwargs):
+    def render_into_wcs(self, wcs, zoom, x, y, general_wcs=False, weights=None, **kwargs):
         
         ## FIXME -- generic WCS
         #print('render_into_wcs zoom,x,y', zoom,x,y, 'wcs', wcs)
@@ -2697,14 +3093,14 @@ class LegacySurveySplitLayer(MapLayer):
             split = self.tilesplits[zoom]
             if y < split:
                 #print('y below split -- north')
-                return self.top.render_into_wcs(wcs, zoom, x, y,
+                return self.top.render_into_wcs(wcs, zoom, x, y, weights=weights,
                                                 general_wcs=general_wcs, **kwargs)
             if y > split:
                 #print('y above split -- south')
-                return self.bottom.render_into_wcs(wcs, zoom, x, y,
+                return self.bottom.render_into_wcs(wcs, zoom, x, y, weights=weights,
                                                    general_wcs=general_wcs, **kwargs)
 
-        # both!
+        # both!  (*weights* is not filled: no tiles get skipped)
         topims = self.top.render_into_wcs(wcs, zoom, x, y,
                                           general_wcs=general_wcs, **kwargs)
         botims = self.bottom.render_into_wcs(wcs, zoom, x, y,
@@ -2758,6 +3154,25 @@ class LegacySurveySplitLayer(MapLayer):
         print('Middle:', tilefn)
         return tilefn
 
+    def render_metatile(self, wcs, zoom, x0, y0, n, **kwargs):
+        split = self.tilesplits[zoom]
+        ## FIXME -- this is not the correct cut -- ignores NGC/SGC difference
+        if y0 + n - 1 < split:
+            return self.top.render_metatile(wcs, zoom, x0, y0, n, **kwargs)
+        if y0 > split:
+            return self.bottom.render_metatile(wcs, zoom, x0, y0, n, **kwargs)
+        # Block straddles the split: render both & cut by Dec (y = -1).
+        return self.render_into_wcs(wcs, zoom, x0, -1, **kwargs)
+
+    def get_tile_store(self, ver, zoom, x, y):
+        split = self.tilesplits[zoom]
+        ## FIXME -- this is not the correct cut -- ignores NGC/SGC difference
+        if y < split:
+            return self.top.get_tile_store(ver, zoom, x, y)
+        if y > split:
+            return self.bottom.get_tile_store(ver, zoom, x, y)
+        return super(LegacySurveySplitLayer, self).get_tile_store(ver, zoom, x, y)
+
 class DesLayer(ReDecalsLayer):
 
     def __init__(self, name):
@@ -2798,14 +3213,11 @@ class DesLayer(ReDecalsLayer):
         return self.bricks
 
     def bricks_touching_radec_box(self, ralo, rahi, declo, dechi, scale=None):
-        import numpy as np
-        bricks = self.get_bricks_for_scale(scale)
-        I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
-        ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
-        I = I[ok]
+        index = self.get_brick_index(scale)
+        I = index.touching_radec_box(ralo, rahi, declo, dechi)
         if len(I) == 0:
             return None
-        return bricks[I]
+        return index.bricks[I]
 
     def get_brick_size_for_scale(self, scale):
         if scale == 0:
@@ -2916,67 +3328,79 @@ class PS1Layer(MapLayer):
             return self.read_image(brick, band, 0, None, header=True)
         #print('calling get_scaled: scale', scale)
         fn = get_scaled(self.get_scaled_pattern(), fnargs, scale, fn,
-                        read_base_wcs=read_base_wcs, read_base_image=read_base_image)
+                        read_base_wcs=read_base_wcs, read_base_image=read_base_image,
+                        maxscale=self.maxscale)
         #print('get_scaled: fn', fn)
         return fn
 
-    def read_image(self, brick, band, scale, slc, header=False, fn=None):
-        #print('read_image for', brickname, 'band', band, 'scale', scale)
-        #if scale > 0:
-        #    return super(PS1Layer, self).read_image(brickname, band, scale, slc)
-
-        # HDU = 1
-        import fitsio
-        #print('-> get_filename')
-        if fn is None:
-            fn = self.get_filename(brick, band, scale)
-        #print('-> got filename', fn)
-
-        if scale == 0:
-            hdu = 1
-        else:
-            hdu = 0
+    def linearize(self, img, hdr):
+        '''
+        Converts (a slice of) a raw, asinh-scaled PS1 skycell image, with
+        header *hdr*, to linear flux, zeroing bad pixels.
+        '''
+        exptime = hdr['EXPTIME']
+        import numpy as np
+        # print('Exptime:', exptime, 'in band', band, '; image 90th pctile:', np.percentile(img.ravel(), 90))
 
-        #print('Reading image from', fn)
-        F = fitsio.FITS(fn)
-        f = F[hdu]
-        if slc is None:
-            img = f.read()
-        else:
-            img = f[slc]
-        hdr = f.read_header()
+        # Srsly?
+        alpha = 2.5 * np.log10(np.e)
+        boff = hdr['BOFFSET']
+        bsoft = hdr['BSOFTEN']
 
-        if scale == 0:
-            #print('scale == 0; scaling pixels')
-            exptime = hdr['EXPTIME']
-            import numpy as np
-            # print('Exptime:', exptime, 'in band', band, '; image 90th pctile:', np.percentile(img.ravel(), 90))
+        origimg = img
 
-            # Srsly?
-            alpha = 2.5 * np.log10(np.e)
-            boff = hdr['BOFFSET']
-            bsoft = hdr['BSOFTEN']
+        img = boff + bsoft * 2. * np.sinh(img / alpha)
 
-            origimg = img
 
-            img = boff + bsoft * 2. * np.sinh(img / alpha)
+        # print('After linearitity: image 90th pctile:', np.percentile(img.ravel(), 90))
 
+        # Zeropoint of 25 = factor of 10 vs nanomaggies
+        img *= 0.1 / exptime
 
-            # print('After linearitity: image 90th pctile:', np.percentile(img.ravel(), 90))
+        #img[np.logical_not(np.isfinite(img))] = 0.
+        #img[origimg == bad] = 0.
 
-            # Zeropoint of 25 = factor of 10 vs nanomaggies
-            img *= 0.1 / exptime
+        bad = hdr['BLANK']
+        bzero = hdr['BZERO']
+        bscale = hdr['BSCALE']
+        badval = bzero + bscale * (bad - 0.5)
+        img[origimg > badval] = 0.
+        return img
 
-            #img[np.logical_not(np.isfinite(img))] = 0.
-            #img[origimg == bad] = 0.
+    def get_linear_filename(self, brick, band):
+        return os.path.join(self.get_derived_dir(), 'linear-%s' % band, brick.brickname[:4],
+                            'ps1-%s-%s.fits.fz' % (brick.brickname, band))
 
-            bad = hdr['BLANK']
-            bzero = hdr['BZERO']
-            bscale = hdr['BSCALE']
-            badval = bzero + bscale * (bad - 0.5)
-            img[origimg > badval] = 0.
+    def read_image(self, brick, band, scale, slc, header=False, fn=None):
+        #print('read_image for', brickname, 'band', band, 'scale', scale)
+        #if scale > 0:
+        #    return super(PS1Layer, self).read_image(brickname, band, scale, slc)
 
+        from map.filecache import read_image, read_header
+        #print('-> get_filename')
+        if fn is None:
+            fn = self.get_filename(brick, band, scale)
+        #print('-> got filename', fn)
 
+        if scale > 0:
+            img,hdr = read_image(fn, 0, slc, header=True)
+        else:
+            # The raw skycell (HDU 1) is linearized once and saved,
+            # float32 and tile-compressed.
+            def make_linear():
+                import numpy as np
+                img,hdr = read_image(fn, 1, header=True)
+                return self.linearize(img, hdr).astype(np.float32)
+            try:
+                linfn = self.get_derived_image(fn, self.get_linear_filename(brick, band),
+                                               make_linear, compress=True)
+                img = read_image(linfn, 1, slc)
+            except (IOError, OSError) as e:
+                print('Failed to save linearized image for', fn, ':', e)
+                img,hdr = read_image(fn, 1, slc, header=True)
+                img = self.linearize(img, hdr)
+            # (callers want the raw image's header)
+            hdr = read_header(fn, 1)
 
         if header:
             return img,hdr
@@ -3020,13 +3444,13 @@ class PS1Layer(MapLayer):
             return None
 
         #print('read_wcs got fn', fn)
+        from map.filecache import get_wcs, read_header
         if scale > 0:
-            return read_tan_wcs(fn, 0)
+            return get_wcs(fn, 0, read_tan_wcs)
 
         #print('Handling PS1 WCS for', fn)
-        import fitsio
         from astrometry.util.util import Tan
-        hdr = fitsio.read_header(fn, 1)
+        hdr = read_header(fn, 1)
 
         # PS1 wonky WCS
         cdelt1 = hdr['CDELT1']
@@ -3080,12 +3504,10 @@ class UnwiseLayer(MapLayer):
         return '12'
 
     def bricks_touching_radec_box(self, ralo, rahi, declo, dechi, scale=None):
-        import numpy as np
-        bricks = self.get_bricks()
+        index = self.get_brick_index(0)
+        bricks = index.bricks
         print('Unwise bricks touching RA,Dec box', ralo, rahi, declo, dechi)
-        I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
-        ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
-        I = I[ok]
+        I = index.touching_radec_box(ralo, rahi, declo, dechi)
         print('-> bricks', bricks.brickname[I])
         if len(I) == 0:
             return None
@@ -3145,13 +3567,10 @@ class RebrickedUnwise(RebrickedMixin, UnwiseLayer):
                   float(size), float(size))
         return wcs
 
-    def bricks_within_range(self, ra, dec, radius, scale=None):
-        from astrometry.libkd.spherematch import match_radec
+    def brick_indices_within_range(self, ra, dec, radius, scale=None):
         import numpy as np
-        B = self.get_bricks_for_scale(scale)
         brad = self.pixelsize * self.pixscale/3600. * 2**scale * np.sqrt(2.)/2. * 1.01
-        I,J,d = match_radec(ra, dec, B.ra, B.dec, radius + brad)
-        return B[J]
+        return self.get_brick_index(scale).within_radius(ra, dec, radius + brad)
 
     def get_bricks_for_scale(self, scale):
         if scale in [0, None]:
@@ -3168,12 +3587,10 @@ class RebrickedUnwise(RebrickedMixin, UnwiseLayer):
         Both RebrickedMixin and UnwiseLayer override this function -- here we have
         to merge the capabilities.
         '''
-        import numpy as np
-        bricks = self.get_bricks_for_scale(scale)
+        index = self.get_brick_index(scale)
+        bricks = index.bricks
         print('(unwise) scale', scale, 'bricks touching RA,Dec box', ralo, rahi, declo, dechi)
-        I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
-        ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
-        I = I[ok]
+        I = index.touching_radec_box(ralo, rahi, declo, dechi)
         print('-> bricks', bricks.brickname[I])
         if len(I) == 0:
             return None
@@ -3280,6 +3697,8 @@ class GalexLayer(RebrickedUnwise):
         fitsio.write(tmpfn + compress, img, header=hdr, clobber=True)
         os.rename(tmpfn, fn)
         print('Wrote', fn)
+        from map.scaledcache import scaled_file_written
+        scaled_file_written(fn)
 
     def create_scaled_image(self, brick, band, scale, fn, tempfiles=None):
         if scale == 0:
@@ -3316,13 +3735,16 @@ class GalexLayer(RebrickedUnwise):
         #print('galex get_filename: scale', scale, 'band', band, 'brick', brick.brickname)
         if scale == -1:
             return self.get_base_filename(brick, band)
+        from map.scaledcache import build_scaled_file
         brickname = brick.brickname
         fnargs = dict(band=band, brickname=brickname, scale=scale)
         fn = self.get_scaled_pattern() % fnargs
-        if not os.path.exists(fn):
-            print('Creating', fn)
-            self.create_scaled_image(brick, band, scale, fn, tempfiles=tempfiles)
-            print('Created', fn)
+        def create(wfn):
+            print('Creating', wfn)
+            self.create_scaled_image(brick, band, scale, wfn, tempfiles=tempfiles)
+            print('Created', wfn)
+            return wfn
+        fn = build_scaled_file(fn, create)
         if not os.path.exists(fn):
             return None
         return fn
@@ -3421,17 +3843,12 @@ class GalexLayer(RebrickedUnwise):
         # return myrgb
 
     def read_image(self, brick, band, scale, slc, fn=None):
-        import fitsio
+        from map.filecache import read_image
         if fn is None:
             fn = self.get_filename(brick, band, scale)
         print('Reading image from', fn)
         ext = self.get_fits_extension(scale, fn)
-        f = fitsio.FITS(fn)[ext]
-        if slc is None:
-            img = f.read()
-        else:
-            img = f[slc]
-        return img
+        return read_image(fn, ext, slc)
 
 def galex_rgb(imgs, bands, **kwargs):
     import numpy as np
@@ -3481,12 +3898,10 @@ class TwoMassLayer(MapLayer):
         return ['j','h','k']
 
     def bricks_touching_radec_box(self, ralo, rahi, declo, dechi, scale=None):
-        import numpy as np
-        bricks = self.get_bricks()
+        index = self.get_brick_index(0)
+        bricks = index.bricks
         print('2MASS bricks touching RA,Dec box', ralo, rahi, declo, dechi)
-        I, = np.nonzero((bricks.dec1 <= dechi) * (bricks.dec2 >= declo))
-        ok = ra_ranges_overlap(ralo, rahi, bricks.ra1[I], bricks.ra2[I])
-        I = I[ok]
+        I = index.touching_radec_box(ralo, rahi, declo, dechi)
         print('-> bricks', bricks.brickname[I])
         if len(I) == 0:
             return None
@@ -3510,60 +3925,75 @@ class TwoMassLayer(MapLayer):
                                    k=0.0009,))
         return rgb
 
+    def sky_subtract(self, fn, ext):
+        '''
+        Returns the calibrated scale-0 image *fn* with the sky re-estimated
+        (by a SplineSky fit) and subtracted -- for the h and k bands.
+        '''
+        import numpy as np
+        from map.filecache import read_image
+        from tractor.splinesky import SplineSky
+        from scipy.ndimage.filters import uniform_filter
+        from scipy.ndimage.morphology import binary_dilation
+
+        # re-estimate sky
+        img,hdr = read_image(fn, ext, header=True)
+        sky = hdr['SKYVAL']
+        zpscale = 10.**((hdr['MAGZP'] - 22.5) / 2.5)
+        img = (img - sky) / zpscale
+        skysig = hdr['SKYSIG']
+        skysig /= zpscale
+
+        boxsize = 128
+        good = (np.abs(img) < 5.*skysig) * np.isfinite(img)
+        skyobj = SplineSky.BlantonMethod(img, good, boxsize)
+        skymod = np.zeros_like(img)
+        skyobj.addTo(skymod)
+
+        # Now mask bright objects in a boxcar-smoothed (image - initial sky model)
+        # Smooth by a boxcar filter before cutting pixels above threshold --
+        boxcar = 5
+        # Sigma of boxcar-smoothed image
+        bsig1 = skysig / boxcar
+        masked = np.abs(uniform_filter(img-skymod, size=boxcar, mode='constant')
+                        > (3.*bsig1))
+        masked = binary_dilation(masked, iterations=3)
+        good[masked] = False
+        # Now find the final sky model using that more extensive mask
+        skyobj = SplineSky.BlantonMethod(img, good, boxsize)
+        skymod[:,:] = 0.
+        skyobj.addTo(skymod)
+        img -= skymod
+        return img
+
+    def get_skysub_filename(self, brick, band):
+        return os.path.join(self.get_derived_dir(), 'skysub-%s' % band, brick.brickname[:3],
+                            '2mass-%s-%s.fits' % (brick.brickname, band))
+
     def read_image(self, brick, band, scale, slc, fn=None):
-        import fitsio
+        from map.filecache import read_image, read_header
         if fn is None:
             fn = self.get_filename(brick, band, scale)
         print('Reading image from', fn)
         ext = self.get_fits_extension(scale, fn)
-        f = fitsio.FITS(fn)[ext]
 
         if band in ['h','k'] and scale == 0:
-            import numpy as np
-            from tractor.splinesky import SplineSky
-            from scipy.ndimage.filters import uniform_filter
-            from scipy.ndimage.morphology import binary_dilation
-
-            # re-estimate sky
-            img = f.read()
-            hdr = f.read_header()
-            sky = hdr['SKYVAL']
-            zpscale = 10.**((hdr['MAGZP'] - 22.5) / 2.5)
-            img = (img - sky) / zpscale
-            skysig = hdr['SKYSIG']
-            skysig /= zpscale
-
-            boxsize = 128
-            good = (np.abs(img) < 5.*skysig) * np.isfinite(img)
-            skyobj = SplineSky.BlantonMethod(img, good, boxsize)
-            skymod = np.zeros_like(img)
-            skyobj.addTo(skymod)
-
-            # Now mask bright objects in a boxcar-smoothed (image - initial sky model)
-            # Smooth by a boxcar filter before cutting pixels above threshold --
-            boxcar = 5
-            # Sigma of boxcar-smoothed image
-            bsig1 = skysig / boxcar
-            masked = np.abs(uniform_filter(img-skymod, size=boxcar, mode='constant')
-                            > (3.*bsig1))
-            masked = binary_dilation(masked, iterations=3)
-            good[masked] = False
-            # Now find the final sky model using that more extensive mask
-            skyobj = SplineSky.BlantonMethod(img, good, boxsize)
-            skymod[:,:] = 0.
-            skyobj.addTo(skymod)
-            img -= skymod
-            if slc is not None:
-                img = img[slc]
-            return img
-
-        if slc is None:
-            img = f.read()
-        else:
-            img = f[slc]
+            # The sky fit is costly, so it is done once per image and saved.
+            try:
+                skyfn = self.get_derived_image(fn, self.get_skysub_filename(brick, band),
+                                               lambda: self.sky_subtract(fn, ext))
+            except (IOError, OSError) as e:
+                print('Failed to save sky-subtracted image for', fn, ':', e)
+                img = self.sky_subtract(fn, ext)
+                if slc is not None:
+                    img = img[slc]
+                return img
+            return read_image(skyfn, 0, slc)
+
+        img = read_image(fn, ext, slc)
         if scale == 0:
             import numpy as np
-            hdr = f.read_header()
+            hdr = read_header(fn, ext)
             sky = hdr['SKYVAL']
             zpscale = 10.**((hdr['MAGZP'] - 22.5) / 2.5)
             img = (img - sky) / zpscale
@@ -3717,23 +4147,11 @@ class ZtfLayer(RebrickedMixin, MapLayer):
         bb = bricks[bricks.filter == ('z'+band)]
         return bb
 
-    def bricks_within_range(self, ra, dec, radius, scale=None):
-        from astrometry.libkd.spherematch import match_radec, tree_open, tree_search_radec
-        from astrometry.util.fits import fits_table
-        import numpy as np
+    def brick_indices_within_range(self, ra, dec, radius, scale=None):
         if scale > 0:
             return None
-        fn = os.path.join(self.basedir, 'ztf-tiles.kd.fits')
-        kd = tree_open(fn)
         # 0.65 ~ 3200/2 * sqrt(2) * 1"/pix
-        I = tree_search_radec(kd, ra, dec, radius + 0.65)
-        #print('Bricks_within_range: radius=', radius, 'RA,Dec', ra,dec, '=', len(I))
-        T = fits_table(fn, rows=I)
-        T.brickname = np.array(['%06i-%02i-%02i' % (f,c,q)
-                                for f,c,q in zip(T.field, T.chip, T.quad)])
-        T.ra  = T.crval1
-        T.dec = T.crval2
-        return T
+        return self.get_brick_index(scale).within_radius(ra, dec, radius + 0.65)
 
     def get_scaled_wcs(self, brick, band, scale):
         from astrometry.util.util import Tan
@@ -3786,8 +4204,20 @@ class ZtfLayer(RebrickedMixin, MapLayer):
         return img
     
 class ZeaLayer(MapLayer):
+    '''
+    A layer showing an all-sky ZEA map (eg SFD dust, H-alpha).
+
+    The maps are much coarser than the tiles at all but the lowest zooms,
+    so tiles are rendered by evaluating the map on a grid of at least
+    *samples_per_pixel* points per map pixel (of *map_pixscale* arcsec,
+    the smallest map pixel size) and interpolating linearly between them.
+    Since the map lookup itself interpolates linearly between map pixels,
+    the result differs from evaluating the map at every tile pixel by at
+    most the change in the map over 1/samples_per_pixel of a map pixel
+    (only where it is not linear, ie, near map pixel centers).
+    '''
     def __init__(self, name, zeamap, stretch=None, vmin=0., vmax=1.,
-                 cmap=None):
+                 cmap=None, map_pixscale=100., samples_per_pixel=2):
         super(ZeaLayer, self).__init__(name)
         self.zeamap = zeamap
         self.stretch = stretch
@@ -3798,32 +4228,108 @@ class ZeaLayer(MapLayer):
             self.cmap = cmap
         self.vmin = vmin
         self.vmax = vmax
+        self.map_pixscale = map_pixscale
+        self.samples_per_pixel = samples_per_pixel
+        self.lut = None
+
+    def get_sampling_step(self, wcs):
+        '''
+        Returns the spacing, in pixels of *wcs*, at which to evaluate the
+        map (1 = every pixel).
+        '''
+        import numpy as np
+        from astrometry.util.starutil_numpy import degrees_between
+        W,H = wcs.get_width(), wcs.get_height()
+        # largest pixel size anywhere in the image (Mercator tiles vary)
+        n = 9
+        px = np.linspace(1., W, n)
+        py = np.linspace(1., H, n)
+        xx,yy = np.meshgrid(px, py)
+        rr,dd = wcs.pixelxy2radec(xx.ravel(), yy.ravel())[-2:]
+        rr = rr.reshape(xx.shape)
+        dd = dd.reshape(xx.shape)
+        dx = degrees_between(rr[:,:-1], dd[:,:-1], rr[:,1:], dd[:,1:]) / (px[1] - px[0])
+        dy = degrees_between(rr[:-1,:], dd[:-1,:], rr[1:,:], dd[1:,:]) / (py[1] - py[0])
+        pixscale = 3600. * max(np.max(dx), np.max(dy))
+        if not np.isfinite(pixscale) or pixscale <= 0:
+            return 1
+        step = int(np.floor(self.map_pixscale / self.samples_per_pixel / pixscale))
+        return max(1, min(step, 64))
 
-    def render_into_wcs(self, wcs, zoom, x, y, bands=None, tempfiles=None):
+    def render_into_wcs(self, wcs, zoom, x, y, bands=None, tempfiles=None, weights=None):
+        # (all-sky: *weights* is not filled, so no tiles get skipped)
         import numpy as np
-        xx,yy = np.meshgrid(np.arange(wcs.get_width()), np.arange(wcs.get_height()))
+        W,H = wcs.get_width(), wcs.get_height()
+        step = self.get_sampling_step(wcs)
+        if step > 1:
+            # evaluate on a coarse grid (including the last row & column)
+            gx = np.unique(np.append(np.arange(0, W, step), W-1))
+            gy = np.unique(np.append(np.arange(0, H, step), H-1))
+        else:
+            gx = np.arange(W)
+            gy = np.arange(H)
+        xx,yy = np.meshgrid(gx, gy)
         rr,dd = wcs.pixelxy2radec(1. + xx.ravel(), 1. + yy.ravel())[-2:]
         #print('ZeaLayer rendering: RA range', rr.min(), rr.max(),
         #  'Dec', dd.min(), dd.max())
         # Calling ebv function for historical reasons, works for any ZEA map.
         val = self.zeamap.ebv(rr, dd) 
         val = val.reshape(xx.shape)
+        if step > 1:
+            val = interpolate_grid(val, gx, gy, W, H)
         #print('ZeaLayer: map range', val.min(), val.max())
         return [val]
 
+    def get_lut(self):
+        '''
+        The colormap as a lookup table: its N colors, then the colors for
+        under, over and bad (NaN) values.
+        '''
+        if self.lut is None:
+            import numpy as np
+            N = self.cmap.N
+            self.lut = np.vstack((self.cmap(np.arange(N)),
+                                  self.cmap(np.array([-1., 2., np.nan]))))[:, :3]
+        return self.lut
+
     def get_rgb(self, imgs, bands, **kwargs):
+        import numpy as np
         val = imgs[0]
         if self.stretch is not None:
             val = self.stretch(val)
-        rgb = self.cmap((val - self.vmin) / (self.vmax - self.vmin))
-        #print('RGB', rgb.shape, rgb.dtype)
-        s = rgb.shape
-        if len(s) == 3 and s[2] == 4:
-            # cut out alpha layer
-            rgb = rgb[:,:,:3]
+        # Same binning as matplotlib's Colormap.__call__
+        lut = self.get_lut()
+        N = self.cmap.N
+        xa = (val - self.vmin) / (self.vmax - self.vmin) * N
+        bad = np.isnan(xa)
+        xa[bad] = 0.
+        xa[xa < 0] = -1
+        xa[xa == N] = N - 1
+        xa = np.clip(xa, -1, N).astype(int)
+        xa[xa > N-1] = N + 1
+        xa[xa < 0] = N
+        xa[bad] = N + 2
+        rgb = lut[xa]
         #print('red range', rgb[:,:,0].min(), rgb[:,:,0].max())
         return rgb
 
+def interpolate_grid(val, gx, gy, W, H):
+    '''
+    Bilinearly interpolates values *val* on the grid of pixel columns *gx*
+    and rows *gy* (increasing, spanning the image) to the full W x H image.
+    '''
+    import numpy as np
+    def weights(g, n):
+        p = np.arange(n)
+        i = np.clip(np.searchsorted(g, p, side='right') - 1, 0, len(g) - 2)
+        f = (p - g[i]) / (g[i+1] - g[i]).astype(np.float64)
+        return i, f
+    ix,fx = weights(gx, W)
+    iy,fy = weights(gy, H)
+    # along rows, then columns
+    v = val[:, ix] * (1. - fx) + val[:, ix+1] * fx
+    return v[iy, :] * (1. - fy)[:, np.newaxis] + v[iy+1, :] * fy[:, np.newaxis]
+
 # "PR"
 #rgbkwargs=dict(mnmx=(-0.3,100.), arcsinh=1.))
 
@@ -4363,7 +4869,7 @@ def ccd_list(req):
 
     if name == 'unwise-tiles':
         from astrometry.util.starutil import radectoxyz, xyztoradec, degrees_between
-        from astrometry.libkd.spherematch import tree_open, tree_search_radec
+        from map.filecache import kdtree_search_radec
         from astrometry.util.fits import fits_table
         x1,y1,z1 = radectoxyz(east, north)
         x2,y2,z2 = radectoxyz(west, south)
@@ -4371,8 +4877,7 @@ def ccd_list(req):
         # 0.8: unWISE tile radius, approx.
         radius = 0.8 + degrees_between(east, north, west, south)/2. 
         fn = os.path.join(settings.DATA_DIR, 'unwise-tiles.kd.fits')
-        kd = tree_open(fn)
-        I = tree_search_radec(kd, rc, dc, radius)
+        I = kdtree_search_radec(fn, rc, dc, radius)
         print(len(I), 'unwise tiles within', radius, 'deg of RA,Dec (%.3f, %.3f)' % (rc,dc))
         if len(I) == 0:
             return HttpResponse(json.dumps(dict(polys=[])), content_type='application/json')
@@ -4423,11 +4928,10 @@ def ccd_list(req):
     return HttpResponse(json.dumps(dict(polys=ccds)), content_type='application/json')
 
 def sdss_ccds_near(rc, dc, radius):
-    from astrometry.libkd.spherematch import tree_open, tree_search_radec
+    from map.filecache import kdtree_search_radec
     from astrometry.util.fits import fits_table
     fn = os.path.join(settings.DATA_DIR, 'sdss', 'sdss-fields-trimmed.kd.fits')
-    kd = tree_open(fn, 'ccds')
-    I = tree_search_radec(kd, rc, dc, radius)
+    I = kdtree_search_radec(fn, rc, dc, radius, treename='ccds')
     print(len(I), 'CCDs within', radius, 'deg of RA,Dec (%.3f, %.3f)' % (rc,dc))
     if len(I) == 0:
         return None
@@ -5805,30 +6309,6 @@ def cutout_wcs(req):
 def sdss_wcs(req):
     return cutout_wcs(req, default_layer='sdssco')
 
-def ra_ranges_overlap(ralo, rahi, ra1, ra2):
-    import numpy as np
-    x1 = np.cos(np.deg2rad(ralo))
-    y1 = np.sin(np.deg2rad(ralo))
-
-    x2 = np.cos(np.deg2rad(rahi))
-    y2 = np.sin(np.deg2rad(rahi))
-
-    x3 = np.cos(np.deg2rad(ra1))
-    y3 = np.sin(np.deg2rad(ra1))
-
-    x4 = np.cos(np.deg2rad(ra2))
-    y4 = np.sin(np.deg2rad(ra2))
-
-    #cw31 = x1*y3 - x3*y1
-    cw32 = x2*y3 - x3*y2
-
-    cw41 = x1*y4 - x4*y1
-    #cw42 = x2*y4 - x4*y2
-
-    #print('3:', cw31, cw32)
-    #print('4:', cw41, cw42)
-    return np.logical_and(cw32 <= 0, cw41 >= 0)
-
 if __name__ == '__main__':
     import sys
 
@@ -107,6 +107,46 @@ def _one_tile(X):
         view = views.get_tile_view(kind)
         return view(req, version, zoom, x, y, savecache=True, **kwargs)
 
+def _one_metatile(X):
+    '''
+    Renders (and caches) the n x n block of tiles at x0,y0 if any of its
+    tiles is missing from the cache (or *ignore*).
+    '''
+    (kind, zoom, x0, y0, n, ignore) = X
+    from map.coverage import get_coverage
+    layer = get_layer(kind)
+    ver = tileversions.get(layer.name, [1])[-1]
+    cov = get_coverage(layer)
+    N = 2**zoom
+    missing = False
+    for y in range(y0, min(y0 + n, N)):
+        for x in range(x0, min(x0 + n, N)):
+            if cov is not None and not cov.has_tile(zoom, x, y):
+                continue
+            if ignore or not layer.get_tile_store(ver, zoom, x, y).has_tile(ver, zoom, x, y):
+                missing = True
+    if not missing:
+        print('Metatile', zoom, x0, y0, 'is cached')
+        return
+    print('Rendering metatile', zoom, x0, y0, 'n', n)
+    fused = None
+    if settings.FUSED_RESID_TILES:
+        fused = layer.get_fused_layer()
+    if fused is not None:
+        fused.render_fused_tiles(zoom, x0, y0, n)
+    else:
+        layer.render_tiles_jpeg(ver, zoom, x0, y0, n, True)
+
+def _bounce_one_metatile(*args):
+    try:
+        _one_metatile(*args)
+    except KeyboardInterrupt:
+        raise
+    except:
+        print('Error in _one_metatile(', args, '):')
+        import traceback
+        traceback.print_exc()
+
 def _bounce_one_tile(*args):
     try:
         _one_tile(*args)
@@ -207,7 +247,6 @@ def top_levels(mp, opt):
         import pylab as plt
         from viewer import settings
         import fitsio
-        from scipy.ndimage.filters import gaussian_filter
         from map.views import _unwise_to_rgb
         tag = opt.kind
 
@@ -243,10 +282,6 @@ def top_levels(mp, opt):
         print('Version', ver)
         basescale = 5
 
-        pat = os.path.join(settings.DATA_DIR, 'tiles', tag, '%(ver)s',
-                           '%(zoom)i', '%(x)i', '%(y)i.jpg')
-        patdata = dict(ver=ver)
-
         tilesize = 256
         tiles = 2**basescale
         side = tiles * tilesize
@@ -301,12 +336,12 @@ def top_levels(mp, opt):
                     ims = [base[y*tilesize:(y+1)*tilesize,
                                 x*tilesize:(x+1)*tilesize] for base in bases]
                     rgb = layer.get_rgb(ims, bands, **rgbkwargs)
-                    pp = patdata.copy()
-                    pp.update(zoom=scale, x=x, y=y)
-                    fn = pat % pp
-                    trymakedirs(fn)
-                    save_jpeg(fn, rgb)
-                    print('Wrote', fn)
+                    from io import BytesIO
+                    out = BytesIO()
+                    save_jpeg(out, rgb)
+                    store = layer.get_tile_store(ver, scale, x, y)
+                    store.put(ver, scale, x, y, out.getvalue())
+                    print('Wrote tile', ver, scale, x, y)
 
             for i,base in enumerate(bases):
                 if 'vlass' in opt.kind:
@@ -432,14 +467,12 @@ def top_levels(mp, opt):
 
                 sys.exit(0)
 
-        from scipy.ndimage.filters import gaussian_filter
+        from map.downsample import smooth_and_bin
 
         for scale in range(basescale-1, -1, -1):
 
             for i,base in enumerate(bases):
-                base = gaussian_filter(base, 1.)
-                base = (base[::2,::2] + base[1::2,::2] + base[1::2,1::2] + base[::2,1::2])/4.
-                bases[i] = base
+                bases[i] = smooth_and_bin(base)
 
             tiles = 2**scale
             
@@ -459,7 +492,7 @@ def top_levels(mp, opt):
     if opt.kind in ['depth-g', 'depth-r', 'depth-z']:
         import pylab as plt
         from viewer import settings
-        from scipy.ndimage.filters import gaussian_filter
+        from map.downsample import smooth_and_bin
         from map.views import trymakedirs
 
         tag = 'decam-' + opt.kind
@@ -490,10 +523,7 @@ def top_levels(mp, opt):
 
             newbase = []
             for i in range(3):
-                b = gaussian_filter(base[:,:,i], 1.)
-                b = (b[ ::2, ::2] + b[1::2, ::2] +
-                     b[1::2,1::2] + b[ ::2,1::2])/4.
-                newbase.append(b)
+                newbase.append(smooth_and_bin(base[:,:,i]))
             base = np.dstack(newbase)
 
             tiles = 2**scale
@@ -686,6 +716,13 @@ def main():
 
     parser.add_option('--bands', default=None)
 
+    parser.add_option('--metatile', type=int, default=settings.METATILE_SIZE,
+                      help='Render blocks of N x N tiles at once (power of 2; default %default)')
+    parser.add_option('--fused', action='store_true', default=settings.FUSED_RESID_TILES,
+                      help='Render image, model and resid tiles together (for resid layers)')
+    parser.add_option('--resample-tables', default=settings.RESAMPLE_TABLE_DIR,
+                      help='Cache brick-to-tile resampling tables in this directory')
+
     parser.add_option('-v', '--verbose', dest='verbose', action='count',
                       default=0, help='Make more verbose')
 
@@ -698,6 +735,10 @@ def main():
         lvl = logging.DEBUG
     logging.basicConfig(level=lvl, format='%(message)s', stream=sys.stdout)
 
+    # (before forking workers)
+    settings.METATILE_SIZE = opt.metatile
+    settings.FUSED_RESID_TILES = opt.fused
+    settings.RESAMPLE_TABLE_DIR = opt.resample_tables
 
     mp = multiproc(opt.threads)
 
@@ -1300,7 +1341,15 @@ def main():
             basedir = settings.DATA_DIR
             ver = tileversions[opt.kind][-1]
             tiledir = os.path.join(basedir, 'tiles', opt.kind, '%i'%ver, '%i'%zoom)
-            for dirpath,dirnames,filenames in os.walk(tiledir):
+            if settings.TILE_STORE != 'files':
+                # Packed tile archives: ask the store, tile by tile.
+                layer = get_layer(opt.kind)
+                for iy,y in enumerate(yy):
+                    for ix,x in enumerate(xx):
+                        store = layer.get_tile_store(ver, zoom, x, y)
+                        tileexists[iy, ix] = store.has_tile(ver, zoom, x, y)
+                tiledir = None
+            for dirpath,dirnames,filenames in (os.walk(tiledir) if tiledir else []):
                 # change walk order
                 dirnames.sort()
                 if len(filenames) == 0:
@@ -1436,6 +1485,8 @@ def main():
         #     plt.savefig('%s-z%02i-exists.png' % (opt.kind, zoom))
 
 
+_metatiles_queued = set()
+
 def run_xy_set(zoom, xx, yy, rr, dd, opt, Bkd, Ckd, ccdsize, tilesize, mp):
     if opt.queue:
         if 'decaps2' in opt.kind:
@@ -1503,11 +1554,24 @@ def run_xy_set(zoom, xx, yy, rr, dd, opt, Bkd, Ckd, ccdsize, tilesize, mp):
         xx = xx[keep]
         yy = yy[keep]
 
+    n = 1
+    if opt.metatile > 1:
+        n = get_layer(opt.kind).get_metatile_size(zoom)
     args = []
     for xi,yi in zip(xx,yy):
-        args.append((opt.kind, zoom, xi, yi, opt.ignore, False))
+        if n > 1:
+            # Render whole metatiles (each one once), if any of their
+            # tiles is missing.
+            key = (opt.kind, zoom, xi - (xi % n), yi - (yi % n))
+            if key in _metatiles_queued:
+                continue
+            _metatiles_queued.add(key)
+            args.append(key + (n, opt.ignore))
+        else:
+            args.append((opt.kind, zoom, xi, yi, opt.ignore, False))
     print('Rendering', len(args), 'tiles in row/col')
-    mp.map(_bounce_one_tile, args, chunksize=min(100, max(1, int(len(args)/opt.threads))))
+    bounce = _bounce_one_metatile if n > 1 else _bounce_one_tile
+    mp.map(bounce, args, chunksize=min(100, max(1, int(len(args)/opt.threads))))
     #mp.map(_one_tile, args, chunksize=min(100, max(1, int(len(args)/opt.threads))))
     print('Rendered', len(args), 'tiles')
 
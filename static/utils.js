@@ -60,3 +60,84 @@ function disableMouseEventPropagation(element) {
         .disableClickPropagation(container)
         .disableScrollPropagation(container);
 }
+
+// Decodes a binary catalog response (see map/catformat.py) into the
+// same object the JSON response would give.
+function decodeCatalog(buf) {
+    var dv = new DataView(buf);
+    var magic = String.fromCharCode(dv.getUint8(0), dv.getUint8(1),
+                                    dv.getUint8(2), dv.getUint8(3));
+    if (magic != 'CAT1') {
+        throw 'Not a binary catalog: ' + magic;
+    }
+    var hlen = dv.getUint32(4, true);
+    var header = JSON.parse(new TextDecoder('utf-8').decode(
+        new Uint8Array(buf, 8, hlen)));
+    var data0 = 8 + hlen;
+    var types = {
+        float64: Float64Array, float32: Float32Array,
+        int32: Int32Array, uint32: Uint32Array,
+        int16: Int16Array, uint16: Uint16Array,
+        int8: Int8Array, uint8: Uint8Array,
+    };
+    var readArray = function(desc) {
+        var n = desc.shape.reduce(function(a, b) { return a * b; }, 1);
+        var arr = new types[desc.dtype](buf, data0 + desc.offset, n);
+        if (desc.shape.length == 1) {
+            return Array.from(arr);
+        }
+        // 2-d: one row (eg, [ra, dec]) per object
+        var w = desc.shape[1];
+        var rows = [];
+        for (var i = 0; i < desc.shape[0]; i++) {
+            rows.push(Array.from(arr.subarray(i * w, (i + 1) * w)));
+        }
+        return rows;
+    };
+    var result = {};
+    header.fields.forEach(function(field) {
+        if (field.kind == 'json') {
+            result[field.name] = field.value;
+        } else if (field.kind == 'array') {
+            result[field.name] = readArray(field);
+        } else if (field.kind == 'records') {
+            var cols = field.fields.map(readArray);
+            var recs = [];
+            var n = (cols.length ? cols[0].length : 0);
+            for (var i = 0; i < n; i++) {
+                var rec = {};
+                for (var j = 0; j < cols.length; j++) {
+                    rec[field.fields[j].name] = cols[j][i];
+                }
+                recs.push(rec);
+            }
+            result[field.name] = recs;
+        }
+    });
+    return result;
+}
+
+// Like $.getJSON for catalog URLs, but asks for the binary catalog format
+// (falling back to JSON if the server sends that instead).
+function getCatalog(url, callback) {
+    url += (url.indexOf('?') == -1 ? '?' : '&') + 'format=binary';
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url);
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+        if (xhr.status != 200) {
+            console.log('Failed to load catalog ' + url + ': ' + xhr.status);
+            return;
+        }
+        var ctype = xhr.getResponseHeader('Content-Type') || '';
+        var result;
+        if (ctype.indexOf('application/octet-stream') == 0) {
+            result = decodeCatalog(xhr.response);
+        } else {
+            result = JSON.parse(new TextDecoder('utf-8').decode(
+                new Uint8Array(xhr.response)));
+        }
+        callback(result);
+    };
+    xhr.send();
+}
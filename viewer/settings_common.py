@@ -68,15 +68,82 @@ ENABLE_VLASS = True
 
 # Can the web service not create files under BASE_DIR?
 READ_ONLY_BASEDIR = False
+# ... in which case, scaled images and images derived from the data
+# files (eg, 2MASS sky-subtracted images) are cached here instead, with
+# the least-recently used files deleted to keep it below
+# READ_ONLY_CACHE_BYTES (0 = no limit); see map/scaledcache.py.
+READ_ONLY_CACHE_DIR = '/tmp/viewer-cache'
+READ_ONLY_CACHE_BYTES = 50 * 1024**3
 
 DEBUG_LOGGING = False
 
 MAX_NATIVE_ZOOM = 15
 
+# Number of threads used to read & resample bricks when rendering a
+# tile or cutout (per uwsgi worker process); 1 = serial.
+RENDER_THREADS = 4
+
+# Per-process caches of open FITS file handles, and of headers / WCS /
+# HDU counts parsed from them (see map/filecache.py); 0 = disabled.
+FITS_HANDLE_CACHE_SIZE = 64
+FITS_METADATA_CACHE_SIZE = 4096
+# Per-process pool of open catalog kd-trees: max number of trees (ie,
+# open files) and max total size of their files; 0 = no pool / no limit.
+KDTREE_CACHE_SIZE = 64
+KDTREE_CACHE_BYTES = 2 * 1024**3
+# Per-process cache of the unique-area masks of model / resid bricks
+# (see map/brickmask.py); 0 = disabled.
+UNIQUE_MASK_CACHE_SIZE = 1024
 
 # Tile cache is writable?
 SAVE_CACHE = False
 
+# How pre-rendered tiles are stored in each layer's tile directory (see
+# map/tilestore.py): 'files' = one JPEG per tile; 'sqlite' = MBTiles-style
+# archives holding TILE_STORE_ZOOMS_PER_FILE zoom levels each.
+TILE_STORE = 'files'
+TILE_STORE_ZOOMS_PER_FILE = 4
+
+# uwsgi kills requests that take longer than this (keep in sync with
+# "harakiri" in uwsgi.ini).
+HARAKIRI = 300
+# When several requests want the same uncached tile, one renders it and
+# the others wait up to this many seconds for it (then render it
+# themselves), leaving time to do so before harakiri.
+TILE_RENDER_WAIT = HARAKIRI / 2
+
+# On a tile cache miss (when saving to the cache), render the whole
+# METATILE_SIZE x METATILE_SIZE block of tiles around it at once
+# (a power of 2; 1 = off).
+METATILE_SIZE = 4
+
+# On a tile cache miss for an image, model or resid layer (when saving
+# to the cache), render and cache the tiles of all three at once.
+FUSED_RESID_TILES = False
+
+# Zoom level of the per-layer maps of which tiles have any data, used to
+# answer tiles outside a survey's footprint without rendering them (see
+# map/coverage.py); None = off.  The maps are saved in each layer's tile
+# directory and are not rebuilt when a layer gets new bricks -- delete
+# the coverage-z*.fits files then -- so this is off by default.
+COVERAGE_ZOOM = None
+
+# Level-of-detail pyramids of the Tractor catalogs (see map/catpyramid.py)
+# show at most this many sources per tile below zoom 12; the web page
+# asks for the Tractor catalog tiles of layers that have a pyramid from
+# CAT_PYRAMID_MIN_ZOOM up, and of other layers from zoom 12 up.
+CAT_PYRAMID_SOURCES_PER_TILE = 500
+CAT_PYRAMID_MIN_ZOOM = 12
+
+# Optional cache of the tables mapping brick pixels to Mercator tile
+# pixels, so that re-rendering a tile skips the WCS math (see
+# map/resampletable.py); None = off.  The directory is kept below
+# RESAMPLE_TABLE_BYTES (0 = no limit), and each process keeps up to
+# RESAMPLE_TABLE_CACHE_BYTES of tables in memory.
+RESAMPLE_TABLE_DIR = None
+RESAMPLE_TABLE_BYTES = 20 * 1024**3
+RESAMPLE_TABLE_CACHE_BYTES = 256 * 1024**2
+
 ROOT_URL = '/viewer'
 
 HOSTNAME = 'legacysurvey.org'